@@ -10,11 +10,24 @@ alpaca.py
 Devines Alpaca class:
   
     Initialize like:
-        alpaca = Alpaca(device_type = "Switch", server_address = address, control_port = port)
+        alpaca = Alpaca(device_type = "Switch", server_address = address, control_port = port, loop = device_loop)
+        
+        loop: the asyncio event loop (running in its own thread) that owns device I/O.  Bound API
+        methods may return a coroutine instead of a response; it is run on this loop.
+        server_mode: "threaded" (ThreadingHTTPServer, one thread per connection) or "asyncio"
+        (all connections served on loop, with keep-alive and pipelining).
+        
+        Both modes apply the connection limits max_connections, max_pending_connections, idle_timeout,
+        read_timeout and max_body_size (class attributes, may be set per instance before start()).
+        Event-feed requests (/events, /events/stream) give up their connection slot while they wait,
+        and are limited by max_event_connections instead.
+        alpaca.limit_counters counts how often each limit has fired.
     
     Start:
         alpaca.bindMethods(device_manager.alpaca_methods)
         alpaca.start()
+        ...
+        alpaca.stop()       # on shutdown: close the HTTP and discovery sockets
 
     Functions:
         alpaca.bindMethod(self, method_type, method_name, action)
@@ -26,12 +39,31 @@ Devines Alpaca class:
         alpaca.invalid_request_response(self, transaction, error_message)
         alpaca.not_supported_response(self, transaction)
         alpaca.management_response(self, transaction, value)
+        alpaca.cached_response(self, transaction, key, value, version=())
+        alpaca.invalidate_responses(self, *method_names)
+        
+        alpaca.publish_event(self, event)
+        
+        alpaca.ProcessRequest(self, request_type, request_path, request_body, if_none_match=None)          # blocking, from any non-loop thread
+        alpaca.ProcessRequestAsync(self, request_type, request_path, request_body, if_none_match=None)     # coroutine, on loop
+        
+    Responses built by cached_response() carry a weak ETag (TaggedResponse.etag), sent as an ETag header.  A
+    GET whose If-None-Match header (passed as if_none_match) matches is answered 304 with no body.  The ETag
+    is the version of the data the response was read from, as given by the caller, behind a random prefix
+    chosen at start-up, so tags from an earlier run of the server never match.
         
+    Besides the Alpaca API, the HTTP server offers change notifications published by the device manager:
+        GET /events?since=N&timeout=S    long-poll, returns JSON {"Version": v, "Events": [...]} once events newer than N exist
+        GET /events/stream               Server-Sent Events stream (resumes after Last-Event-ID header or ?since=N)
+        GET /metrics                     counters, gauges and histograms (see metrics.py) in the Prometheus text format
+
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
 
 from http.server import HTTPServer, BaseHTTPRequestHandler, ThreadingHTTPServer
+from http import HTTPStatus
+import io
 import json
 import asyncio
 import threading
@@ -39,12 +71,27 @@ from threading import Thread
 import time
 import sys
 import re
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, unquote_plus, urlparse
 # for multicast discovery:
-from socket import AF_INET6, AF_INET
 import socket
 import struct
 import os
+import collections
+import itertools
+import logging
+from logger import get_logger, TRACE
+import metrics
+
+log = get_logger("alpaca")
+http_log = get_logger("http")
+
+request_count = metrics.counter("alpaca_requests_total", "Alpaca and management API requests by method and HTTP status", ("method", "code"))
+request_latency = metrics.histogram("alpaca_request_duration_seconds", "Time to produce an Alpaca response, including any device I/O", ("method",))
+connection_gauge = metrics.gauge("http_connections", "HTTP connections being served (active), waiting for a slot (pending) or waiting on the event feed (events)", ("state",))
+connection_limit_count = metrics.counter("http_connection_limits_total", "Times each HTTP connection limit fired", ("limit",))
+discovery_request_count = metrics.counter("alpaca_discovery_requests_total", "Alpaca discovery datagrams by outcome", ("result",))
+thread_gauge = metrics.gauge("process_threads", "Live Python threads")
+thread_gauge.set_function(threading.active_count)
 
 
 
@@ -106,47 +153,153 @@ class AlpacaAPI():
         "INVALID_WHILE_SLAVED":                 0x409,
         "INVALID_OPERATION":                    0x40B,
         "ACTION_NOT_IMPLEMENTED":               0x40C,
+        "UNSPECIFIED_ERROR":                    0x4FF,
     }
 
 
 
 
+class TaggedResponse(bytes):
+    # An encoded response body and the ETag of its content; empty for a 304 Not Modified
+    def __new__(cls, content, etag):
+        response = bytes.__new__(cls, content)
+        response.etag = etag
+        return response
+
+
+class DeadlineReader(io.RawIOBase):
+    # Raw input of a threaded handler's rfile.  Each recv waits at most until deadline (a time.monotonic()
+    # value, None for no limit), so a client sending a request a byte at a time can't stretch it past the
+    # deadline the way it could a per-recv socket timeout.  The socket is left with write_timeout.
+    def __init__(self, sock, write_timeout):
+        self.sock = sock
+        self.write_timeout = write_timeout
+        self.deadline = None
+        
+    def readable(self):
+        return True
+        
+    def readinto(self, buffer):
+        if self.deadline is None:
+            return self.sock.recv_into(buffer)
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout('timed out')
+        self.sock.settimeout(remaining)
+        try:
+            return self.sock.recv_into(buffer)
+        finally:
+            self.sock.settimeout(self.write_timeout)
+
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison (RFC 9110 13.1.2) of an If-None-Match header value with an ETag
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag[2:] in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def parse_bool(value):
+    lowered = value.lower()
+    if lowered == "true":
+        return True
+    if lowered == "false":
+        return False
+    raise ValueError('expected "true" or "false"')
+
+
 class Alpaca():
     api = AlpacaAPI()
-    connected = False
     cliend_id = None
     server_transaction_id = 0
-    server_transaction_count = 0
-    methods = {"GET":{}, "PUT":{}}
+    
+    # Converters for the parameter types named in AlpacaAPI.methods
+    param_coercers = {"str": str, "int": int, "float": float, "bool": parse_bool}
+    
+    # HTTP connection limits, applied by both server modes.  limit_counters counts each time one fires.
+    max_connections = 32            # connections being served at once
+    max_pending_connections = 16    # accepted connections waiting for a slot; beyond this, answer 503
+    max_event_connections = 8       # event-feed requests waiting at once, outside max_connections; beyond this, answer 503
+    idle_timeout = 60               # seconds a keep-alive connection may sit between requests
+    read_timeout = 10               # seconds a client may stall while sending a request
+    max_body_size = 16384           # bytes; larger request bodies are answered 413
+    max_header_lines = 100
+    busy_response = b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
         
-    def __init__(self, device_type, server_address='0.0.0.0', control_port=8000, discovery_port=32227):
+    def __init__(self, device_type, server_address='0.0.0.0', control_port=8000, discovery_port=32227, loop=None, server_mode="threaded"):
         assert device_type in self.api.supported_device_types, 'device type "%s" not supported' % device_type
+        assert server_mode in ("threaded", "asyncio"), 'server mode "%s" not supported' % server_mode
+        assert server_mode != "asyncio" or loop is not None, 'asyncio server mode requires an event loop'
         self.server_address = server_address
         self.control_port = control_port
         self.device_type = device_type
         self.discovery_port = discovery_port
-        self.server = self.AlpacaHttpServer(self, server_address, control_port)
+        self.loop = loop
+        self.events = self.EventFeed()
+        # server transaction IDs; next() on an itertools.count is atomic, so handler threads need no lock
+        self.transaction_ids = itertools.count()
+        self.response_cache = {}
+        self.etag_prefix = os.urandom(4).hex()
+        self.devices_version = 0
+        self.set_devices([("Kasa Switch Hub", "1234")])
+        self.limit_counters = collections.Counter()
+        self.limit_lock = threading.Lock()
+        self.discovery_responder = None
+        self.event_connections = 0
+        self.event_lock = threading.Lock()
+        if server_mode == "asyncio":
+            self.server = self.AsyncAlpacaHttpServer(self, server_address, control_port)
+        else:
+            self.server = self.AlpacaHttpServer(self, server_address, control_port)
+        connection_gauge.set_function(self.server.connection_counts)
 
-        # re-catalog API-listed methods, pulling in Common and device type-specific methods
+        # method label values for request metrics; anything else is counted as "other"
+        self.metric_methods = {"apiversions", "description", "configureddevices"}
+        
+        # re-catalog API-listed methods, pulling in Common and device type-specific methods, and compile
+        # them once into a dispatch table keyed by (request type, device type, method).  Each route carries
+        # its required parameter set and a coercer per parameter, so ProcessRequest does no schema work.
+        self.methods = {"GET":{}, "PUT":{}}
+        self.routes = {}
         for api_method_group in ("Common", self.device_type):
             for method_type in ("GET", "PUT"):
-                for method_name in list(self.api.methods[api_method_group][method_type].keys()):
-                    self.methods[method_type][method_name] = {
-                        "action":None, 
-                        "required_params":self.api.methods[api_method_group][method_type][method_name]
+                for method_name, param_types in self.api.methods[api_method_group][method_type].items():
+                    route = {
+                        "action": None, 
+                        "required_params": param_types,
+                        "required_set": frozenset(param_types),
+                        "coercers": tuple((param_name, self.param_coercers[param_type]) for param_name, param_type in param_types.items()),
                     }
+                    self.methods[method_type][method_name] = route
+                    self.routes[(method_type, self.device_type.lower(), method_name)] = route
+                    self.metric_methods.add(method_name)
 
     def start(self):
         # Warn if any api methods have not been bound
         for method_type in ("GET", "PUT"):
             for method_name in list(self.methods[method_type].keys()):
                 if self.methods[method_type][method_name]["action"] is None:
-                    print('Warning: Alpaca API %s method "%s" not bound' % (method_type, method_name))
-        print('Starting Alpaca device server')
+                    log.warning('Alpaca API %s method "%s" not bound', method_type, method_name)
+        log.info('Starting Alpaca device server')
         self.server.start()
         
-        print('Initializing Alpaca discovery responder')
-        self.discovery_responder = self.DiscoveryResponder(self.server_address, self.discovery_port, self.control_port)
+        log.info('Initializing Alpaca discovery responder')
+        if self.loop is None:
+            # threaded mode without a device loop: give the responder a loop of its own
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.discovery_responder = self.DiscoveryResponder(self.server_address, self.discovery_port, self.control_port, self.loop)
+        self.discovery_responder.start()
+
+    def stop(self):
+        # Stop accepting HTTP connections and discovery requests; connections being served are not waited for
+        log.info('Stopping Alpaca device server')
+        self.server.stop()
+        if self.discovery_responder is not None:
+            self.discovery_responder.stop()
 
         
         
@@ -167,8 +320,105 @@ class Alpaca():
             assert hasattr(method[2], '__call__'), "Expected function handle"
             self.bindMethod(method[0], method[1], method[2])
 
+    def set_devices(self, devices):
+        # The devices served, as [(name, unique id), ...] numbered from 0.  Listed by configureddevices;
+        # requests for any other device number are rejected before reaching a bound method.
+        self.devices = [{"DeviceName": name, "DeviceType": self.device_type, "DeviceNumber": number, "UniqueID": unique_id}
+            for number, (name, unique_id) in enumerate(devices)]
+        self.devices_version += 1
+        self.invalidate_responses("management")
+
+    def publish_event(self, event):
+        # Push a change notification (dict) to /events and /events/stream clients
+        return self.events.publish(event)
+
+    class EventFeed:
+        # Versioned, bounded log of change events.  Readers hold a version cursor and block
+        # until something newer is published.
+        max_events = 1000
+        
+        def __init__(self):
+            self.version = 0
+            self.events = collections.deque(maxlen=self.max_events)
+            self.condition = threading.Condition()
+            self.async_waiters = []     # (loop, future) per wait_async() caller
+            
+        def publish(self, event):
+            with self.condition:
+                self.version += 1
+                event = dict(event, Version=self.version, Time=time.time())
+                self.events.append(event)
+                self.condition.notify_all()
+                for (loop, future) in self.async_waiters:
+                    loop.call_soon_threadsafe(self._wake, future)
+                self.async_waiters = []
+            return event
+
+        @staticmethod
+        def _wake(future):
+            if not future.done():
+                future.set_result(None)
+            
+        def wait(self, version, timeout):
+            # (current version, events newer than version), once there are any or timeout has passed.  If the
+            # cursor is older than the retained log, the client has missed events and gets everything
+            # retained; it can tell from the first Version.
+            with self.condition:
+                self.condition.wait_for(lambda: self.version > version, timeout)
+                return (self.version, [event for event in self.events if event["Version"] > version])
+                
+        async def wait_async(self, version, timeout):
+            # Same as wait(), without blocking the calling event loop
+            loop = asyncio.get_running_loop()
+            waiter = None
+            with self.condition:
+                if self.version <= version:
+                    waiter = (loop, loop.create_future())
+                    self.async_waiters.append(waiter)
+            if waiter is not None:
+                try:
+                    await asyncio.wait_for(waiter[1], timeout)
+                except asyncio.TimeoutError:
+                    pass
+            with self.condition:
+                if waiter in self.async_waiters:
+                    self.async_waiters.remove(waiter)
+                return (self.version, [event for event in self.events if event["Version"] > version])
+
+    def parse_events_request(self, request_path, last_event_id=None):
+        # For /events and /events/stream: returns (stream, since, timeout); raises ValueError on bad parameters.
+        # Versions restart at 0 with the server, so a cursor ahead of the feed is from before a restart:
+        # the client gets everything retained, as it would after falling behind.
+        path = urlparse(request_path)
+        query = dict((name.lower(), val[0]) for name, val in parse_qs(path.query).items())
+        since = int(query.get('since', last_event_id or self.events.version))
+        if since > self.events.version:
+            since = 0
+        timeout = min(float(query.get('timeout', 30)), 300)
+        return (path.path == "/events/stream", since, timeout)
+
+    def enter_event_feed(self, peer=None):
+        # Claim one of max_event_connections for an event-feed request; False, counted, if all are taken
+        with self.event_lock:
+            claimed = self.event_connections < self.max_event_connections
+            if claimed:
+                self.event_connections += 1
+        if not claimed:
+            self.count_limit("event_connections_rejected", peer)
+        return claimed
+
+    def leave_event_feed(self):
+        with self.event_lock:
+            self.event_connections -= 1
+
+    @staticmethod
+    def encode_sse_event(event):
+        return ('id: %i\ndata: %s\n\n' % (event["Version"], json.dumps(event))).encode('utf-8')
+
     class Transaction:
-        def __init__(self, client_transaction_id, server_transaction_id, client_id, request_type, request_path, method, params):
+        # params: raw (string) request parameters, lower-case names
+        # args:   required parameters of the called method, already converted to their API types
+        def __init__(self, client_transaction_id, server_transaction_id, client_id, request_type, request_path, method, params, args=None, if_none_match=None):
             self.client_transaction_id = client_transaction_id
             self.server_transaction_id = server_transaction_id
             self.client_id = client_id
@@ -176,27 +426,79 @@ class Alpaca():
             self.request_path = request_path
             self.method = method
             self.params = params
+            self.args = args if args is not None else {}
+            self.if_none_match = if_none_match     # If-None-Match request header, for a conditional GET
+            self.snapshot = None                    # for the bound method: the data snapshot the request is answered from
+
+
+    def ProcessRequest(self, request_type, request_path, request_body, if_none_match=None):
+        # Blocking entry point for server threads; coroutines returned by bound methods run on self.loop
+        t0 = time.perf_counter()
+        response = self.__dispatch_request(request_type, request_path, request_body, if_none_match)
+        if asyncio.iscoroutine(response):
+            assert self.loop is not None, 'bound method returned a coroutine but Alpaca has no event loop'
+            response = asyncio.run_coroutine_threadsafe(response, self.loop).result()
+        self.record_request(request_path, response, t0)
+        return response
+
+    async def ProcessRequestAsync(self, request_type, request_path, request_body, if_none_match=None):
+        # Entry point for servers running on self.loop
+        t0 = time.perf_counter()
+        response = self.__dispatch_request(request_type, request_path, request_body, if_none_match)
+        if asyncio.iscoroutine(response):
+            response = await response
+        self.record_request(request_path, response, t0)
+        return response
 
+    def record_request(self, request_path, response, t0):
+        method = request_path.partition('?')[0].rpartition('/')[2].lower()
+        if method not in self.metric_methods:
+            method = "other"
+        request_latency.observe(time.perf_counter() - t0, method=method)
+        request_count.inc(method=method, code=response[0])
 
-    def ProcessRequest(self, request_type, request_path, request_body):
-        self.server_transaction_count += 1
-        server_transaction_id = self.server_transaction_count-1
+    def count_limit(self, limit, peer=None):
+        # Tally a connection limit firing; the first time each one fires is logged as a warning
+        with self.limit_lock:
+            self.limit_counters[limit] += 1
+            count = self.limit_counters[limit]
+        connection_limit_count.inc(limit=limit)
+        http_log.log(logging.WARNING if count == 1 else logging.DEBUG, 'connection limit "%s" hit (%i times), client %s', limit, count, peer)
         
-        #print('Request body: %s' % str(request_body))
-    
-        # parse url-encoded params:
-        (api, method, params) = self.__parse_request_path(request_path)
-        #print('params:',params)
+    def request_body_error(self, content_length, transfer_encoding=None, peer=None):
+        # None if a request body with these headers can be read, else (http code, message).  
+        # After an error the body is left unread, so the server must close the connection.
+        if transfer_encoding is not None:
+            return (411, 'Chunked request bodies not supported; send Content-Length')
+        if content_length is None:
+            return None
+        if not content_length.strip().isdigit():
+            return (400, 'Invalid Content-Length: %s' % content_length)
+        if int(content_length) > self.max_body_size:
+            self.count_limit("body_too_large", peer)
+            return (413, 'Request body exceeds %i bytes' % self.max_body_size)
+        return None
 
-        # parse body-encoded params:
-        if request_body is not None:
-            for name, val in parse_qs(request_body).items():
-                #val = val if len(val)>1 else val
-                val = val[0] if isinstance(val, list) else val
-                params[name.lower()] = val
+    def encode_response(self, http_return_code, response_content):
+        # Alpaca sends json content for valid responses or string for errors.  Returns (content type, bytes).
+        if isinstance(response_content, bytes):
+            # already encoded (see cached_response)
+            return ('application/json', response_content)
+        elif http_return_code==200:
+            return ('application/json', json.dumps(response_content).encode('utf-8'))
+        else:
+            return ('text/plain', response_content.encode())
 
-        client_id = params['clientid'] if 'clientid' in params else 0
-        client_transaction_id = int(params['clienttransactionid']) if 'clienttransactionid' in params else 0
+    def __dispatch_request(self, request_type, request_path, request_body, if_none_match=None):
+        server_transaction_id = next(self.transaction_ids)
+        
+        (api, method, params) = self.__parse_request(request_path, request_body)
+
+        client_id = params.get('clientid', 0)
+        try:
+            client_transaction_id = int(params.get('clienttransactionid', 0))
+        except ValueError:
+            client_transaction_id = 0
 
         transaction = self.Transaction(
             client_transaction_id = client_transaction_id,
@@ -205,32 +507,24 @@ class Alpaca():
             request_type = request_type,
             request_path = request_path,
             method = method,
-            params = params
+            params = params,
+            if_none_match = if_none_match if request_type == "GET" else None
         )
 
-        #print('Request details: %s' % str((api, method, params)))
-        #print("%s request from client ID %s, client transaction %i
-        
         if api=="management":
             if method == "apiversions":
-                return self.management_response(transaction, [self.api.version])
+                return self.cached_response(transaction, ("management", method), [self.api.version], management=True)
             elif method == "description":
-                return self.management_response(transaction, {
+                return self.cached_response(transaction, ("management", method), {
                     "ServerName": "Kasa Switch Hub",
                     "Manufacturer": "rkinnett",
                     "ManufacturerVersion": "1",
                     "Location": "here"
-                })
+                }, management=True)
                 
             elif method == "configureddevices":
-                return self.management_response(transaction, [
-                    {
-                        "DeviceName": "Kasa Switch Hub",
-                        "DeviceType": "Switch",
-                        "DeviceNumber": 0,
-                        "UniqueID": "1234"
-                    },
-                ])
+                return self.cached_response(transaction, ("management", method), lambda: self.devices, management=True,
+                    version=(self.devices_version,))
             else:
                 return self.invalid_request_response(transaction, 'Unrecognized %s method "%s"' % (request_type, method))
 
@@ -238,49 +532,43 @@ class Alpaca():
         elif api=="device_control":        
             device_type = params["device_type"]
             device_number = params["device_number"]
-            print("%s request from client ID %s, client transaction %i: \n   device type %s, device number %s, method %s, params %s" \
-                % (request_type, client_id, client_transaction_id,  device_type, device_number, method, str(params)))
+            log.debug("%s request from client ID %s, client transaction %i: device type %s, device number %s, method %s", 
+                request_type, client_id, client_transaction_id,  device_type, device_number, method)
+            log.log(TRACE, "request params: %s", params)
                     
-            # Require either GET or PUT method:
-            if request_type not in ("GET", "PUT"):
-                return self.invalid_request_response(transaction, 'Expected GET or PUT type HTTP request, got "%s"' % request_type)
-
-            # Require valid device type, number, and method:
-            if device_type is None or device_number is None or method is None:
-                return self.invalid_request_response(transaction, 'Unsupported path "%s" (expected /api/v1/switch/0/[method]' % request_path)
-            
-            # Require valid (and registered) method:
-            if method is None:
-                return self.invalid_request_response(transaction, 'Invalid method "%s"' % method)
-            
-            if method not in self.methods[request_type]:        
-                return self.invalid_request_response(transaction, 'Unrecognized %s method "%s"' % (request_type, method))
-
-            if self.methods[request_type][method]["action"] is None:
-                return self.invalid_request_response(transaction, 'Unrecognized %s method "%s"' % (request_type, method))
+            # Require a registered method for this request type and device type:
+            route = self.routes.get((request_type, device_type.lower(), method))
+            if route is None or route["action"] is None:
+                return self.invalid_request_response(transaction, 'Unrecognized %s method "%s" for device type "%s"' % (request_type, method, device_type))
 
             # Require required parameters:
-            required_params = self.methods[request_type][method]["required_params"]
-            #print('required_params: %s' % str(required_params))
-            #print('params: %s' % str(params))
-            missing_params = []
-            for required_param in required_params:
-                #print('required param "%s" in params? %s' % (required_param, required_param in params))
-                if required_param not in params:
-                    missing_params.append(required_param)
-            if len(missing_params)>0:
-                print('Missing params: %s' % str(missing_params))
+            missing_params = route["required_set"].difference(params)
+            if missing_params:
+                log.debug('Missing params: %s', sorted(missing_params))
                 http_return_code = self.server.http_return_codes["INVALID_REQUEST"]
-                error_message = 'Error, missing parameter(s): %s' % str(missing_params)
+                error_message = 'Error, missing parameter(s): %s' % str(sorted(missing_params))
                 return (http_return_code, error_message)
 
-            #print("%s request client_id: %s, client transaction ID: %s" % (request_type, client_id, client_transaction_id) )
+            # Convert required parameters to their API types:
+            args = transaction.args
+            for (param_name, coerce) in route["coercers"]:
+                try:
+                    args[param_name] = coerce(params[param_name])
+                except ValueError:
+                    return self.error_response(transaction, self.api.error_codes['INVALID_VALUE'],
+                        'invalid value for parameter "%s": "%s"' % (param_name, params[param_name]))
+            if not 0 <= args["device_number"] < len(self.devices):
+                return self.invalid_request_response(transaction, 'Unrecognized device number %i (configured: 0 to %i)' % (
+                    args["device_number"], len(self.devices) - 1))
 
-            return self.methods[request_type][method]["action"](transaction)
+            return route["action"](transaction)
+        
+        else:
+            return self.invalid_request_response(transaction, 'Unsupported path "%s" (expected /api/v1/switch/0/[method] or /management/...)' % request_path)
         
             
     def noop(self, params):
-        print("Alpaca No op, params: %s" % str(params))
+        log.debug("Alpaca No op, params: %s", params)
         
     
     def nominal_response(self, transaction, value=None):
@@ -292,7 +580,7 @@ class Alpaca():
         }
         if value is not None:
             response.update({"Value":value})
-        print('response: ',response)
+        log.log(TRACE, 'response: %s', response)
         return (self.server.http_return_codes['VALID_REQUEST'], response)
         
     def error_response(self, transaction, error_number, error_message):
@@ -320,31 +608,69 @@ class Alpaca():
             "ServerTransactionID": transaction.server_transaction_id,
         }
         return (self.server.http_return_codes['VALID_REQUEST'], response)
+
+    def cached_response(self, transaction, key, value=None, management=False, version=()):
+        # Nominal (or, with management=True, management) response for a static or slowly-changing value.
+        # Everything after the transaction IDs is JSON-encoded once per key and kept as bytes; each call
+        # only splices in the IDs.  value may be a zero-argument callable, evaluated on a cache miss only.
+        # key is a tuple whose first item is the method name, e.g. ("getswitchname", 3), see invalidate_responses().
+        # version identifies the data value was read from, e.g. (inventory version, state version), and makes
+        # the ETag, so it must change whenever the value for this request may; () for a value fixed for the
+        # life of the server.  The ETag is weak, as the transaction IDs differ.  Callers only get here with
+        # a value clients may cache (e.g. read_state, not for a stale state), so a matching If-None-Match
+        # is answered 304 without looking at the cache.
+        etag = 'W/"%s"' % '.'.join([self.etag_prefix] + [str(part) for part in version])
+        if transaction.if_none_match is not None and etag_matches(transaction.if_none_match, etag):
+            return (304, TaggedResponse(b'', etag))
+        tail = self.response_cache.get(key)
+        if tail is None:
+            if callable(value):
+                value = value()
+            if management:
+                body = {"Value": value}
+            else:
+                body = {"ErrorNumber": 0, "ErrorMessage": ""}
+                if value is not None:
+                    body["Value"] = value
+            tail = json.dumps(body).encode('utf-8')[1:]   # drop the leading "{"
+            self.response_cache[key] = tail
+        return (self.server.http_return_codes['VALID_REQUEST'], TaggedResponse(
+            b'{"ClientTransactionID": %d, "ServerTransactionID": %d, ' % (transaction.client_transaction_id, transaction.server_transaction_id) + tail, etag))
+
+    def invalidate_responses(self, *method_names):
+        # Drop cached responses for the given method names, or all of them if none given.  Handler threads
+        # may add entries meanwhile, so iterate over a copy; the rebuilt dict replaces the old in one assignment.
+        if method_names:
+            self.response_cache = {key: tail for key, tail in list(self.response_cache.items()) if key[0] not in method_names}
+        else:
+            self.response_cache = {}
     
-    def __parse_request_path(self, request_path):
+    def __parse_request(self, request_path, request_body):
+        # Split path and query once; url- and body-encoded params are merged with lower-case names
         (api, method, params) = (None, None, {})
-        #print("Request path: %s" % request_path)
-        path_fields        = request_path.split('/')
-        #print('Path fields: %s' % str(path_fields))
-        if path_fields[1]=="api" and len(path_fields)==6:
+        (path, _, query) = request_path.partition('?')
+        for encoded_params in (query, request_body):
+            if encoded_params:
+                # x-www-form-urlencoded; only pay for unquoting fields that need it
+                for field in encoded_params.split('&'):
+                    (name, _, val) = field.partition('=')
+                    if '%' in val or '+' in val:
+                        val = unquote_plus(val)
+                    if '%' in name or '+' in name:
+                        name = unquote_plus(name)
+                    if name:
+                        params[name.lower()] = val
+        path_fields = path.split('/')
+        if len(path_fields)==6 and path_fields[1]=="api":
             api = "device_control"
             params["device_type"] = path_fields[3]
             params["device_number"] = path_fields[4]
-            method = path_fields[5].split('?')[0]
-            #print('path fields 5: %s' % path_fields[5])
-            #print('? in path fields 5? %s' % str("?" in path_fields[5]))
-            if "?" in path_fields[5]:
-                #print("parse_qs:",  parse_qs(path_fields[5].split('?')[1]))
-                for name, val in parse_qs(path_fields[5].split('?')[1]).items():
-                    val = val[0] if isinstance(val, list) else val
-                    params[name.lower()] = val
-                #params = dict((name.lower(), val) for name, val in parse_qs(path_fields[5].split('?')[1]).items())
-        elif path_fields[1]=="management":
+            method = path_fields[5].lower()
+        elif len(path_fields)>2 and path_fields[1]=="management":
             api = "management"
-            method = path_fields[-1]
+            method = path_fields[-1].lower()
         else:
-            print('Error:  unrecognized request path: %s' % request_path)
-        #print( ("api:",api),("method:",method), ("params:",params))
+            log.debug('unrecognized request path: %s', request_path)
         return (api, method, params)
 
 
@@ -361,63 +687,250 @@ class Alpaca():
             self.parent = parent
             self.server_address = server_address
             self.device_control_port = device_control_port
-            self.server = ThreadingHTTPServer((server_address, device_control_port), self.MakeHandler(self.parent))
+            self.server = self.LimitedHTTPServer((server_address, device_control_port), self.MakeHandler(self.parent), parent)
             self.thread = threading.Thread(target=self.start_serve_forever)
             
+        def connection_counts(self):
+            return {("active",): self.server.active_connections, ("pending",): len(self.server.pending_connections), 
+                ("events",): self.parent.event_connections}
+            
         def start(self):
-            print(f"Starting Alpaca server on {self.server_address}:{self.device_control_port}")
+            http_log.info('Starting Alpaca server on %s:%i', self.server_address, self.device_control_port)
             self.thread.start()
-            print(f'HTTP server listening on port {self.device_control_port}')
+            http_log.info('HTTP server listening on port %i', self.device_control_port)
+            
+        def stop(self):
+            if self.thread.is_alive():
+                self.server.shutdown()      # waits for serve_forever() to return, so only once it has started
+            self.server.server_close()
             
         def start_serve_forever(self):
             try:
                 self.server.serve_forever()
-            except Exception as ex:
-                print("exception", ex)                        
             except (ConnectionResetError, ConnectionAbortedError):
-                print('Connection closed by remote client')
-        
+                http_log.debug('Connection closed by remote client')
+            except Exception as ex:
+                http_log.exception("HTTP server stopped: %s", ex)
+                
+        class LimitedHTTPServer(ThreadingHTTPServer):
+            # At most max_connections handler threads.  Further connections wait in a bounded queue and are
+            # served, in order, by the next thread to finish its connection; when the queue is full the
+            # accept thread answers 503 itself and closes the socket.  A thread waiting on the event feed
+            # hands its slot on (release_slot) and only takes one back if it is free (reclaim_slot).
+            def __init__(self, server_address, handler_class, alpaca):
+                self.alpaca = alpaca
+                self.active_connections = 0
+                self.pending_connections = collections.deque()
+                self.slots_lock = threading.Lock()
+                self.holding = threading.local()    # holding.slot: whether this handler thread has a slot
+                if ':' in server_address[0]:
+                    self.address_family = socket.AF_INET6
+                ThreadingHTTPServer.__init__(self, server_address, handler_class)
+                
+            def server_bind(self):
+                if self.server_address[0] == '::':
+                    # IPv6 wildcard: serve IPv4 clients as well
+                    self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+                ThreadingHTTPServer.server_bind(self)
+                
+            def process_request(self, request, client_address):
+                with self.slots_lock:
+                    if self.active_connections < self.alpaca.max_connections:
+                        self.active_connections += 1
+                        queued = None
+                    else:
+                        queued = len(self.pending_connections) < self.alpaca.max_pending_connections
+                        if queued:
+                            self.pending_connections.append((request, client_address))
+                if queued is not None:
+                    self.alpaca.count_limit("connections_queued" if queued else "connections_rejected", client_address)
+                    if not queued:
+                        self.reject_request(request)
+                    return
+                Thread(target=self.serve_connections, args=(request, client_address), daemon=True).start()
+                
+            def serve_connections(self, request, client_address):
+                self.holding.slot = True
+                while request is not None:
+                    self.process_request_thread(request, client_address)
+                    if not self.holding.slot:
+                        return
+                    with self.slots_lock:
+                        if self.pending_connections:
+                            (request, client_address) = self.pending_connections.popleft()
+                        else:
+                            self.active_connections -= 1
+                            request = None
+                            
+            def release_slot(self):
+                # Hand this thread's slot to the next queued connection, on a new thread, or free it
+                with self.slots_lock:
+                    queued = self.pending_connections.popleft() if self.pending_connections else None
+                    if queued is None:
+                        self.active_connections -= 1
+                self.holding.slot = False
+                if queued is not None:
+                    Thread(target=self.serve_connections, args=queued, daemon=True).start()
+                    
+            def reclaim_slot(self):
+                # Take a slot back if one is free and no connection is queued for it
+                with self.slots_lock:
+                    if self.pending_connections or self.active_connections >= self.alpaca.max_connections:
+                        return False
+                    self.active_connections += 1
+                self.holding.slot = True
+                return True
+                
+            def reject_request(self, request):
+                try:
+                    request.settimeout(1)
+                    request.sendall(self.alpaca.busy_response)
+                except OSError:
+                    pass
+                self.shutdown_request(request)
+                
             
         def MakeHandler(self, alpaca):
             class HttpHandler(BaseHTTPRequestHandler):
                 protocol_version = 'HTTP/1.1'
+                disable_nagle_algorithm = True      # small responses go out immediately, not after a delayed ACK
+                
+                def setup(self):
+                    BaseHTTPRequestHandler.setup(self)
+                    self.rfile.close()
+                    self.reader = DeadlineReader(self.connection, alpaca.read_timeout)
+                    self.rfile = io.BufferedReader(self.reader)
+                    
+                def handle_one_request(self):
+                    # As BaseHTTPRequestHandler.handle_one_request, with separate idle (between requests) and 
+                    # read (within a request: line, headers and body together) deadlines
+                    try:
+                        self.reader.deadline = time.monotonic() + alpaca.idle_timeout
+                        if not self.rfile.peek(1):
+                            self.close_connection = True
+                            return
+                    except socket.timeout:
+                        alpaca.count_limit("idle_timeouts", self.client_address)
+                        self.close_connection = True
+                        return
+                    except (ConnectionResetError, ConnectionAbortedError):
+                        http_log.debug('Connection closed by remote client')
+                        self.close_connection = True
+                        return
+                    try:
+                        self.reader.deadline = time.monotonic() + alpaca.read_timeout
+                        self.raw_requestline = self.rfile.readline(65537)
+                        if len(self.raw_requestline) > 65536:
+                            self.requestline = ''
+                            self.request_version = ''
+                            self.command = ''
+                            self.send_error(HTTPStatus.REQUEST_URI_TOO_LONG)
+                            return
+                        if not self.raw_requestline:
+                            self.close_connection = True
+                            return
+                        if not self.parse_request():
+                            return
+                        if not hasattr(self, 'do_' + self.command):
+                            self.send_error(HTTPStatus.NOT_IMPLEMENTED, "Unsupported method (%r)" % self.command)
+                            return
+                        getattr(self, 'do_' + self.command)()
+                        self.wfile.flush()
+                    except socket.timeout:
+                        alpaca.count_limit("read_timeouts", self.client_address)
+                        self.close_connection = True
                 
                 def do_GET(self):
                     try:
                         self._handle_request("GET")
                     except Exception as ex:
-                        print(ex)
+                        http_log.exception('error handling GET %s: %s', self.path, ex)
 
                 def do_PUT(self):
                     self._handle_request("PUT")
                     
                 def _handle_request(self, http_request_type):
+                    if http_request_type == "GET" and self.path.split('?')[0] in ("/events", "/events/stream"):
+                        return self._handle_events()
+                    if http_request_type == "GET" and self.path.split('?')[0] == "/metrics":
+                        encoded_content = metrics.render()
+                        self._set_headers(200, len(encoded_content), metrics.CONTENT_TYPE)
+                        return self.wfile.write(encoded_content)
+                    body_error = alpaca.request_body_error(
+                        self.headers.get('content-length'), self.headers.get('transfer-encoding'), self.client_address
+                    )
+                    if body_error is not None:
+                        self.close_connection = True
+                        return self._respond(*body_error)
                     try:
                         request_body = self._read_request_body()
+                    except socket.timeout:
+                        raise
                     except Exception as ex:
-                        print('error parsing request body')
-                        print('Request body: "%s"' % request_body)
-                        print(ex)
-                        return
+                        # the body may be partly read, so the connection can't be reused
+                        http_log.warning('error reading request body: %s', ex)
+                        self.close_connection = True
+                        return self._respond(400, 'Unreadable request body')
                     try:
-                        (http_return_code, response_content) = alpaca.ProcessRequest(http_request_type, self.path, request_body)
+                        (http_return_code, response_content) = alpaca.ProcessRequest(http_request_type, self.path, request_body, 
+                            self.headers.get('if-none-match'))
                     except (ConnectionResetError, ConnectionAbortedError):
-                        print('Connection closed by remote client')
+                        http_log.debug('Connection closed by remote client')
                         return
                     except TypeError as er:
-                        print(er)
-                        print('No response to send; skipping.')
+                        http_log.warning('No response to send; skipping. (%s)', er)
                         return
                     try:
                         self._respond(http_return_code, response_content)
                     except (ConnectionResetError, ConnectionAbortedError):
-                        print('Connection closed by remote client')
+                        http_log.debug('Connection closed by remote client')
                     except TypeError:
-                        print('TypeError; ProcessRequest result: %s' % str((http_return_code, response_content)))
+                        http_log.warning('TypeError; ProcessRequest result: %s', (http_return_code, response_content))
+                        
+                def _handle_events(self):
+                    # Change notifications: long-poll (/events) or Server-Sent Events (/events/stream)
+                    try:
+                        (stream, since, timeout) = alpaca.parse_events_request(self.path, self.headers.get('last-event-id'))
+                    except ValueError:
+                        return self._respond(400, 'Invalid since/timeout parameter')
+                    if not alpaca.enter_event_feed(self.client_address):
+                        self.close_connection = True
+                        return self._respond(503, 'Too many event-feed connections')
+                    # wait without holding a connection slot; afterwards keep the connection only if one is free
+                    self.server.release_slot()
+                    try:
+                        if not stream:
+                            (version, events) = alpaca.events.wait(since, timeout)
+                            if not self.server.reclaim_slot():
+                                self.close_connection = True
+                            return self._respond(200, {"Version": version, "Events": events})
+                        self._stream_events(since)
+                    finally:
+                        alpaca.leave_event_feed()
+                        
+                def _stream_events(self, since):
+                    # SSE: no Content-Length, the stream ends when either side closes the connection
+                    self.close_connection = True
+                    try:
+                        self.send_response(200)
+                        self.send_header('Content-type', 'text/event-stream')
+                        self.send_header('Cache-Control', 'no-cache')
+                        self.send_header('Connection', 'close')
+                        self.end_headers()
+                        while True:
+                            (version, events) = alpaca.events.wait(since, 15)
+                            if not events:
+                                self.wfile.write(b': keepalive\n\n')
+                            for event in events:
+                                self.wfile.write(alpaca.encode_sse_event(event))
+                            self.wfile.flush()
+                            since = version
+                    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                        http_log.debug('Event stream closed by remote client')
                         
                 def _process_request_headers(self):
                     try:
-                        print('\r\n=========== new request received ===========')
+                        http_log.log(TRACE, '=========== new request received ===========')
                         #print('Headers:')
                         #print(self.headers)
                         #print('CONTENT-LENGTH: %s' % str(self.headers.get('content-length')))
@@ -429,93 +942,417 @@ class Alpaca():
                         content_length = int(content_length) if content_length else None
                         return (content_type, content_length, content_encoding)
                     except (ConnectionResetError, ConnectionAbortedError):
-                        print("Connection reset!")
+                        http_log.debug("Connection reset!")
                     except Exception as ex:
-                        print('error:')
-                        print(ex)
+                        http_log.warning('error reading request headers: %s', ex)
                         return                        
                     
                 def _read_request_body(self):
                     # Unique to this application (Alpaca), requests should be x-www-form-urlencoded, in which case content is in path.
+                    # Content-Length has been checked by alpaca.request_body_error; read errors propagate to the caller.
                     (request_content_type, request_content_length, request_content_encoding) = self._process_request_headers()
-                    if request_content_length is not None:
-                        try:
-                            request_content = self.rfile.read(request_content_length).decode('utf-8')
-                        except (ConnectionResetError, ConnectionAbortedError):
-                            print('Connection closed by remote client')
-                        except Exception as ex:
-                            print('error:')
-                            print(ex)
-                            return                              
-                    else:
-                        request_content = None
-                    return request_content
+                    if request_content_length is None:
+                        return None
+                    request_content = self.rfile.read(request_content_length)
+                    if len(request_content) < request_content_length:
+                        raise ConnectionAbortedError('request body truncated')
+                    return request_content.decode('utf-8')
                     
                 def _respond(self, http_return_code, response_content):
                     # Note: this is application-specific. Alpaca sends json content for valid responses or string for errors
-                    print('Response http code: %i, content: "%s"' % (http_return_code, response_content))
-                    if http_return_code==200:
-                        encoded_content = json.dumps(response_content).encode('utf-8')
-                    else:
-                        encoded_content = response_content.encode()
+                    http_log.log(TRACE, 'Response http code: %i, content: "%s"', http_return_code, response_content)
+                    (content_type, encoded_content) = alpaca.encode_response(http_return_code, response_content)
                     content_length = len(encoded_content)
                     try:
-                        self._set_headers(http_return_code, content_length)
+                        self._set_headers(http_return_code, content_length, content_type, getattr(response_content, 'etag', None))
                         #print('Sending response...')
                         self.wfile.write(encoded_content)
                         #print('Sent response ')
-                    except Exception as ex:
-                        print("exception", ex)                        
                     except (ConnectionResetError, ConnectionAbortedError):
-                        print('Connection closed by remote client')
+                        http_log.debug('Connection closed by remote client')
+                    except Exception as ex:
+                        http_log.warning("error sending response: %s", ex)
                     
                     
-                def _set_headers(self, http_return_code=200, content_length=0):
-                    if http_return_code==200:
-                        content_type='application/json'
-                    else:
-                        content_type='text/plain'            
+                def _set_headers(self, http_return_code=200, content_length=0, content_type='application/json', etag=None):
                     #print('Sending headers...')
                     try:
                         self.send_response(http_return_code)
-                        self.send_header('Content-type', content_type)
-                        self.send_header('Content-Length', str(content_length))
+                        if etag is not None:
+                            self.send_header('ETag', etag)
+                        if http_return_code != 304:
+                            self.send_header('Content-type', content_type)
+                            self.send_header('Content-Length', str(content_length))
+                        if self.close_connection:
+                            self.send_header('Connection', 'close')
                         self.end_headers()   
                         #print('Sent headers')
                     except Exception as ex:
-                        print("exception", ex)                          
+                        http_log.warning("error sending headers: %s", ex)
+                        
+                def log_message(self, format, *args):
+                    # BaseHTTPRequestHandler writes an access line per request to stderr; route it to the http logger
+                    if http_log.isEnabledFor(logging.DEBUG):
+                        http_log.debug('%s - %s', self.address_string(), format % args)
             
             return HttpHandler
 
 
-    class DiscoveryResponder(Thread):
-        def __init__(self, address, discovery_port, control_port):
+    class AsyncAlpacaHttpServer():
+        # HTTP/1.1 server on asyncio streams, running on the Alpaca event loop: one task per connection
+        # and no threads.  Requests on a connection are answered in order, so keep-alive and pipelined
+        # clients are both served; idle connections cost a socket and a suspended task.
+        http_return_codes = {
+            "VALID_REQUEST":   200,
+            "INVALID_REQUEST": 400,
+            "DEVICE_ERROR":    500
+        }    
+        
+        def __init__(self, parent, server_address, device_control_port):
+            self.parent = parent
+            self.server_address = server_address
+            self.device_control_port = device_control_port
+            self.server = None
+            self.active_connections = 0
+            self.connection_slots = collections.deque()     # futures of connections waiting for a slot
+            self.slotless = set()                           # writers of connections that gave up their slot for the event feed
+            
+        def connection_counts(self):
+            return {("active",): self.active_connections, ("pending",): len(self.connection_slots), 
+                ("events",): self.parent.event_connections}
+            
+        def start(self):
+            http_log.info('Starting asyncio Alpaca server on %s:%i', self.server_address, self.device_control_port)
+            if self.server_address == '::':
+                # IPv6 wildcard: serve IPv4 clients as well (asyncio would bind IPv6 only)
+                listen = {"sock": socket.create_server(('::', self.device_control_port), family=socket.AF_INET6, 
+                    dualstack_ipv6=socket.has_dualstack_ipv6())}
+            else:
+                listen = {"host": self.server_address, "port": self.device_control_port}
+            self.server = asyncio.run_coroutine_threadsafe(
+                asyncio.start_server(self.handle_connection, **listen), 
+                self.parent.loop
+            ).result()
+            http_log.info('HTTP server listening on port %i', self.device_control_port)
+            
+        def stop(self):
+            if self.server is not None:
+                self.parent.loop.call_soon_threadsafe(self.server.close)
+            
+        async def handle_connection(self, reader, writer):
+            # At most max_connections are served at once; further connections wait, in order, for a slot,
+            # and once max_pending_connections are waiting new ones are answered 503 and closed.
+            peer = writer.get_extra_info('peername')
+            alpaca = self.parent
+            if self.active_connections < alpaca.max_connections:
+                self.active_connections += 1
+            elif len(self.connection_slots) < alpaca.max_pending_connections:
+                alpaca.count_limit("connections_queued", peer)
+                slot = asyncio.get_running_loop().create_future()
+                self.connection_slots.append(slot)
+                try:
+                    await slot
+                except asyncio.CancelledError:
+                    self.connection_slots.remove(slot)
+                    writer.close()
+                    raise
+            else:
+                alpaca.count_limit("connections_rejected", peer)
+                writer.write(alpaca.busy_response)
+                writer.close()
+                return
+            try:
+                await self.serve_connection(reader, writer, peer)
+            finally:
+                writer.close()
+                if writer in self.slotless:
+                    self.slotless.discard(writer)
+                else:
+                    self.release_slot()
+                    
+        def release_slot(self):
+            if self.connection_slots:
+                self.connection_slots.popleft().set_result(None)    # hand this slot straight on
+            else:
+                self.active_connections -= 1
+                
+        def reclaim_slot(self):
+            # Take a slot back if one is free and no connection is waiting for it
+            if self.connection_slots or self.active_connections >= self.parent.max_connections:
+                return False
+            self.active_connections += 1
+            return True
+                
+        async def serve_connection(self, reader, writer, peer):
+            alpaca = self.parent
+            try:
+                while True:
+                    try:
+                        request_line = await asyncio.wait_for(reader.readline(), alpaca.idle_timeout)
+                    except asyncio.TimeoutError:
+                        alpaca.count_limit("idle_timeouts", peer)
+                        break
+                    if not request_line:
+                        break
+                    request_line = request_line.decode('latin-1').rstrip('\r\n')
+                    if not request_line:
+                        continue    # tolerate blank lines between requests
+                    try:
+                        (http_request_type, request_path, http_version) = request_line.split(' ', 2)
+                    except ValueError:
+                        self.write_response(writer, 400, 'Malformed request line', False)
+                        break
+                    try:
+                        headers = await asyncio.wait_for(self.read_headers(reader), alpaca.read_timeout)
+                    except asyncio.TimeoutError:
+                        alpaca.count_limit("read_timeouts", peer)
+                        break
+                    if headers is None:
+                        alpaca.count_limit("too_many_headers", peer)
+                        self.write_response(writer, 431, 'More than %i header lines' % alpaca.max_header_lines, False)
+                        break
+                    connection = headers.get('connection', '').lower()
+                    if http_version == 'HTTP/1.1':
+                        keep_alive = connection != 'close'
+                    else:
+                        keep_alive = connection == 'keep-alive'
+                        
+                    body_error = alpaca.request_body_error(headers.get('content-length'), headers.get('transfer-encoding'), peer)
+                    if body_error is not None:
+                        # the body is left unread, so the connection can't be reused
+                        self.write_response(writer, *body_error, False)
+                        break
+                    request_body = None
+                    if 'content-length' in headers:
+                        if http_version == 'HTTP/1.1' and headers.get('expect', '').lower() == '100-continue':
+                            # as BaseHTTPRequestHandler does: clients sending this wait for it before the body
+                            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                        try:
+                            request_body = await asyncio.wait_for(reader.readexactly(int(headers['content-length'])), alpaca.read_timeout)
+                        except asyncio.TimeoutError:
+                            alpaca.count_limit("read_timeouts", peer)
+                            break
+                        try:
+                            request_body = request_body.decode('utf-8')
+                        except UnicodeDecodeError:
+                            self.write_response(writer, 400, 'Unreadable request body', keep_alive)
+                            await writer.drain()
+                            continue
+                    http_log.log(TRACE, '%s %s %s from %s', http_request_type, request_path, http_version, peer)
+                    
+                    if http_request_type == "GET" and request_path.split('?')[0] in ("/events", "/events/stream"):
+                        keep_alive = await self.handle_events(writer, request_path, headers, keep_alive, peer)
+                    elif http_request_type == "GET" and request_path.split('?')[0] == "/metrics":
+                        self.write_encoded_response(writer, 200, metrics.CONTENT_TYPE, metrics.render(), keep_alive)
+                    elif http_request_type not in ("GET", "PUT"):
+                        self.write_response(writer, 400, 'Expected GET or PUT type HTTP request, got "%s"' % http_request_type, keep_alive)
+                    else:
+                        try:
+                            (http_return_code, response_content) = await alpaca.ProcessRequestAsync(http_request_type, request_path, request_body, 
+                                headers.get('if-none-match'))
+                        except Exception as ex:
+                            http_log.exception('error handling %s %s: %s', http_request_type, request_path, ex)
+                            (http_return_code, response_content) = (500, 'Internal server error')
+                        self.write_response(writer, http_return_code, response_content, keep_alive)
+                    # a client that stops reading its responses stalls here rather than growing the write buffer
+                    try:
+                        await asyncio.wait_for(writer.drain(), alpaca.read_timeout)
+                    except asyncio.TimeoutError:
+                        alpaca.count_limit("write_timeouts", peer)
+                        break
+                    if not keep_alive:
+                        break
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, asyncio.IncompleteReadError):
+                http_log.debug('Connection closed by remote client %s', peer)
+            except Exception as ex:
+                http_log.warning('error on connection from %s: %s', peer, ex)
+                
+        async def read_headers(self, reader):
+            # Header lines up to the blank line, as a dict keyed by lower-case name; None if there are too many
+            headers = {}
+            for _ in range(self.parent.max_header_lines + 1):
+                header_line = await reader.readline()
+                if header_line in (b'\r\n', b'\n', b''):
+                    return headers
+                (name, _, value) = header_line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            return None
+                
+        def write_response(self, writer, http_return_code, response_content, keep_alive):
+            http_log.log(TRACE, 'Response http code: %i, content: "%s"', http_return_code, response_content)
+            (content_type, encoded_content) = self.parent.encode_response(http_return_code, response_content)
+            self.write_encoded_response(writer, http_return_code, content_type, encoded_content, keep_alive, getattr(response_content, 'etag', None))
+            
+        def write_encoded_response(self, writer, http_return_code, content_type, encoded_content, keep_alive, etag=None):
+            connection = b'' if keep_alive else b'Connection: close\r\n'
+            if etag is not None:
+                connection = b'ETag: %s\r\n' % etag.encode() + connection
+            if http_return_code == 304:
+                writer.write(b'HTTP/1.1 304 Not Modified\r\n%s\r\n' % connection)
+                return
+            writer.write(b'HTTP/1.1 %d %s\r\nContent-type: %s\r\nContent-Length: %d\r\n%s\r\n' % (
+                http_return_code, HTTPStatus(http_return_code).phrase.encode(), content_type.encode(), 
+                len(encoded_content), connection
+            ) + encoded_content)
+            
+        async def handle_events(self, writer, request_path, headers, keep_alive, peer=None):
+            # Long-poll (/events) or Server-Sent Events (/events/stream); returns whether to keep the connection.
+            # The connection's slot is handed on while it waits, and kept afterwards only if one is free.
+            try:
+                (stream, since, timeout) = self.parent.parse_events_request(request_path, headers.get('last-event-id'))
+            except ValueError:
+                self.write_response(writer, 400, 'Invalid since/timeout parameter', keep_alive)
+                return keep_alive
+            if not self.parent.enter_event_feed(peer):
+                self.write_response(writer, 503, 'Too many event-feed connections', False)
+                return False
+            self.release_slot()
+            self.slotless.add(writer)
+            try:
+                if not stream:
+                    (version, events) = await self.parent.events.wait_async(since, timeout)
+                    if keep_alive and self.reclaim_slot():
+                        self.slotless.discard(writer)
+                    else:
+                        keep_alive = False
+                    self.write_response(writer, 200, {"Version": version, "Events": events}, keep_alive)
+                    return keep_alive
+                await self.stream_events(writer, since)
+            finally:
+                self.parent.leave_event_feed()
+                
+        async def stream_events(self, writer, since):
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+            while True:
+                (version, events) = await self.parent.events.wait_async(since, 15)
+                if not events:
+                    writer.write(b': keepalive\n\n')
+                for event in events:
+                    writer.write(self.parent.encode_sse_event(event))
+                await writer.drain()
+                since = version
+
+
+    class DiscoveryResponder():
+        # Alpaca discovery on the Alpaca event loop: answers "alpacadiscovery1" datagrams sent to the IPv4
+        # broadcast address and, when the HTTP server listens on IPv6, to the IPv6 Alpaca multicast group,
+        # with the pre-encoded HTTP port.  Replies are rate-limited per source address and overall, so a burst
+        # of clients starting at once, or one flooding client, costs a dictionary lookup per datagram and
+        # no logging.  Dropped requests are counted in alpaca_discovery_requests_total.
+        multicast_group_v6 = "ff12::a1:9aca"
+        min_reply_interval = 1.0        # seconds between replies to one source address
+        max_replies_per_second = 100    # replies to all sources together
+        max_tracked_sources = 4096      # source addresses remembered for min_reply_interval
+        
+        def __init__(self, address, discovery_port, control_port, loop):
+            self.address = address
             self.discovery_port = discovery_port
             self.control_port = control_port
-            Thread.__init__(self)
-            self.device_address = (address, discovery_port) #listen for any IP on Alpaca disc. port
-            self.alpaca_response  = "{\"alpacaport\": " + str(control_port) + "}"
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  #share address
+            self.loop = loop
+            self.reply = b'{"alpacaport": %d}' % control_port
+            self.last_reply = {}        # source address: time.monotonic() of the last reply to it
+            self.window_start = 0
+            self.window_replies = 0
+            self.transports = []
+            
+        def start(self):
+            sockets = self.open_sockets()
+            for sock in sockets:
+                (transport, protocol) = asyncio.run_coroutine_threadsafe(
+                    self.loop.create_datagram_endpoint(lambda: self.Protocol(self), sock=sock), self.loop).result()
+                self.transports.append(transport)
+            log.info('Starting Alpaca discovery responder on port %i (%s)', self.discovery_port, 
+                ', '.join('IPv6 multicast' if sock.family == socket.AF_INET6 else 'IPv4' for sock in sockets))
+                
+        def stop(self):
+            for transport in self.transports:
+                self.loop.call_soon_threadsafe(transport.close)
+            
+        def open_sockets(self):
+            # An IPv4 socket unless the server is bound to a specific IPv6 address, and an IPv6 one joined to
+            # the multicast group on every interface if it listens on IPv6 at all
+            sockets = []
+            try:
+                if ':' not in self.address or self.address == '::':
+                    sockets.append(self.bind_socket(socket.AF_INET, '0.0.0.0' if self.address == '::' else self.address))
+                if ':' in self.address:
+                    sock = self.bind_socket(socket.AF_INET6, '::')
+                    sockets.append(sock)
+                    self.join_multicast_group(sock)
+            except OSError:
+                log.error('Discovery responder failed to bind')
+                for sock in sockets:
+                    sock.close()
+                raise
+            return sockets
+            
+        def bind_socket(self, family, address):
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  #share address
             if os.name != 'nt':
                 # needed on Linux and OSX to share port with net core. Remove on windows
-                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.setblocking(False)
             try:
-                self.sock.bind(self.device_address)
-            except:
-                print('Discovery responder failed to bind')
-                self.sock.close()
-                self.sock = 0
+                sock.bind((address, self.discovery_port))
+            except OSError:
+                sock.close()
                 raise
-            # OK start the listener
-            self.daemon = True
-            print('Starting Alpaca discovery responder on port %i' % discovery_port)
-            self.start()
-        def run(self):
-            while True:
-                data, addr = self.sock.recvfrom(1024)
-                datascii = str(data, 'ascii')
-                print('Alpaca discovery responder received ' + datascii + ' from ' + str(addr))
-                if 'alpacadiscovery1' in datascii:
-                    print('informing client at %s that ASCOM-Remote server is operating on port %i' % (str(addr),  self.control_port))
-                    self.sock.sendto(self.alpaca_response.encode(), addr)
\ No newline at end of file
+            return sock
+            
+        def join_multicast_group(self, sock):
+            group = socket.inet_pton(socket.AF_INET6, self.multicast_group_v6)
+            joined = 0
+            for (interface_index, interface_name) in socket.if_nameindex():
+                try:
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, group + struct.pack('@I', interface_index))
+                    joined += 1
+                except OSError as error:
+                    log.debug('not listening for IPv6 discovery on %s: %s', interface_name, error)
+            if not joined:
+                # let the system pick the interface
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, group + struct.pack('@I', 0))
+                
+        def should_answer(self, data, addr):
+            # Loop thread only, so no locking
+            if b'alpacadiscovery1' not in data:
+                discovery_request_count.inc(result="ignored")
+                return False
+            now = time.monotonic()
+            host = addr[0]
+            last = self.last_reply.get(host)
+            if last is not None and now - last < self.min_reply_interval:
+                discovery_request_count.inc(result="rate_limited")
+                return False
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_replies = 0
+            if self.window_replies >= self.max_replies_per_second:
+                discovery_request_count.inc(result="rate_limited")
+                return False
+            if len(self.last_reply) >= self.max_tracked_sources:
+                # forget sources whose interval is over; at most max_replies_per_second * min_reply_interval aren't
+                self.last_reply = {source: then for source, then in self.last_reply.items() if now - then < self.min_reply_interval}
+            self.last_reply[host] = now
+            self.window_replies += 1
+            discovery_request_count.inc(result="answered")
+            log.debug('informing client at %s that ASCOM-Remote server is operating on port %i', host, self.control_port)
+            return True
+            
+        class Protocol(asyncio.DatagramProtocol):
+            def __init__(self, responder):
+                self.responder = responder
+                self.transport = None
+                
+            def connection_made(self, transport):
+                self.transport = transport
+                
+            def datagram_received(self, data, addr):
+                log.log(TRACE, 'Alpaca discovery responder received %r from %s', data[:64], addr[0])
+                if self.responder.should_answer(data, addr):
+                    self.transport.sendto(self.responder.reply, addr)
+                    
+            def error_received(self, error):
+                log.debug('discovery responder: %s', error)
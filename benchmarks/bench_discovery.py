@@ -0,0 +1,117 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Alpaca discovery responder flood benchmark
+
+Runs the daemon's discovery responder (alpaca.Alpaca.DiscoveryResponder) on
+its own event loop thread, floods it with "alpacadiscovery1" datagrams from a
+separate process sending from several loopback source addresses, and reports
+how many were answered or dropped, the responder process's CPU time, and how
+long a well-behaved client from a fresh address waits for its reply during the
+flood.  Needs no plugs or python-kasa devices (Linux: sources bind 127.0.0.x).
+
+    python3 benchmarks/bench_discovery.py [--sources N] [--duration S] [--json results.json]
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from alpaca import Alpaca, discovery_request_count
+
+
+def flood(port, sources, duration, sent_count, reply_count):
+    # Send discovery datagrams from each source address in turn, as fast as possible, until duration is up
+    sockets = []
+    for source in range(sources):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.1.%i' % (source + 1), 0))
+        sock.setblocking(False)
+        sockets.append(sock)
+    (sent, replies) = (0, 0)
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for sock in sockets:
+            try:
+                sock.sendto(b'alpacadiscovery1', ('127.0.0.1', port))
+                sent += 1
+            except BlockingIOError:
+                pass
+            try:
+                while sock.recv(64):
+                    replies += 1
+            except BlockingIOError:
+                pass
+    sent_count.value = sent
+    reply_count.value = replies
+
+
+def discover(port, source, timeout=2):
+    # Seconds a client at source waits for the reply to one discovery datagram, or None if it gets none
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((source, 0))
+        sock.settimeout(timeout)
+        t0 = time.perf_counter()
+        sock.sendto(b'alpacadiscovery1', ('127.0.0.1', port))
+        try:
+            sock.recv(64)
+        except socket.timeout:
+            return None
+        return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flood the Alpaca discovery responder and measure its cost")
+    parser.add_argument("--sources", type=int, default=8, help="flooding source addresses")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="seconds of flooding")
+    parser.add_argument("--port", type=int, default=32327, help="discovery port to run the responder on")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    responder = Alpaca.DiscoveryResponder('0.0.0.0', args.port, 8000, loop)
+    responder.start()
+
+    sent_count = multiprocessing.Value('q', 0)
+    reply_count = multiprocessing.Value('q', 0)
+    flooder = multiprocessing.Process(target=flood, args=(args.port, args.sources, args.duration, sent_count, reply_count))
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    flooder.start()
+    waits = []
+    for probe in range(int(args.duration / 0.5)):
+        time.sleep(0.5)
+        waits.append(discover(args.port, '127.0.2.%i' % (probe + 1)))
+    flooder.join()
+    cpu_seconds = time.process_time() - cpu0
+    elapsed = time.perf_counter() - t0
+
+    outcomes = {labels[0]: value for labels, value in discovery_request_count.samples()}
+    answered_waits = sorted(wait for wait in waits if wait is not None)
+    results = {
+        "sent": sent_count.value,
+        "replies_to_flood": reply_count.value,
+        "outcomes": outcomes,
+        "cpu_seconds": cpu_seconds,
+        "cpu_percent": 100 * cpu_seconds / elapsed,
+        "probes": len(waits),
+        "probes_answered": len(answered_waits),
+        "probe_max_ms": 1000 * answered_waits[-1] if answered_waits else None,
+    }
+    print('%i datagrams from %i sources in %.0f s: %i answered, %i rate limited; responder CPU %.2f s (%.0f%%)' % (
+        results["sent"], args.sources, args.duration, outcomes.get("answered", 0), outcomes.get("rate_limited", 0),
+        cpu_seconds, results["cpu_percent"]))
+    print('new clients during the flood: %i of %i answered, slowest %s' % (len(answered_waits), len(waits),
+        'n/a' if not answered_waits else '%.1f ms' % results["probe_max_ms"]))
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump({"arguments": vars(args), "results": results}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+End-to-end load and latency benchmark
+
+Starts the kasa simulator (kasa_simulator.py) and the daemon in-process, the
+daemon discovering the simulated devices over loopback, then drives the Alpaca
+HTTP endpoints from keep-alive client threads and reports throughput and
+p50/p95/p99 latency per endpoint.  Needs python-kasa but no network or plugs
+(Linux: the simulated devices bind 127.0.0.x addresses).
+
+    python3 benchmarks/bench_load.py [--concurrency N] [--duration S] [--mix getswitchvalue=70,setswitchvalue=10,...]
+                                     [--server threaded|asyncio] [--json results.json] [simulator options]
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from alpaca import Alpaca
+from logger import setup_logging
+import kasa_simulator
+
+
+DEFAULT_MIX = "getswitchvalue=60,getswitch=10,setswitchvalue=10,maxswitch=10,management=10"
+
+
+def make_request(endpoint, num_switches, rng, transaction_id):
+    # (method, path, body) for one request to the named endpoint
+    ids = 'ClientID=1&ClientTransactionID=%i' % transaction_id
+    if endpoint in ("getswitchvalue", "getswitch", "getswitchname"):
+        return ("GET", '/api/v1/switch/0/%s?Id=%i&%s' % (endpoint, rng.randrange(num_switches), ids), None)
+    if endpoint == "setswitchvalue":
+        return ("PUT", '/api/v1/switch/0/setswitchvalue', 'Id=%i&Value=%i&%s' % (rng.randrange(num_switches), rng.randrange(2), ids))
+    if endpoint == "maxswitch":
+        return ("GET", '/api/v1/switch/0/maxswitch?%s' % ids, None)
+    if endpoint == "management":
+        return ("GET", '/management/v1/configureddevices?%s' % ids, None)
+    raise ValueError('unknown endpoint "%s"' % endpoint)
+
+
+def parse_mix(mix):
+    weights = {}
+    for field in mix.split(','):
+        (endpoint, _, weight) = field.partition('=')
+        weights[endpoint.strip()] = float(weight or 1)
+    return weights
+
+
+def client(port, weights, num_switches, deadline, record_after, results, seed):
+    # One keep-alive connection issuing requests back to back; appends (endpoint, seconds, ok) to results
+    rng = random.Random(seed)
+    endpoints = list(weights)
+    cumulative_weights = list(itertools.accumulate(weights.values()))
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    transaction_ids = itertools.count(1)
+    while time.perf_counter() < deadline:
+        endpoint = rng.choices(endpoints, cum_weights=cumulative_weights)[0]
+        (method, path, body) = make_request(endpoint, num_switches, rng, next(transaction_ids))
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+        t0 = time.perf_counter()
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            content = response.read()
+            ok = response.status == 200 and json.loads(content).get("ErrorNumber", 0) == 0
+        except (OSError, http.client.HTTPException, ValueError):
+            ok = False
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        if t0 >= record_after:
+            results.append((endpoint, time.perf_counter() - t0, ok))
+    connection.close()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(results, duration):
+    summary = {}
+    by_endpoint = {}
+    for endpoint, seconds, ok in results:
+        by_endpoint.setdefault(endpoint, []).append((seconds, ok))
+    by_endpoint["all"] = [(seconds, ok) for endpoint, seconds, ok in results]
+    for endpoint, samples in by_endpoint.items():
+        latencies = sorted(seconds for seconds, ok in samples)
+        if not latencies:
+            continue
+        summary[endpoint] = {
+            "requests": len(samples),
+            "errors": sum(not ok for seconds, ok in samples),
+            "requests_per_s": len(samples) / duration,
+            "p50_ms": 1000 * percentile(latencies, 0.50),
+            "p95_ms": 1000 * percentile(latencies, 0.95),
+            "p99_ms": 1000 * percentile(latencies, 0.99),
+            "max_ms": 1000 * latencies[-1],
+        }
+    return summary
+
+
+def start_daemon(args, discovery_target):
+    # The same wiring as start_server.main(), minus the console banner, on a loopback port
+    from start_server import DeviceIOLoop, SwitchManager
+    io_loop = DeviceIOLoop()
+    io_loop.start()
+    alpaca = Alpaca(device_type="Switch", server_address="127.0.0.1", control_port=args.port, discovery_port=0,
+        loop=io_loop.loop, server_mode=args.server)
+    switch_manager = SwitchManager(alpaca, io_loop)
+    switch_manager.discovery_target = discovery_target
+    switch_manager.discovery_timeout = 1
+    switch_manager.power_channels = False       # the load mix writes to any switch number
+    io_loop.run(switch_manager.discover())
+    alpaca.bindMethods(switch_manager.alpaca_methods)
+    alpaca.start()
+    switch_manager.start_discovery_loop()
+    switch_manager.start_state_check_loop()
+    return (alpaca, switch_manager)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Alpaca end-to-end load test against simulated kasa devices")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="client connections issuing requests back to back")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of unmeasured load first")
+    parser.add_argument("--mix", type=str, default=DEFAULT_MIX, help="endpoint=weight list (getswitchvalue, getswitch, setswitchvalue, maxswitch, management)")
+    parser.add_argument("--server", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("-p", "--port", type=int, default=18000)
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show daemon log output (warnings and up are always shown)")
+    kasa_simulator.add_simulator_arguments(parser)
+    args = parser.parse_args()
+    setup_logging(logging.INFO if args.verbose else logging.WARNING)
+
+    simulator = kasa_simulator.make_simulator(args)
+    simulator.start()
+    (alpaca, switch_manager) = start_daemon(args, kasa_simulator.DISCOVERY_ADDRESS)
+    num_switches = switch_manager.num_switches
+    expected_switches = sum(len(device.outlets) or 1 for device in simulator.devices)
+    assert num_switches == expected_switches, 'discovered %i of %i simulated switches' % (num_switches, expected_switches)
+
+    connection = http.client.HTTPConnection('127.0.0.1', args.port)
+    connection.request("PUT", '/api/v1/switch/0/connected', 'Connected=true&ClientID=1&ClientTransactionID=0',
+        {'Content-Type': 'application/x-www-form-urlencoded'})
+    connection.getresponse().read()
+    connection.close()
+
+    weights = parse_mix(args.mix)
+    results = []
+    record_after = time.perf_counter() + args.warmup
+    deadline = record_after + args.duration
+    threads = [threading.Thread(target=client, args=(args.port, weights, num_switches, deadline, record_after, results, seed))
+        for seed in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    simulator.stop()
+
+    summary = summarize(results, args.duration)
+    print('%i simulated devices (latency %.1f ms + up to %.1f ms jitter, %.0f%% failures), %s server, %i connections, %.0f s' % (
+        len(simulator.devices), 1000 * args.latency, 1000 * args.jitter, 100 * args.failure_rate, args.server, args.concurrency, args.duration))
+    print('%-16s %9s %8s %10s %9s %9s %9s %9s' % ("endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for endpoint in sorted(summary, key=lambda endpoint: (endpoint == "all", endpoint)):
+        row = summary[endpoint]
+        print('%-16s %9i %8i %10.0f %9.2f %9.2f %9.2f %9.2f' % (endpoint, row["requests"], row["errors"], row["requests_per_s"],
+            row["p50_ms"], row["p95_ms"], row["p99_ms"], row["max_ms"]))
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump({"arguments": vars(args), "results": summary}, json_file, indent=2)
+    os._exit(0)     # the daemon's server and device threads don't stop on their own
+
+
+if __name__ == "__main__":
+    main()
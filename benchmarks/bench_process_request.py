@@ -0,0 +1,67 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Microbenchmark: requests/second through Alpaca.ProcessRequest
+
+Measures routing, parameter parsing and validation overhead only; every
+API method is bound to a trivial handler, no sockets or devices involved.
+
+    python3 benchmarks/bench_process_request.py [-n requests] [--keep-output]
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from alpaca import Alpaca
+
+
+REQUESTS = [
+    ("GET", "/api/v1/switch/0/getswitchvalue?Id=3&ClientID=1&ClientTransactionID=17", None),
+    ("GET", "/api/v1/switch/0/getswitch?Id=3&ClientID=1&ClientTransactionID=18", None),
+    ("GET", "/api/v1/switch/0/getswitchname?Id=1&ClientID=1&ClientTransactionID=19", None),
+    ("GET", "/api/v1/switch/0/maxswitch?ClientID=1&ClientTransactionID=20", None),
+    ("GET", "/api/v1/switch/0/connected?ClientID=1&ClientTransactionID=21", None),
+    ("PUT", "/api/v1/switch/0/setswitchvalue", "Id=2&Value=1&ClientID=1&ClientTransactionID=22"),
+    ("GET", "/management/v1/configureddevices?ClientID=1&ClientTransactionID=23", None),
+]
+
+
+def make_alpaca():
+    alpaca = Alpaca(device_type="Switch", server_address="127.0.0.1", control_port=0)
+    def handler(transaction):
+        return alpaca.nominal_response(transaction, value=1)
+    alpaca.bindMethods([[method_type, method_name, handler]
+        for method_type in ("GET", "PUT") for method_name in alpaca.methods[method_type]])
+    return alpaca
+
+
+def run(alpaca, num_requests):
+    requests = (REQUESTS * (num_requests // len(REQUESTS) + 1))[:num_requests]
+    t0 = time.perf_counter()
+    for request_type, request_path, request_body in requests:
+        alpaca.ProcessRequest(request_type, request_path, request_body)
+    return num_requests / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Alpaca.ProcessRequest throughput")
+    parser.add_argument("-n", "--requests", type=int, default=50000)
+    parser.add_argument("--keep-output", action="store_true", help="don't discard console output produced by the request path")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        alpaca = make_alpaca()
+    rates = []
+    for trial in range(3):
+        if args.keep_output:
+            rates.append(run(alpaca, args.requests))
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                rates.append(run(alpaca, args.requests))
+    print('ProcessRequest: %.0f requests/s (best of 3, %i requests each)' % (max(rates), args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Start-up benchmark: time to first valid response
+
+Starts the kasa simulator (kasa_simulator.py), then launches start_server.py
+as a separate process, non-interactive, and times from launch until it
+answers with a valid switch name (inventory available) and a valid switch
+value (state available).  The first run of each round starts without a saved
+inventory and so waits for discovery; the following runs restore the
+inventory the first one saved.  With --direct, the server probes each
+simulated device's address instead of broadcasting.  Same requirements as
+bench_load.py.
+
+    python3 benchmarks/bench_startup.py [--runs N] [--rounds N] [--direct] [--json results.json] [simulator options]
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import kasa_simulator
+
+
+START_SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'start_server.py')
+
+
+def valid_response(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status == 200 and json.loads(response.read()).get("ErrorNumber") == 0
+    except (OSError, http.client.HTTPException, ValueError):
+        return False
+    finally:
+        connection.close()
+
+
+def wait_for(port, path, t0, timeout):
+    # Seconds from t0 until path first answers with a valid response
+    while time.perf_counter() - t0 < timeout:
+        if valid_response(port, path):
+            return time.perf_counter() - t0
+        time.sleep(0.005)
+    raise RuntimeError('no valid response to %s within %.0f s' % (path, timeout))
+
+
+def start_run(args, inventory_path, discovery_args):
+    # Launch the server; returns (times to the first valid name and value responses, server process)
+    t0 = time.perf_counter()
+    server = subprocess.Popen([sys.executable, START_SERVER, "-a", "127.0.0.1", "-p", str(args.port),
+        "--inventory", inventory_path, "--non-interactive", "-q"] + discovery_args,
+        stdout=subprocess.DEVNULL)
+    try:
+        ids = 'ClientID=1&ClientTransactionID=1'
+        name_time = wait_for(args.port, '/api/v1/switch/0/getswitchname?Id=0&%s' % ids, t0, args.timeout)
+        value_time = wait_for(args.port, '/api/v1/switch/0/getswitchvalue?Id=0&%s' % ids, t0, args.timeout)
+    except Exception:
+        server.kill()
+        raise
+    return (name_time, value_time, server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time from launch to first valid Alpaca response, with and without a saved inventory")
+    parser.add_argument("--rounds", type=int, default=3, help="start-ups without a saved inventory")
+    parser.add_argument("--runs", type=int, default=3, help="start-ups restoring the inventory, per round")
+    parser.add_argument("-p", "--port", type=int, default=18000)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the server to answer")
+    parser.add_argument("--direct", action="store_true", help="probe the simulated devices' addresses (--host, --no-broadcast) instead of broadcasting")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    kasa_simulator.add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = kasa_simulator.make_simulator(args)
+    simulator.start()
+    if args.direct:
+        discovery_args = ["--no-broadcast"] + [arg for device in simulator.devices for arg in ("--host", device.host)]
+    else:
+        discovery_args = ["--discovery-target", kasa_simulator.DISCOVERY_ADDRESS]
+    results = {"cold": [], "restored": []}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        inventory_path = os.path.join(temp_dir, 'inventory.json')
+        for round_number in range(args.rounds):
+            if os.path.exists(inventory_path):
+                os.remove(inventory_path)
+            for run in range(1 + args.runs):
+                (name_time, value_time, server) = start_run(args, inventory_path, discovery_args)
+                results["restored" if run else "cold"].append({"name_s": name_time, "value_s": value_time})
+                # the cold start saves the inventory a few seconds after discovery
+                deadline = time.perf_counter() + args.timeout
+                while not os.path.exists(inventory_path) and time.perf_counter() < deadline:
+                    time.sleep(0.05)
+                server.terminate()
+                server.wait()
+    simulator.stop()
+
+    print('%i simulated devices (latency %.1f ms + up to %.1f ms jitter), %s, %i rounds of 1 cold + %i restored start-ups' % (
+        len(simulator.devices), 1000 * args.latency, 1000 * args.jitter, "direct probes" if args.direct else "broadcast discovery",
+        args.rounds, args.runs))
+    print('%-10s %22s %22s' % ("start-up", "first name (ms)", "first value (ms)"))
+    for kind, runs in results.items():
+        if runs:
+            name_times = [run["name_s"] * 1000 for run in runs]
+            value_times = [run["value_s"] * 1000 for run in runs]
+            print('%-10s %10.0f (max %5.0f)  %10.0f (max %5.0f)' % (kind,
+                sum(name_times) / len(runs), max(name_times), sum(value_times) / len(runs), max(value_times)))
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump({"arguments": vars(args), "results": results}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
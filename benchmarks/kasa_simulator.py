@@ -0,0 +1,315 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Kasa device simulator
+
+Fake kasa plugs and power strips speaking the legacy kasa local protocol:
+XOR-autokey obfuscated JSON, length-prefixed on TCP 9999 and bare on UDP 9999
+(discovery).  Each device listens on its own loopback address, 127.0.0.10,
+127.0.0.11, ..., so python-kasa sees distinct hosts; discovery is answered on
+127.0.0.2, the "broadcast" address to hand to SwitchManager.discovery_target.
+Binding arbitrary 127.x addresses works out of the box on Linux only.
+
+Each device also answers discovery sent straight to its own address, as used
+for configured hosts.
+
+Devices answer after latency + uniform(0, jitter) seconds and drop the
+connection (or ignore the discovery packet) with probability failure_rate.
+
+    python3 benchmarks/kasa_simulator.py [--plugs N] [--emeter-plugs N] [--strips N] [--latency S] ...
+
+or in-process:
+
+    simulator = KasaSimulator(plugs=8, strips=2, latency=0.01)
+    simulator.start()           # runs on its own event loop thread
+    ...
+    simulator.stop()
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import argparse
+import asyncio
+import json
+import random
+import struct
+import threading
+import time
+
+
+KASA_PORT = 9999
+DISCOVERY_ADDRESS = "127.0.0.2"
+FIRST_DEVICE_ADDRESS = (127, 0, 0, 10)
+
+
+def encrypt(plaintext):
+    key = 171
+    result = bytearray()
+    for byte in plaintext.encode('utf-8'):
+        key = key ^ byte
+        result.append(key)
+    return bytes(result)
+
+
+def decrypt(ciphertext):
+    key = 171
+    result = bytearray()
+    for byte in ciphertext:
+        result.append(key ^ byte)
+        key = byte
+    return result.decode('utf-8')
+
+
+class SimulatedDevice():
+    # One plug, or one strip with several outlets.  handle() answers a decoded kasa request.
+    def __init__(self, index, host, alias, model, outlets=0, emeter=False):
+        self.index = index
+        self.host = host
+        self.alias = alias
+        self.model = model
+        self.emeter = emeter
+        self.mac = '50:C7:BF:00:%02X:%02X' % (index // 256, index % 256)
+        self.device_id = '8006%036X' % (0x5eed0000 + index)
+        self.relay_state = 0
+        self.on_since = None
+        self.outlets = [{"id": '%s%02i' % (self.device_id, outlet), "alias": '%s outlet %i' % (alias, outlet + 1), "state": 0}
+            for outlet in range(outlets)]
+        self.requests = 0
+
+    def sysinfo(self):
+        sysinfo = {
+            "sw_ver": "1.0.0 Build 000000 Rel.000000",
+            "hw_ver": "1.0",
+            "model": self.model,
+            "deviceId": self.device_id,
+            "oemId": "00000000000000000000000000000000",
+            "hwId": "00000000000000000000000000000000",
+            "rssi": -50,
+            "latitude_i": 0,
+            "longitude_i": 0,
+            "alias": self.alias,
+            "status": "new",
+            "mic_type": "IOT.SMARTPLUGSWITCH",
+            "feature": "TIM:ENE" if self.emeter else "TIM",
+            "mac": self.mac,
+            "updating": 0,
+            "led_off": 0,
+            "err_code": 0,
+        }
+        if self.outlets:
+            sysinfo["child_num"] = len(self.outlets)
+            sysinfo["children"] = [dict(outlet, on_time=0, next_action={"type": -1}) for outlet in self.outlets]
+        else:
+            sysinfo["dev_name"] = "Smart Wi-Fi Plug"
+            sysinfo["relay_state"] = self.relay_state
+            sysinfo["on_time"] = 0 if self.on_since is None else int(time.time() - self.on_since)
+            sysinfo["next_action"] = {"type": -1}
+        return sysinfo
+
+    def realtime(self, outlets):
+        # made-up but plausible readings: 20 W per outlet that is on
+        num_on = sum(outlet["state"] for outlet in outlets) if self.outlets else self.relay_state
+        return {"voltage_mv": 120000, "current_ma": 167 * num_on, "power_mw": 20000 * num_on, "total_wh": 1000 + self.index, "err_code": 0}
+
+    def handle(self, request):
+        self.requests += 1
+        context = request.pop("context", None)
+        outlets = self.outlets
+        if context is not None and self.outlets:
+            outlets = [outlet for outlet in self.outlets if outlet["id"] in context.get("child_ids", ())]
+        response = {}
+        for module, methods in request.items():
+            response[module] = {}
+            for method, params in methods.items():
+                response[module][method] = self.handle_method(module, method, params or {}, outlets)
+        return response
+
+    def handle_method(self, module, method, params, outlets):
+        if module == "system" and method == "get_sysinfo":
+            return self.sysinfo()
+        if module == "system" and method == "set_relay_state":
+            state = 1 if params.get("state") else 0
+            if self.outlets:
+                for outlet in outlets:
+                    outlet["state"] = state
+            else:
+                if state and not self.relay_state:
+                    self.on_since = time.time()
+                self.relay_state = state
+            return {"err_code": 0}
+        if module == "system" and method == "set_dev_alias":
+            if self.outlets and len(outlets) == 1:
+                outlets[0]["alias"] = params.get("alias", outlets[0]["alias"])
+            else:
+                self.alias = params.get("alias", self.alias)
+            return {"err_code": 0}
+        if module == "emeter" and not self.emeter:
+            return {"err_code": -1, "err_msg": "module not support"}
+        if module == "emeter" and method == "get_realtime":
+            return self.realtime(outlets)
+        if method == "get_time":
+            now = time.localtime()
+            return {"year": now.tm_year, "month": now.tm_mon, "mday": now.tm_mday, 
+                "hour": now.tm_hour, "min": now.tm_min, "sec": now.tm_sec, "err_code": 0}
+        if method == "get_timezone":
+            return {"index": 6, "err_code": 0}
+        if method == "get_info" and module == "cnCloud":
+            return {"username": "", "server": "devs.tplinkcloud.com", "binded": 0, "cld_connection": 0, "err_code": 0}
+        # the rest of the queries python-kasa's modules make: empty rule and statistics lists
+        if method == "get_rules":
+            return {"rule_list": [], "enable": 0, "version": 2, "err_code": 0}
+        if method == "get_daystat":
+            return {"day_list": [], "err_code": 0}
+        if method == "get_monthstat":
+            return {"month_list": [], "err_code": 0}
+        return {"err_code": 0}
+
+
+class KasaSimulator():
+    def __init__(self, plugs=8, emeter_plugs=0, strips=0, outlets_per_strip=3, latency=0.005, jitter=0.005, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.devices = []
+        for kind, count, model, outlets, emeter in (
+            ("plug", plugs, "HS103(US)", 0, False),
+            ("energy plug", emeter_plugs, "HS110(US)", 0, True),
+            ("strip", strips, "HS300(US)", outlets_per_strip, True),
+        ):
+            for number in range(count):
+                index = len(self.devices)
+                host = '.'.join(str(part) for part in FIRST_DEVICE_ADDRESS[:3] + (FIRST_DEVICE_ADDRESS[3] + index,))
+                self.devices.append(SimulatedDevice(index, host, 'Sim %s %i' % (kind, number + 1), model, outlets, emeter))
+        self.loop = None
+        self.thread = None
+        self.servers = []
+        self.connection_writers = set()
+
+    def delay(self):
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    def fails(self):
+        return self.random.random() < self.failure_rate
+
+    async def handle_connection(self, device, reader, writer):
+        # TCP: 4-byte big-endian length, then the obfuscated JSON; python-kasa may reuse the connection
+        self.connection_writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                (length,) = struct.unpack('>I', header)
+                request = json.loads(decrypt(await reader.readexactly(length)))
+                await asyncio.sleep(self.delay())
+                if self.fails():
+                    break
+                payload = encrypt(json.dumps(device.handle(request)))
+                writer.write(struct.pack('>I', len(payload)) + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.connection_writers.discard(writer)
+            writer.close()
+
+    class DiscoveryProtocol(asyncio.DatagramProtocol):
+        # Listens on DISCOVERY_ADDRESS; each device answers from its own UDP socket so the reply's
+        # source address is the device's host, as on a real network.
+        def __init__(self, simulator):
+            self.simulator = simulator
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            try:
+                request = json.loads(decrypt(data))
+            except ValueError:
+                return
+            for device, device_transport in zip(self.simulator.devices, self.simulator.device_transports):
+                asyncio.get_running_loop().call_later(self.simulator.delay(), self.simulator.answer_discovery,
+                    device, device_transport, dict(request), addr)
+
+    class DeviceProtocol(asyncio.DatagramProtocol):
+        # A device's own UDP socket, answering discovery sent directly to it
+        def __init__(self, simulator, device):
+            self.simulator = simulator
+            self.device = device
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            try:
+                request = json.loads(decrypt(data))
+            except ValueError:
+                return
+            asyncio.get_running_loop().call_later(self.simulator.delay(), self.simulator.answer_discovery,
+                self.device, self.transport, request, addr)
+
+    def answer_discovery(self, device, device_transport, request, addr):
+        if not self.fails():
+            device_transport.sendto(encrypt(json.dumps(device.handle(request))), addr)
+
+    async def start_servers(self):
+        loop = asyncio.get_running_loop()
+        self.device_transports = []
+        for device in self.devices:
+            self.servers.append(await asyncio.start_server(
+                lambda reader, writer, device=device: self.handle_connection(device, reader, writer), device.host, KASA_PORT))
+            (transport, _) = await loop.create_datagram_endpoint(
+                lambda device=device: self.DeviceProtocol(self, device), local_addr=(device.host, KASA_PORT))
+            self.device_transports.append(transport)
+        (self.discovery_transport, _) = await loop.create_datagram_endpoint(
+            lambda: self.DiscoveryProtocol(self), local_addr=(DISCOVERY_ADDRESS, KASA_PORT))
+
+    async def stop_servers(self):
+        for server in self.servers:
+            server.close()
+        for writer in list(self.connection_writers):
+            writer.close()
+        await asyncio.sleep(0)
+        for transport in self.device_transports + [self.discovery_transport]:
+            transport.close()
+
+    def start(self):
+        # Run the simulated fleet on its own event loop thread; returns once every device is listening
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='kasa-simulator', daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start_servers(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.stop_servers(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def add_simulator_arguments(parser):
+    parser.add_argument("--plugs", type=int, default=8, help="simulated single-outlet plugs")
+    parser.add_argument("--emeter-plugs", type=int, default=0, help="simulated single-outlet plugs with energy monitoring")
+    parser.add_argument("--strips", type=int, default=0, help="simulated power strips")
+    parser.add_argument("--outlets", type=int, default=3, help="outlets per power strip")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds before each device reply")
+    parser.add_argument("--jitter", type=float, default=0.005, help="up to this many seconds added to each reply at random")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests dropped without a reply")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def make_simulator(args):
+    return KasaSimulator(plugs=args.plugs, emeter_plugs=args.emeter_plugs, strips=args.strips, outlets_per_strip=args.outlets,
+        latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated kasa plugs and strips on loopback addresses")
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+    simulator = make_simulator(args)
+    simulator.start()
+    for device in simulator.devices:
+        print('%-16s %-12s %s%s' % (device.host, device.model, device.alias, ' (%i outlets)' % len(device.outlets) if device.outlets else ''))
+    print('Discovery on %s:%i; run the daemon with --discovery-target %s.  Ctrl-c to stop.' % (DISCOVERY_ADDRESS, KASA_PORT, DISCOVERY_ADDRESS))
+    try:
+        simulator.thread.join()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
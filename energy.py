@@ -0,0 +1,90 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Kasa Switch ASCOM-Remote Server
+R. Kinnett, 2024
+https://github.com/rkinnett/kasa_smart_plug_ascom_daemon
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+energy.py
+
+Fixed-size history of energy meter (emeter) readings for one switch, and
+aggregates over a recent window of it.
+
+    Usage:
+        history = EnergyHistory(8640)
+        history.append(time.time(), watts, volts, amps)
+        history.latest()                        # (time, watts, volts, amps), or None before the first sample
+        history.aggregate(3600, time.time())    # {"Samples", "Start", "End", "MinWatts", ...} over the last hour
+
+    Samples live in preallocated array.array columns used as a ring buffer, so
+    memory stays constant however long the daemon runs and no Python object is
+    kept per sample.  Aggregates run as C-level builtins (min, max, sum over
+    map) on array slices, not as a Python loop over samples.  Appends (device
+    loop) and aggregates (HTTP threads) may come from different threads.
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import array
+import bisect
+import math
+import operator
+import threading
+
+
+class EnergyHistory():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array('d', [0.0]) * capacity     # time.time() of each sample
+        # readings as 32-bit floats, plenty for the meters' mW/mV/mA resolution
+        self.watts = array.array('f', [0.0]) * capacity
+        self.volts = array.array('f', [0.0]) * capacity
+        self.amps = array.array('f', [0.0]) * capacity
+        self.head = 0           # slot the next sample goes in
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, t, watts, volts=math.nan, amps=math.nan):
+        with self.lock:
+            i = self.head
+            self.times[i] = t
+            self.watts[i] = watts
+            self.volts[i] = volts
+            self.amps[i] = amps
+            self.head = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def latest(self):
+        with self.lock:
+            if not self.count:
+                return None
+            i = self.head - 1
+            return (self.times[i], self.watts[i], self.volts[i], self.amps[i])
+
+    def ordered(self, column, start=0):
+        # column's samples from the start'th oldest on, oldest first; caller holds the lock
+        if self.count < self.capacity or start >= self.count:
+            return column[start:self.count]
+        i = (self.head + start) % self.capacity
+        if i < self.head:
+            return column[i:self.head]
+        return column[i:] + column[:self.head]
+
+    def aggregate(self, window, now):
+        # Min, time-weighted mean and max power, and energy, over the samples taken within window
+        # seconds before now.  Energy integrates power over time between samples (trapezoidal rule).
+        with self.lock:
+            start = bisect.bisect_left(self.ordered(self.times), now - window)
+            times = self.ordered(self.times, start)
+            watts = self.ordered(self.watts, start)
+        if not times:
+            return {"Samples": 0, "Start": None, "End": None, "MinWatts": None, "MeanWatts": None, "MaxWatts": None, "EnergyWh": 0.0}
+        duration = times[-1] - times[0]
+        joules = sum(map(operator.mul, map(operator.add, watts[1:], watts[:-1]), map(operator.sub, times[1:], times[:-1]))) / 2
+        return {
+            "Samples": len(times),
+            "Start": times[0],
+            "End": times[-1],
+            "MinWatts": min(watts),
+            "MeanWatts": joules / duration if duration > 0 else watts[0],
+            "MaxWatts": max(watts),
+            "EnergyWh": joules / 3600,
+        }
@@ -0,0 +1,152 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Kasa Switch ASCOM-Remote Server
+R. Kinnett, 2024
+https://github.com/rkinnett/kasa_smart_plug_ascom_daemon
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+history.py
+
+Per-switch history of state transitions and commands, and an append-only
+file the events of all switches can be spilled to.
+
+    Usage:
+        history = StateHistory(10000)
+        history.append(time.time(), "poll", True)           # event name (see EVENTS), state True/False/None
+        history.between(start, end)                         # [(time, event, state), ...], oldest first
+
+        history_file = HistoryFile(path)
+        history_file.append([(switch_index, ticks, code), ...])   # from StateHistory.append()'s return value
+        history_file.between(switch_index, start, end)
+
+    An event is 5 bytes: its time in tenths of a second since 2024 as an
+    unsigned 32-bit integer (good until 2037) and one byte combining the event
+    and the state.  StateHistory keeps them in preallocated array.array columns
+    used as a ring buffer, so memory stays constant however long the daemon
+    runs; the file adds the switch index, 7 bytes per record.  Both are kept in
+    time order and searched by bisection on the times.  Appends (device loop)
+    and queries (HTTP threads) may come from different threads.
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import array
+import bisect
+import os
+import struct
+import threading
+
+
+EVENTS = (
+    "poll",             # a poll found the switch in another state than the last one known
+    "write",            # a client write, acknowledged by the switch
+    "write_failed",     # a client write the switch did not acknowledge; state is the one requested
+    "mismatch",         # the poll verifying a write found the other state
+    "discovered",       # first discovered
+    "lost",             # no longer discovered
+    "returned",         # discovered again after being lost
+)
+STATES = (False, True, None)
+EPOCH = 1704067200      # 2024-01-01 UTC
+TICKS_PER_SECOND = 10
+MAX_TICKS = 2**32 - 1
+
+
+def to_ticks(t):
+    return min(max(int((t - EPOCH) * TICKS_PER_SECOND), 0), MAX_TICKS)
+
+
+def from_ticks(ticks):
+    return EPOCH + ticks / TICKS_PER_SECOND
+
+
+def encode(event, state):
+    return EVENTS.index(event) << 2 | STATES.index(state)
+
+
+def decode(code):
+    return (EVENTS[code >> 2], STATES[code & 3])
+
+
+class StateHistory():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ticks = array.array('I', [0]) * capacity
+        assert self.ticks.itemsize == 4
+        self.codes = array.array('B', [0]) * capacity
+        self.head = 0           # slot the next event goes in
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, t, event, state):
+        # Returns (ticks, code) as stored, for spilling to a HistoryFile
+        (ticks, code) = (to_ticks(t), encode(event, state))
+        with self.lock:
+            i = self.head
+            self.ticks[i] = ticks
+            self.codes[i] = code
+            self.head = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+        return (ticks, code)
+
+    def ordered(self, column, start=0, stop=None):
+        # column's events from the start'th to the stop'th oldest, oldest first; caller holds the lock
+        stop = self.count if stop is None else stop
+        if self.count < self.capacity:
+            return column[start:stop]
+        return (column[self.head:] + column[:self.head])[start:stop]
+
+    def oldest(self):
+        # Time of the oldest event still held, or None if there is none
+        with self.lock:
+            if not self.count:
+                return None
+            return from_ticks(self.ticks[self.head if self.count == self.capacity else 0])
+
+    def between(self, start, end):
+        # Events from start to end (time.time() values, inclusive), oldest first
+        with self.lock:
+            ticks = self.ordered(self.ticks)
+            first = bisect.bisect_left(ticks, to_ticks(start))
+            last = bisect.bisect_right(ticks, to_ticks(end))
+            codes = self.ordered(self.codes, first, last)
+        return [(from_ticks(t),) + decode(code) for t, code in zip(ticks[first:last], codes)]
+
+
+class HistoryFile():
+    """
+    Append-only file of (switch index, ticks, code) records, 7 bytes each, in time order.  Readers
+    open the file themselves and ignore a trailing partial record, so queries need no lock.
+    """
+    record = struct.Struct('<HIB')
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, records):
+        with open(self.path, 'ab') as history_file:
+            history_file.write(b''.join(self.record.pack(*record) for record in records))
+
+    def read_record(self, history_file, i):
+        history_file.seek(i * self.record.size)
+        return self.record.unpack(history_file.read(self.record.size))
+
+    def bisect(self, history_file, count, ticks):
+        # Index of the first record at or after ticks
+        (low, high) = (0, count)
+        while low < high:
+            middle = (low + high) // 2
+            if self.read_record(history_file, middle)[1] < ticks:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def between(self, index, start, end):
+        # Events of switch index from start to end, as StateHistory.between()
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as history_file:
+            count = os.fstat(history_file.fileno()).st_size // self.record.size
+            (first, last) = (self.bisect(history_file, count, to_ticks(start)), self.bisect(history_file, count, to_ticks(end) + 1))
+            history_file.seek(first * self.record.size)
+            data = history_file.read((last - first) * self.record.size)
+        return [(from_ticks(ticks),) + decode(code) for (switch_index, ticks, code) in self.record.iter_unpack(data) if switch_index == index]
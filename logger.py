@@ -0,0 +1,78 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Kasa Switch ASCOM-Remote Server
+R. Kinnett, 2024
+https://github.com/rkinnett/kasa_smart_plug_ascom_daemon
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+logger.py
+
+Leveled, per-subsystem logging with a background writer.
+
+    Subsystem loggers (children of "kasa_daemon"):
+        http, alpaca, discovery, poller, device
+
+    Usage:
+        log = get_logger("poller")
+        log.debug('switch %i state: %s', idx, state)      # format args, don't pre-format
+        log.log(TRACE, ...)                                 # per-request detail
+
+    setup_logging(level, log_file=None) installs a QueueHandler, so handler and
+    request threads only enqueue records; a QueueListener thread does the
+    formatting and the (possibly slow) console/file writes.
+    stop_logging() writes out the records still queued and stops the listener;
+    call it on shutdown, after whatever might still log has stopped (atexit
+    calls it too, but atexit doesn't run when the process dies of a signal).
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+LOGGER_ROOT = "kasa_daemon"
+SUBSYSTEMS = ("http", "alpaca", "discovery", "poller", "device")
+
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+_listener = None
+
+
+def get_logger(subsystem):
+    return logging.getLogger('%s.%s' % (LOGGER_ROOT, subsystem))
+
+
+def setup_logging(level=logging.INFO, log_file=None):
+    # level may be a logging level number or name ("TRACE", "DEBUG", "INFO", ...)
+    global _listener
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file is not None:
+        handlers.append(logging.FileHandler(log_file))
+    formatter = logging.Formatter('%(asctime)s %(levelname)-7s %(name)s: %(message)s')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    stop_logging()
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger(LOGGER_ROOT)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    root.propagate = False
+
+
+@atexit.register
+def stop_logging():
+    # Flush queued records and stop the writer thread
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
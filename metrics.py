@@ -0,0 +1,204 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Kasa Switch ASCOM-Remote Server
+R. Kinnett, 2024
+https://github.com/rkinnett/kasa_smart_plug_ascom_daemon
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+metrics.py
+
+Counters, gauges and histograms, rendered in the Prometheus text exposition
+format by render() and served by the HTTP server at GET /metrics.
+
+    Usage:
+        requests = counter("alpaca_requests_total", "Alpaca requests handled", ("method", "code"))
+        requests.inc(method="getswitch", code=200)
+
+        latency = histogram("kasa_device_rtt_seconds", "Device round trip", ("switch", "op"))
+        latency.observe(0.042, switch=3, op="check")
+
+        threads = gauge("process_threads", "Live Python threads")
+        threads.set_function(threading.active_count)     # sampled at scrape time
+
+    Metrics are registered once by name; asking again for the same name returns
+    the existing metric.  Updates are safe from any thread.
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import bisect
+import math
+import threading
+import time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds; suits both HTTP request handling and LAN device round trips
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return repr(value)
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+class Metric():
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.function = None
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        assert len(labels) == len(self.labelnames), 'metric %s expects labels %s, got %s' % (self.name, self.labelnames, tuple(labels))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function):
+        # Sample function() at render time instead of stored values.  With labels, function returns
+        # {label value tuple: value}; without, a single number.
+        self.function = function
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+    def samples(self):
+        if self.function is None:
+            with self.lock:
+                return list(self.values.items())
+        values = self.function()
+        if not self.labelnames:
+            return [] if values is None else [((), values)]
+        return [(tuple(str(label) for label in labels), value) for labels, value in values.items()]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for labelvalues, value in sorted(self.samples()):
+            lines.append('%s%s %s' % (self.name, format_labels(self.labelnames, labelvalues), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        # values[key] is [per-bucket counts (last one +Inf), sum]; counts are made cumulative at render time
+        key = self.key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        with self.lock:
+            entries = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for labelvalues, (counts, total) in entries:
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %i' % (self.name,
+                    format_labels(self.labelnames, labelvalues, [("le", format_value(upper_bound))]), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labelnames, labelvalues), format_value(total)))
+            lines.append('%s_count%s %i' % (self.name, format_labels(self.labelnames, labelvalues), cumulative))
+        return lines
+
+
+class HistogramTimer():
+    # with histogram.time(op="discover"): ...  observes the elapsed seconds, whether or not the block raises
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.t0, **self.labels)
+
+
+def register(metric_class, name, help, labelnames=(), **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(name, help, labelnames, **kwargs)
+    assert type(metric) is metric_class, 'metric %s already registered as a %s' % (name, metric.type)
+    return metric
+
+
+def counter(name, help, labelnames=()):
+    return register(Counter, name, help, labelnames)
+
+
+def gauge(name, help, labelnames=()):
+    return register(Gauge, name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return register(Histogram, name, help, labelnames, buckets=buckets)
+
+
+def render():
+    # Every registered metric in the Prometheus text format, as bytes
+    with _registry_lock:
+        metrics = sorted(_registry.items())
+    lines = []
+    for name, metric in metrics:
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode('utf-8')
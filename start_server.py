@@ -5,26 +5,263 @@ https://github.com/rkinnett/kasa_smart_plug_ascom_daemon
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""
 import argparse
 import asyncio
+import contextlib
 from alpaca import Alpaca
+import fnmatch
+import sys
 import threading
 import time
+import os
+import heapq
+import inspect
+import itertools
+import json
+import logging
+import math
+import uuid
+from energy import EnergyHistory
+from history import StateHistory, HistoryFile
+from logger import get_logger, setup_logging, stop_logging, TRACE
+import metrics
 
 
-from kasa import SmartPlug as KasaSmartPlug, Discover as KasaDiscover, SmartDeviceException as KasaSmartDeviceException
-
-import signal
-signal.signal(signal.SIGINT, signal.SIG_DFL)
+from kasa import SmartPlug as KasaSmartPlug, SmartStrip as KasaSmartStrip, Discover as KasaDiscover, SmartDeviceException as KasaSmartDeviceException, EmeterStatus as KasaEmeterStatus
 
 supported_switch_types = ("kasa", )
 
-asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+device_log = get_logger("device")
+discovery_log = get_logger("discovery")
+poller_log = get_logger("poller")
+alpaca_log = get_logger("alpaca")
+
+# buckets in seconds for ages of polled states and for discovery, which waits several seconds for replies
+AGE_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+DISCOVERY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60)
+
+device_rtt = metrics.histogram("kasa_device_rtt_seconds", "Round trip of successful kasa device requests", ("switch", "op"))
+device_errors = metrics.counter("kasa_device_errors_total", "Failed or timed out kasa device requests", ("switch", "op", "reason"))
+sweep_duration = metrics.histogram("kasa_poll_sweep_duration_seconds", "Time to poll one batch of due switches")
+sweep_skipped = metrics.counter("kasa_poll_sweeps_skipped_total", "Poller wakeups that polled nothing, by reason", ("reason",))
+discovery_duration = metrics.histogram("kasa_discovery_duration_seconds", "Time taken by each kasa discovery", buckets=DISCOVERY_BUCKETS)
+discovery_errors = metrics.counter("kasa_discovery_errors_total", "Discoveries that raised an error")
+discovery_skipped = metrics.counter("kasa_discovery_skipped_total", "Scheduled discoveries skipped because one was already running")
+inventory_changes = metrics.counter("kasa_inventory_changes_total", "Switch inventory changes applied by discovery", ("change",))
+snapshot_reads = metrics.counter("kasa_snapshot_reads_total", 
+    "Client state reads by outcome: hit (fresh snapshot), stale_refresh, stale_error, absent", ("result",))
+snapshot_age = metrics.histogram("kasa_snapshot_age_seconds", "Age of the polled state served on each snapshot hit", buckets=AGE_BUCKETS)
+command_wait = metrics.histogram("kasa_command_wait_seconds", "Time device commands spend queued behind other commands for the same switch", ("op",))
+write_mismatches = metrics.counter("kasa_write_mismatches_total", "Writes acknowledged by a switch whose verification poll found the other state", ("switch",))
+commands_coalesced = metrics.counter("kasa_commands_coalesced_total", "Device commands merged into one already queued", ("op",))
+
+# python-kasa 0.6 renamed Discover.discover's (and discover_single's) reply wait from timeout to discovery_timeout
+DISCOVERY_TIMEOUT_ARG = "discovery_timeout" if "discovery_timeout" in inspect.signature(KasaDiscover.discover).parameters else "timeout"
+
+if os.name == 'nt':
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+
+class DeviceIOLoop():
+    """
+    Single long-lived asyncio event loop, running in its own thread, which owns all kasa device I/O.
+    Kasa device objects are bound to the loop they were created on, so every coroutine touching
+    a KasaSwitch.device must run here.  HTTP handler threads hand work over with submit() or run().
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='device-io', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        # Schedule coroutine on the device loop from any thread; returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        # Block the calling (non-loop) thread until the coroutine completes on the device loop
+        assert threading.current_thread() is not self.thread, 'DeviceIOLoop.run() called from the device loop thread'
+        return self.submit(coro).result(timeout)
+
+    def wait(self):
+        # Block until the loop thread ends.  Joined in short steps: on Windows an untimed join() can't be
+        # interrupted, so Ctrl-C would never reach the caller.
+        while self.thread.is_alive():
+            self.thread.join(0.5)
+
+
+class CommandQueue():
+    """
+    Runs one physical device's I/O one operation at a time, on the device loop.  Holds at most one
+    pending write per key (the switch written; a strip's outlets share their strip's queue) and one
+    pending read per op ("poll" for state, "energy" for strip outlet emeter samples).  The worker
+    always takes writes first, oldest first, so client writes never wait behind a background read.
+    A write queued while another for the same key is pending replaces it (last writer wins; every
+    caller gets the outcome of the write actually sent), and reads requested while one with the same
+    op is pending share it.
+    """
+    class Command():
+        def __init__(self, op, run, timeout):
+            self.op = op
+            self.run = run              # zero-argument coroutine function
+            self.timeout = timeout      # applies to running the command, not to time spent queued
+            self.queued_at = time.perf_counter()
+            self.future = asyncio.get_running_loop().create_future()
+            # callers may have given up (see submit), so don't complain about unretrieved errors
+            self.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    def __init__(self):
+        self.pending_writes = {}        # key: Command, in the order first queued
+        self.pending_polls = {}         # op: Command, likewise
+        self.running = None             # op name of the command in progress
+        self.worker = None
+
+    def depth(self):
+        return len(self.pending_writes) + len(self.pending_polls) + (self.running is not None)
+
+    async def write(self, key, run, timeout):
+        command = self.pending_writes.get(key)
+        if command is None:
+            command = self.pending_writes[key] = self.Command("write", run, timeout)
+        else:
+            commands_coalesced.inc(op="write")
+            (command.run, command.timeout) = (run, timeout)
+        return await self.submit(command)
+
+    async def poll(self, run, timeout, op="poll"):
+        command = self.pending_polls.get(op)
+        if command is None:
+            command = self.pending_polls[op] = self.Command(op, run, timeout)
+        else:
+            commands_coalesced.inc(op=op)
+        return await self.submit(command)
+
+    async def submit(self, command):
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.work())
+        # shielded: one caller giving up must not cancel a command other callers share
+        return await asyncio.shield(command.future)
+
+    def next_command(self):
+        for pending in (self.pending_writes, self.pending_polls):
+            if pending:
+                return pending.pop(next(iter(pending)))
+        return None
+
+    async def work(self):
+        try:
+            while True:
+                command = self.next_command()
+                if command is None:
+                    return
+                command_wait.observe(time.perf_counter() - command.queued_at, op=command.op)
+                self.running = command.op
+                try:
+                    result = await asyncio.wait_for(command.run(), command.timeout)
+                except Exception as error:
+                    command.future.set_exception(error)
+                else:
+                    command.future.set_result(result)
+                finally:
+                    self.running = None
+        finally:
+            self.worker = None
+
+
+def kasa_device_id(device):
+    # Stable identity for a kasa device (or strip outlet) across IP changes and renames
+    return getattr(device, 'device_id', None) or getattr(device, 'mac', None) or device.host
+
+
+def kasa_is_strip(device):
+    # Power strips list their outlets in sysinfo, which discovery replies already include
+    return "children" in device.sys_info
+
+
+def kasa_has_emeter(device):
+    # Energy monitoring plugs and strips (HS110, KP115, HS300...) list the ENE feature in sysinfo
+    return "ENE" in device.sys_info.get("feature", "").split(":")
+
+
+def kasa_emeter_status(device):
+    # A plug's realtime emeter reading, which comes with every update().  python-kasa 0.7 moved it
+    # from emeter_realtime to the Energy module.
+    energy = (device.modules or {}).get("Energy")
+    return energy.status if energy is not None else device.emeter_realtime
+
+
+async def kasa_outlet_emeter_status(strip, outlet):
+    # One strip outlet's realtime emeter reading, which update(update_children=False) leaves out: one request
+    response = await strip.protocol.query({"context": {"child_ids": [outlet.child_id]}, "emeter": {"get_realtime": {}}})
+    realtime = response["emeter"]["get_realtime"]
+    if realtime.get("err_code", 0) != 0:
+        raise KasaSmartDeviceException('emeter error on outlet "%s": %s' % (outlet.alias, realtime))
+    return KasaEmeterStatus(realtime)
+
+
+def lookup_channel(channels, switch_num):
+    # channels[n] for a switch id from action parameters: an integer, or a string of one (JSON object keys).
+    # Raises ValueError or IndexError for anything else, including negative ids, which Python indexing
+    # would otherwise count back from the end.
+    if isinstance(switch_num, (bool, float)):
+        raise ValueError('switch id must be an integer: %r' % (switch_num,))
+    number = int(switch_num)
+    if not 0 <= number < len(channels):
+        raise IndexError('invalid switch id: %i' % number)
+    return channels[number]
+
+
+def parse_switch_state(state):
+    # A switch state from action parameters: JSON true/false or 1/0, nothing else (bool("false") is True)
+    if isinstance(state, bool):
+        return state
+    if isinstance(state, int) and state in (0, 1):
+        return bool(state)
+    raise ValueError('switch state must be true, false, 1 or 0: %r' % (state,))
+
 
 class KasaSwitch():
-    device = None
-    state = None
-    state_str = None
+    """
+    One Alpaca switch: a kasa plug, or one outlet of a kasa power strip (HS300, KP303...).  A strip's
+    outlets share the strip's device object, command queue and siblings list, and one check() of any
+    of them refreshes them all from a single request to the strip.
+    """
+    device = None               # the physical kasa device, i.e. the strip for an outlet
+    outlet = None               # for a strip outlet, the strip's child device
+    outlet_number = None        # 1-based, for a strip outlet
+    id = None
+    device_id = None            # id of the physical device, shared by a strip's outlets
+    index = None                # Alpaca switch number
+    present = True              # False while discovery no longer sees the device (index is kept)
+    # (state, time.time() of the most recent successful check() or acknowledged write, state version), replaced
+    # as a whole so that HTTP threads always read a state together with its own refresh time and version.  The
+    # version counts the state's changes; it keys the ETag of state reads.
+    reading = (None, None, 0)
+    last_check_rtt = None       # seconds, round trip of the most recent successful check()
+    last_check_error = None
+    unverified_state = None     # state set by the last acknowledged write, until a check() confirms it
+    group = None                # SwitchGroup (Alpaca device) serving this switch, None if no group matches it
+    number = None               # Alpaca switch number within the group
+    can_write = True
+    min_value = 0
+    max_value = 1
+    step = 1
+    energy = None               # EnergyHistory of emeter readings, for a switch with an energy meter
+    power_channel = None        # the PowerChannel reporting this switch's power draw, if any
+    history = None              # StateHistory of state transitions and commands
     
-    def __init__(self, switch_address=None, switch_type=None, switch_name=None, kasa_device=None ):
+    # poll scheduling (all times are time.monotonic()):
+    next_poll = None            # due time of this switch's current entry in the poll heap
+    last_interest = None        # last client read or write
+    consecutive_failures = 0
+    
+    def __init__(self, switch_address=None, switch_type=None, switch_name=None, kasa_device=None, outlet=None, siblings=None):
+        # siblings: an existing switch on the same strip, whose command queue and siblings list to share
+        self.commands = CommandQueue()      # all device I/O for this switch goes through here
+        self.siblings = [self]
         self.address = switch_address
         self.name = switch_name
         self.type = switch_type
@@ -34,52 +271,276 @@ class KasaSwitch():
             self.address = kasa_device.host
             self.name    = kasa_device.alias
             self.type    = kasa_device.model
+            self.id      = kasa_device_id(kasa_device)
+            self.device_id = self.id
+        
+        if outlet is not None:
+            self.outlet = outlet
+            self.outlet_number = kasa_device.children.index(outlet) + 1
+            self.name = outlet.alias
+            self.id = kasa_device_id(outlet)
+        
+        if siblings is not None:
+            self.commands = siblings.commands
+            self.siblings = siblings.siblings
+            self.siblings.append(self)
         
         if switch_address is not None:
             self.device = KasaSmartPlug(switch_address)
+            self.id = switch_address
+            self.device_id = self.id
+
+    @property
+    def relay(self):
+        # the kasa device object to switch: the outlet of a strip, else the device itself
+        if self.outlet_number is None:
+            return self.device
+        assert self.outlet is not None, 'outlet %i of %s not yet found on the strip' % (self.outlet_number, self.address)
+        return self.outlet
+
+    def find_outlets(self):
+        # Strip outlets restored from the saved inventory have no outlet device until the strip's
+        # first update() creates its children; match them up by id
+        children = {kasa_device_id(child): child for child in self.device.children}
+        for switch in self.siblings:
+            if switch.outlet_number is not None and switch.outlet is None:
+                switch.outlet = children.get(switch.id)
+                if switch.outlet is None:
+                    raise KasaSmartDeviceException('outlet %i is no longer on power strip %s' % (switch.outlet_number, self.address))
             
     async def check(self):
+        # Refresh this switch and its siblings from one device request
         assert self.device is not None, 'device not defined'
-        await self.device.update()
-        self.state = self.device.is_on
-        self.state_str = "on" if self.device.is_on else "off"
+        t0 = time.perf_counter()
+        with self.device_request("check"):
+            if self.outlet_number is None:
+                await self.device.update()
+            else:
+                # outlet states come with the strip's own sysinfo; skip the per-outlet module queries
+                await self.device.update(update_children=False)
+                self.find_outlets()
+        rtt = time.perf_counter() - t0
+        device_rtt.observe(rtt, switch=self.index, op="check")
+        for switch in self.siblings:
+            switch.last_check_rtt = rtt
+            switch.last_check_error = None
+            switch.record_state(switch.relay.is_on)
         return self.state
+
+    @property
+    def state(self):
+        return self.reading[0]
+
+    @property
+    def state_str(self):
+        return None if self.reading[0] is None else "on" if self.reading[0] else "off"
+
+    @property
+    def last_refresh(self):
+        return self.reading[1]
+
+    def record_state(self, state):
+        (previous, _, version) = self.reading
+        self.reading = (state, time.time(), version if state == previous else version + 1)
+
+    def state_age(self):
+        # Seconds since the cached state was last refreshed from the device, or None if never
+        last_refresh = self.reading[1]
+        return None if last_refresh is None else time.time() - last_refresh
+
+    def record_energy(self, status):
+        # Append an emeter reading (kasa EmeterStatus) to the energy history
+        if status.power is None:
+            return
+        self.energy.append(time.time(), status.power, 
+            math.nan if status.voltage is None else status.voltage, math.nan if status.current is None else status.current)
     
     async def on(self):
         assert self.device is not None, 'device not defined'
-        print('turning switch on')
-        await self.device.turn_on()
+        device_log.debug('turning switch %s on', self.name)
+        await self.relay.turn_on()
             
     async def off(self):
         assert self.device is not None, 'device not defined'
-        print('turning switch off')
-        await self.device.turn_off()
+        device_log.debug('turning switch %s off', self.name)
+        await self.relay.turn_off()
 
     async def setState(self, state):
         assert self.device is not None, 'device not defined'
-        print('setting switch state %s' % str(state))
-        if state:
-            await self.on()
-        else:
-            await self.off()
+        device_log.info('setting switch %s state %s', self.name, state)
+        t0 = time.perf_counter()
+        with self.device_request("set"):
+            if self.outlet_number is not None and self.outlet is None:
+                await self.device.update(update_children=False)
+                self.find_outlets()
+            if state:
+                await self.on()
+            else:
+                await self.off()
+        device_rtt.observe(time.perf_counter() - t0, switch=self.index, op="set")
+        # the relay acknowledgement carries no state, so take it as applied until the next check()
+        self.record_state(bool(state))
+        self.unverified_state = bool(state)
+
+    @contextlib.contextmanager
+    def device_request(self, op):
+        # Count a device request that raises, or is cancelled by a caller's wait_for timeout
+        try:
+            yield
+        except asyncio.CancelledError:
+            device_errors.inc(switch=self.index, op=op, reason="timeout")
+            raise
+        except Exception:
+            device_errors.inc(switch=self.index, op=op, reason="error")
+            raise
+
+    def description(self):
+        if self.outlet_number is not None:
+            return 'Kasa switch type %s outlet %i' % (self.type, self.outlet_number)
+        return 'Kasa switch type ' + self.type
+
+
+class PowerChannel():
+    """
+    Read-only Alpaca switch whose value is the power, in watts, drawn through a KasaSwitch with an
+    energy meter, as of the latest sample in the switch's energy history.  It has its own Alpaca
+    switch number but no device I/O of its own.
+    """
+    can_write = False
+    min_value = 0
+    max_value = 3680            # W, the highest kasa outlet rating (16 A at 230 V)
+    step = 0.001                # the meters report mW
+    index = None
+    group = None                # always the switch's group
+    number = None
+    
+    def __init__(self, switch):
+        self.switch = switch
+        switch.power_channel = self
+
+    @property
+    def name(self):
+        return self.switch.name + ' power'
+
+    @property
+    def present(self):
+        return self.switch.present
+
+    def description(self):
+        return 'Power drawn through switch %i, W' % self.switch.number
+
+
+class Inventory():
+    """
+    Immutable, versioned snapshot of the switch inventory, as served to clients.  The device loop is
+    the only writer: it edits SwitchManager's working lists, then publishes them as a new Inventory
+    with one reference assignment (SwitchManager.publish_inventory).  HTTP handler threads and metrics
+    scrapes take SwitchManager.inventory once per request and use only that, so a request never sees
+    a half-applied discovery, and needs no lock.  The version goes up with every published change.
+    """
+    __slots__ = ("version", "channels", "switches", "devices")
+    
+    def __init__(self, version=0, channels=(), switches=(), devices=()):
+        self.version = version
+        self.channels = channels    # server-wide index: KasaSwitch or PowerChannel
+        self.switches = switches    # the KasaSwitches, in index order
+        self.devices = devices      # per Alpaca device number, its channels by switch number
+
+
+class SwitchGroup():
+    """
+    One Alpaca Switch device (device number).  Serves the switches whose name, address or id matches
+    one of its shell-style patterns (case-insensitive), numbered from 0 in the order they were added,
+    each followed by its power switch if it has one.  Each group has its own client connection, and
+    the poller only polls switches of connected groups, or of all groups while /events has subscribers.
+    """
+    connected = False
+    
+    def __init__(self, number, name, patterns=("*",), unique_id=None):
+        self.number = number
+        self.name = name
+        self.patterns = tuple(pattern.lower() for pattern in patterns)
+        self.unique_id = unique_id or str(uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/rkinnett/kasa_smart_plug_ascom_daemon#' + name))
+        self.channels = []      # Alpaca switch number: KasaSwitch or PowerChannel (device loop only, see Inventory)
+
+    def matches(self, name, address, switch_id):
+        values = [str(value).lower() for value in (name, address, switch_id) if value is not None]
+        return any(fnmatch.fnmatchcase(value, pattern) for pattern in self.patterns for value in values)
+
+    def add(self, channel):
+        channel.group = self
+        channel.number = len(self.channels)
+        self.channels.append(channel)
             
     
 
 class SwitchManager():
     version = 1
-    switches = []
-    num_switches = 0
+    inventory = Inventory()         # published snapshot of channels, switches and groups, see publish_inventory
     
-    discovery_loop_period = 30
+    discovery_loop_period = 30          # shortest rediscovery interval, used after changes or failed polls
+    discovery_loop_period_max = 600     # longest interval, reached by doubling while the fleet is stable
+    discovery_target = "255.255.255.255"   # broadcast (or unicast) address discovery packets are sent to
+    discovery_timeout = 5                   # seconds discovery waits for replies
+    broadcast_discovery = True              # False: only probe static_hosts
+    static_hosts = ()                       # plug/strip hosts probed directly on every discovery
     discovery_loop_busy = False
     discovery_loop_started = False
     
-    state_check_loop_period = 2
+    state_check_loop_period = 2     # poll interval for switches clients are actively reading or writing
+    poll_interval_after_write = 0.5 # first poll after a client write, to pick up the new state
+    poll_interval_idle = 30         # poll interval for switches no client has touched within poll_interest_window
+    poll_interest_window = 120      # seconds a client read/write keeps a switch on the active interval
+    poll_backoff_max = 300          # cap on exponential backoff for unreachable switches
     state_check_loop_busy = False
     state_check_loop_started = False
+    state_check_concurrency = 8     # max simultaneous device polls per sweep
+    state_check_timeout = 1.5       # seconds allowed for each device poll
+    last_sweep_duration = None
+    
+    state_max_age = 10              # seconds a cached state may be served before a read goes to the device
+    stale_read_policy = "refresh"   # "refresh": poll the device on a stale read, "error": return an Alpaca error
+    
+    energy_sample_interval = 5      # minimum seconds between emeter samples of a switch
+    energy_history_size = 8640      # emeter samples kept per switch: 12 h at energy_sample_interval
+    energy_max_age = 60             # seconds a power reading may be served before it is considered stale
+    power_channels = True           # give each switch with an energy meter a read-only power switch
+    
+    inventory_path = None           # JSON file the inventory and last states are saved to and restored from
+    inventory_save_delay = 5        # seconds to gather further changes before saving the inventory
+    
+    state_history_size = 10000      # state transitions and commands kept in memory per switch (5 bytes each)
+    history_path = None             # append-only file all switches' history events are also written to
+    history_spill_delay = 5         # seconds to gather further events before appending them to history_path
+    history_spill_max = 100000      # events held for history_path while it can't be written; older ones are dropped
         
-    def __init__(self, alpaca):
+    device_io_timeout = 10
+        
+    def __init__(self, alpaca, io_loop):
         self.alpaca = alpaca
+        self.io = io_loop
+        
+        # self.channels holds every KasaSwitch and PowerChannel; a channel's index is its position there,
+        # its server-wide number for logs, metrics and the saved inventory.  Clients address channels by
+        # Alpaca device (SwitchGroup) and switch number within it.  Neither number ever changes for a device.
+        # These working lists belong to the device loop; other threads read self.inventory instead.
+        self.channels = []
+        self.switches = []
+        self.switches_by_id = {}
+        self.switches_by_device_id = {}     # physical device ID: its first switch (see KasaSwitch.siblings)
+        self.discovery_interval = self.discovery_loop_period
+        self.last_discovery_time = 0
+        self.rediscover_event = None
+        self.inventory_save = None      # pending save_inventory() call, see schedule_inventory_save
+        self.history_spill = []         # (switch index, ticks, code) events not yet written to history_path
+        self.history_flush = None       # pending spill_history() call
+        self.set_groups([SwitchGroup(0, "Kasa Switch Hub", unique_id="1234")])
+        
+        # poll scheduler: heap of (due time, sequence, switch); entries whose due time no
+        # longer matches switch.next_poll have been superseded and are dropped when popped
+        self.poll_heap = []
+        self.poll_sequence = itertools.count()
+        self.poll_wakeup = None
 
         self.alpaca_methods = [
             ["GET", "connected",            self.getConnected],
@@ -107,194 +568,959 @@ class SwitchManager():
             ["PUT", "setswitchname",        self.setSwitchName],
             ["PUT", "setswitchvalue",       self.setSwitchValue],
         ]
+        
+        # Custom Alpaca actions (PUT action, Action=<name>, Parameters=<json>); names are case-insensitive
+        self.supported_actions = {
+            "GetSwitchStates":  self.actionGetSwitchStates,
+            "SetSwitchStates":  self.actionSetSwitchStates,
+            "GetPowerStats":    self.actionGetPowerStats,
+            "GetSwitchHistory": self.actionGetSwitchHistory,
+        }
+        
+        # inventory and state ages, sampled when /metrics is scraped
+        metrics.gauge("kasa_switch_info", "Inventory: one series per switch, value 1 while discovered", 
+            ("switch", "name", "address", "model", "alpaca_device", "alpaca_switch")).set_function(lambda: {
+                (switch.index, switch.name, switch.address, switch.type, 
+                    "" if switch.group is None else switch.group.number, "" if switch.number is None else switch.number): 
+                1 if switch.present else 0 for switch in self.inventory.switches
+            })
+        metrics.gauge("kasa_switch_state_age_seconds", "Seconds since each switch's state was last polled", 
+            ("switch",)).set_function(lambda: {
+                (switch.index,): switch.state_age() for switch in self.inventory.switches if switch.last_refresh is not None
+            })
+        metrics.gauge("kasa_switch_consecutive_failures", "Consecutive failed polls of each switch", 
+            ("switch",)).set_function(lambda: {(switch.index,): switch.consecutive_failures for switch in self.inventory.switches})
+        metrics.gauge("kasa_command_queue_depth", "Device commands queued or running for each switch", 
+            ("switch",)).set_function(lambda: {(switch.index,): switch.commands.depth() for switch in self.inventory.switches})
+        metrics.gauge("kasa_switch_power_watts", "Latest emeter power reading of each switch with an energy meter", 
+            ("switch",)).set_function(lambda: {
+                (switch.index,): switch.energy.latest()[1] for switch in self.inventory.switches 
+                if switch.energy is not None and switch.energy.count
+            })
+        metrics.gauge("kasa_switches", "Switches in the inventory, discovered (present) or not (absent)", 
+            ("state",)).set_function(lambda: {
+                ("present",): sum(switch.present for switch in self.inventory.switches),
+                ("absent",): sum(not switch.present for switch in self.inventory.switches),
+            })
+        metrics.gauge("kasa_inventory_version", "Version of the published switch inventory, up by one per change"
+            ).set_function(lambda: self.inventory.version)
+
+    
+    def set_groups(self, groups):
+        # Partition the inventory into these Alpaca devices; call before the first discovery
+        self.groups = groups
+        self.alpaca.set_devices([(group.name, group.unique_id) for group in groups])
+        self.publish_inventory()
+
+    def publish_inventory(self):
+        # Device loop (or start-up, before it runs) only.  Publish the working lists as the next inventory
+        # version; the single assignment to self.inventory is what makes the change visible to other threads.
+        self.inventory = Inventory(self.inventory.version + 1, tuple(self.channels), tuple(self.switches),
+            tuple(tuple(group.channels) for group in self.groups))
+        self.alpaca.invalidate_responses("maxswitch", "getswitchname", "getswitchdescription")
+        return self.inventory
+
+    @property
+    def num_switches(self):
+        return len(self.inventory.channels)
 
+    def group_for(self, name, address, switch_id):
+        # The first group whose patterns match, or None
+        for group in self.groups:
+            if group.matches(name, address, switch_id):
+                return group
+        return None
     
     async def discover(self):
         # Discover Kasa Switches:
         self.discovery_loop_busy = True
-        print('Discovering kasa smart plugs...')
-        discovered_switches = await KasaDiscover.discover()
-        discovered_switch_addrs = discovered_switches.keys()
-        discovered_switch_names = [device.alias for addr, device in discovered_switches.items()]
-        new_switch_list = []
-        for switch_idx, switch_name in enumerate(sorted(discovered_switch_names)):
-            for addr, device in discovered_switches.items():
-                if device.alias == switch_name:
-                    print('  Device at address %s:  {name: "%s", type: %s}' % (addr, device.alias, device.model))
-                    print('  adding switch addr %s, device ' % addr, device)
-                    new_switch_list.append(KasaSwitch(kasa_device = device))            
-        self.switches = new_switch_list
-        self.num_switches = len(self.switches)
-        print('  found %i kasa switches' % self.num_switches)
-        self.discovery_loop_busy = False
+        discovery_log.debug('Discovering kasa smart plugs...')
+        try:
+            with discovery_duration.time():
+                discovered_switches = await self.find_devices()
+                discovered_switches = await self.expand_strips(discovered_switches)
+            num_changes = self.apply_discovery(discovered_switches)
+        except Exception:
+            discovery_errors.inc()
+            raise
+        finally:
+            self.last_discovery_time = time.monotonic()
+            self.discovery_loop_busy = False
+        discovery_log.log(logging.INFO if num_changes else logging.DEBUG, 
+            'found %i kasa devices, %i inventory changes', len(discovered_switches), num_changes)
+        return num_changes
+        
+    async def find_devices(self):
+        # Broadcast discovery and a direct probe of each static host, all at once.  A probe answers in one
+        # round trip; only hosts that don't answer (and the broadcast) take the full discovery_timeout.
+        # Returns {host: device}, each device once even if found both ways.
+        searches = [self.probe_host(host) for host in self.static_hosts]
+        if self.broadcast_discovery:
+            searches.append(KasaDiscover.discover(target=self.discovery_target, **{DISCOVERY_TIMEOUT_ARG: self.discovery_timeout}))
+        found = {}
+        for devices in await asyncio.gather(*searches):
+            for device in devices.values():
+                found.setdefault(kasa_device_id(device), device)
+        return {device.host: device for device in found.values()}
+
+    async def probe_host(self, host):
+        # Unicast discovery of one configured host; {host: device}, or {} if it doesn't answer
+        try:
+            device = await KasaDiscover.discover_single(host, **{DISCOVERY_TIMEOUT_ARG: self.discovery_timeout})
+        except Exception as error:
+            discovery_log.warning('configured host %s did not answer: %s', host, error)
+            return {}
+        return {} if device is None else {host: device}
+
+    async def expand_strips(self, discovered_switches):
+        # python-kasa only creates a strip's outlet devices on its first update(), so update each newly
+        # discovered strip once.  A strip already in the inventory at the same address is replaced by the
+        # device object its switches use, whose outlets exist already, so the regular rediscovery costs
+        # no request per strip; outlet renames are then seen as of that strip's latest poll.  Strips that
+        # don't answer are left out of this discovery round.
+        discovered_switches = dict(discovered_switches)
+        strips = {}
+        for host, device in discovered_switches.items():
+            if not kasa_is_strip(device) or device.children:
+                continue
+            known = self.switches_by_device_id.get(kasa_device_id(device))
+            if known is not None and known.address == host and known.device.children:
+                discovered_switches[host] = known.device
+            else:
+                strips[host] = device
+        results = await asyncio.gather(*[
+            asyncio.wait_for(device.update(update_children=False), self.device_io_timeout) for device in strips.values()
+        ], return_exceptions=True)
+        for (host, device), result in zip(strips.items(), results):
+            if isinstance(result, Exception):
+                discovery_log.warning('power strip "%s" at %s did not list its outlets: %s', device.alias, host, str(result) or 'timeout')
+                del discovered_switches[host]
+        return discovered_switches
         
+    def apply_discovery(self, discovered_switches):
+        # Merge a discovery result into the inventory, keyed by device ID, with each outlet of a power
+        # strip as a switch of its own.  Existing KasaSwitch objects (and their cached state) are kept;
+        # new switches are appended so that indices already handed out to clients never move.  Returns
+        # the number of changes applied.
+        num_changes = 0
+        discovered_by_id = {}       # switch id: (device, outlet)
+        for device in discovered_switches.values():
+            if kasa_is_strip(device):
+                for outlet in device.children:
+                    discovered_by_id[kasa_device_id(outlet)] = (device, outlet)
+            else:
+                discovered_by_id[kasa_device_id(device)] = (device, None)
         
-    async def check_switches(self):
-        self.state_check_loop_busy = True
-        for switch_idx, switch in enumerate(self.switches):
+        for device_id, (device, outlet) in discovered_by_id.items():
+            switch = self.switches_by_id.get(device_id)
+            if switch is None:
+                continue
+            alias = device.alias if outlet is None else outlet.alias
+            if not switch.present:
+                discovery_log.info('switch %s "%s" is back at %s', device_id, alias, device.host)
+                switch.present = True
+                self.record_event(switch, "returned")
+                num_changes += 1
+                inventory_changes.inc(change="returned")
+            if switch.address != device.host:
+                discovery_log.info('switch %s "%s" moved from %s to %s', device_id, alias, switch.address, device.host)
+                switch.address = device.host
+                switch.device = device
+                switch.outlet = outlet
+                num_changes += 1
+                inventory_changes.inc(change="moved")
+            if switch.name != alias:
+                discovery_log.info('switch %s renamed from "%s" to "%s"', device_id, switch.name, alias)
+                switch.name = alias
+                num_changes += 1
+                inventory_changes.inc(change="renamed")
+        
+        new_switches = [(device, outlet) for device_id, (device, outlet) in discovered_by_id.items() if device_id not in self.switches_by_id]
+        for device, outlet in sorted(new_switches, key=lambda new_switch: (new_switch[0].alias, kasa_device_id(new_switch[0]), 
+                new_switch[0].children.index(new_switch[1]) if new_switch[1] is not None else 0)):
+            switch = KasaSwitch(kasa_device = device, outlet = outlet, siblings = self.switches_by_device_id.get(kasa_device_id(device)))
+            switch.index = len(self.channels)
+            group = self.group_for(switch.name, switch.address, switch.id)
+            if group is not None:
+                group.add(switch)
+            discovery_log.info('adding switch %i at address %s:  {name: "%s", type: %s, alpaca: %s}', switch.index, device.host, switch.name, 
+                switch.description(), 'none' if group is None else 'device %i switch %i' % (group.number, switch.number))
+            self.switches_by_id[switch.id] = switch
+            self.switches_by_device_id.setdefault(switch.device_id, switch)
+            self.switches.append(switch)
+            self.channels.append(switch)
+            switch.history = StateHistory(self.state_history_size)
+            self.record_event(switch, "discovered")
+            if kasa_has_emeter(device):
+                switch.energy = EnergyHistory(self.energy_history_size)
+                if self.power_channels:
+                    channel = PowerChannel(switch)
+                    channel.index = len(self.channels)
+                    if group is not None:
+                        group.add(channel)
+                    discovery_log.info('adding switch %i: power drawn through switch %i', channel.index, switch.index)
+                    self.channels.append(channel)
+            num_changes += 1
+            inventory_changes.inc(change="added")
+        
+        for switch in self.switches:
+            if switch.present and switch.id not in discovered_by_id:
+                discovery_log.warning('switch %i "%s" no longer discovered', switch.index, switch.name)
+                switch.present = False
+                self.record_event(switch, "lost")
+                num_changes += 1
+                inventory_changes.inc(change="lost")
+        
+        if num_changes:
+            inventory = self.publish_inventory()
+            self.schedule_inventory_save()
+            for (number, channels) in enumerate(inventory.devices):
+                self.alpaca.publish_event({
+                    "Type": "inventory", "Device": number, "InventoryVersion": inventory.version, "MaxSwitch": len(channels),
+                    "Switches": [{"Id": channel.number, "Name": channel.name, "Present": channel.present} for channel in channels],
+                })
+        return num_changes
+
+    def load_inventory(self):
+        # Restore the switches saved by save_inventory(), with their Alpaca numbers and last states, so
+        # clients can be served before the first discovery.  The kasa device objects are created from the
+        # saved addresses; discovery then reconciles the inventory as usual.  An inventory saved with
+        # switches in other groups than the current --devices configuration puts them in is not used.
+        # Returns the number of switches restored, 0 if there is no usable inventory file.
+        if self.inventory_path is None or not os.path.exists(self.inventory_path):
+            return 0
+        try:
+            with open(self.inventory_path) as inventory_file:
+                records = sorted(json.load(inventory_file)["switches"], key=lambda record: record["index"])
+            channel_indices = sorted([record["index"] for record in records] + 
+                [record["power_index"] for record in records if record.get("power_index") is not None])
+            assert channel_indices == list(range(len(channel_indices))), 'switch numbers are not contiguous'
+            # inventories saved before device groups existed had a single group numbered like the indices
+            group_numbers = {group.number: [] for group in self.groups}
+            for record in records:
+                record.setdefault("group", 0)
+                record.setdefault("number", record["index"])
+                record.setdefault("power_number", record.get("power_index"))
+                group = self.group_for(record["name"], record["address"], record["id"])
+                assert record["group"] == (None if group is None else group.number), 'switch "%s" now belongs to another device' % record["name"]
+                if group is not None:
+                    group_numbers[group.number] += [number for number in (record["number"], record["power_number"]) if number is not None]
+            for numbers in group_numbers.values():
+                assert sorted(numbers) == list(range(len(numbers))), 'switch numbers are not contiguous'
+        except (OSError, ValueError, KeyError, TypeError, AssertionError) as error:
+            discovery_log.warning('ignoring saved inventory %s: %s', self.inventory_path, error)
+            return 0
+        
+        self.channels = [None] * len(channel_indices)
+        for group in self.groups:
+            group.channels = [None] * len(group_numbers[group.number])
+        for record in records:
+            siblings = self.switches_by_device_id.get(record["device_id"])
+            switch = KasaSwitch(siblings = siblings)
+            if siblings is not None:
+                switch.device = siblings.device
+            elif record.get("outlet") is not None:
+                switch.device = KasaSmartStrip(record["address"])
+            else:
+                switch.device = KasaSmartPlug(record["address"])
+            switch.id = record["id"]
+            switch.device_id = record["device_id"]
+            switch.address = record["address"]
+            switch.name = record["name"]
+            switch.type = record["model"]
+            switch.outlet_number = record.get("outlet")
+            switch.index = record["index"]
+            switch.present = record.get("present", True)
+            if record.get("state") is not None:
+                switch.reading = (record["state"], record.get("last_refresh"), 1)
+            if record.get("emeter"):
+                switch.energy = EnergyHistory(self.energy_history_size)
+            switch.history = StateHistory(self.state_history_size)
+            self.switches_by_id[switch.id] = switch
+            self.switches_by_device_id.setdefault(switch.device_id, switch)
+            self.switches.append(switch)
+            self.channels[switch.index] = switch
+            if record["group"] is not None:
+                switch.group = self.groups[record["group"]]
+                switch.number = record["number"]
+                switch.group.channels[switch.number] = switch
+            if record.get("power_index") is not None:
+                channel = PowerChannel(switch)
+                channel.index = record["power_index"]
+                self.channels[channel.index] = channel
+                if switch.group is not None:
+                    channel.group = switch.group
+                    channel.number = record["power_number"]
+                    channel.group.channels[channel.number] = channel
+        self.publish_inventory()
+        discovery_log.info('restored %i switches from %s', len(self.switches), self.inventory_path)
+        return len(self.switches)
+
+    def save_inventory(self):
+        # Write the inventory and last known states to inventory_path, atomically
+        self.inventory_save = None
+        if self.inventory_path is None:
+            return
+        records = [{
+            "index": switch.index,
+            "id": switch.id,
+            "device_id": switch.device_id,
+            "address": switch.address,
+            "name": switch.name,
+            "model": switch.type,
+            "outlet": switch.outlet_number,
+            "emeter": switch.energy is not None,
+            "power_index": None if switch.power_channel is None else switch.power_channel.index,
+            "group": None if switch.group is None else switch.group.number,
+            "number": switch.number,
+            "power_number": None if switch.power_channel is None else switch.power_channel.number,
+            "present": switch.present,
+            "state": switch.state,
+            "last_refresh": switch.last_refresh,
+        } for switch in self.switches]
+        temp_path = self.inventory_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as inventory_file:
+                json.dump({"version": self.version, "saved": time.time(), "switches": records}, inventory_file, indent=1)
+            os.replace(temp_path, self.inventory_path)
+        except OSError as error:
+            discovery_log.warning('unable to save inventory to %s: %s', self.inventory_path, error)
+            return
+        discovery_log.debug('saved %i switches to %s', len(records), self.inventory_path)
+
+    def schedule_inventory_save(self):
+        # Device loop only.  Save once things have settled, rather than on every change.
+        if self.inventory_path is not None and self.inventory_save is None:
+            self.inventory_save = asyncio.get_running_loop().call_later(self.inventory_save_delay, self.save_inventory)
+
+    def request_rediscovery(self):
+        # Called on the device loop when a poll fails: fall back to the shortest discovery interval
+        self.discovery_interval = self.discovery_loop_period
+        if self.rediscover_event is not None:
+            self.rediscover_event.set()
+        
+        
+    async def refresh_switch(self, switch):
+        # Poll one switch, which also refreshes its siblings on the same strip, and publish a change event
+        # for each whose state differs from the snapshot.  If the poll is the first since a write, a state
+        # other than the one written is reported as a mismatch.
+        previous = [(sibling, sibling.state, sibling.unverified_state) for sibling in switch.siblings]
+        await switch.check()
+        if switch.outlet_number is None and switch.energy is not None and self.energy_due(switch):
+            # a plug's emeter reading comes with its update(), at no extra cost
+            switch.record_energy(kasa_emeter_status(switch.device))
+        for (sibling, previous_state, expected_state) in previous:
+            sibling.unverified_state = None
+            if expected_state is not None and sibling.state != expected_state:
+                poller_log.warning('switch %i "%s" acknowledged being turned %s but is %s', 
+                    sibling.index, sibling.name, "on" if expected_state else "off", sibling.state_str)
+                write_mismatches.inc(switch=sibling.index)
+                self.record_event(sibling, "mismatch", sibling.state)
+                self.publish_switch_event(sibling, "mismatch", Expected=expected_state, State=sibling.state)
+            elif sibling.state != previous_state:
+                self.record_event(sibling, "poll", sibling.state)
+            self.publish_state(sibling, previous_state)
+        return switch.state
+
+    async def apply_write(self, switch, state):
+        # One relay command; the snapshot takes the written state as soon as the switch acknowledges
+        previous_state = switch.state
+        try:
+            await switch.setState(state)
+        except (Exception, asyncio.CancelledError):
+            self.record_event(switch, "write_failed", bool(state))
+            raise
+        self.record_event(switch, "write", bool(state))
+        self.publish_state(switch, previous_state)
+
+    def record_event(self, switch, event, state=None):
+        # Device loop only.  Add an event to the switch's history and, with a history file, queue it for that.
+        (ticks, code) = switch.history.append(time.time(), event, state)
+        if self.history_path is not None:
+            self.history_spill.append((switch.index, ticks, code))
+            if self.history_flush is None:
+                self.history_flush = asyncio.get_running_loop().call_later(self.history_spill_delay, self.spill_history)
+
+    def spill_history(self):
+        # Append the queued history events to history_path; kept for the next try if it can't be written
+        self.history_flush = None
+        try:
+            HistoryFile(self.history_path).append(self.history_spill)
+        except OSError as error:
+            discovery_log.warning('unable to write history to %s: %s', self.history_path, error)
+            del self.history_spill[:-self.history_spill_max]
+            return
+        self.history_spill = []
+
+    def publish_state(self, switch, previous_state):
+        if switch.state != previous_state:
+            self.schedule_inventory_save()
+            self.publish_switch_event(switch, "state", State=switch.state, Value=1 if switch.state else 0)
+
+    def publish_switch_event(self, switch, event_type, **fields):
+        # Events address switches as clients do, by Alpaca device and switch number; a switch no group
+        # serves has no clients to tell
+        if switch.group is not None:
+            self.alpaca.publish_event(dict({"Type": event_type, "Device": switch.group.number, "Id": switch.number, "Name": switch.name}, **fields))
+
+    def energy_due(self, switch):
+        latest = switch.energy.latest()
+        return latest is None or time.time() - latest[0] >= self.energy_sample_interval
+
+    async def sample_outlet_energy(self, switches):
+        # Read the emeters of the given outlets of one strip, one request each, via the strip's command
+        # queue behind any writes.  Runs in the background after a successful poll of the strip.
+        async def read():
+            for switch in switches:
+                t0 = time.perf_counter()
+                with switch.device_request("energy"):
+                    status = await kasa_outlet_emeter_status(switch.device, switch.outlet)
+                device_rtt.observe(time.perf_counter() - t0, switch=switch.index, op="energy")
+                switch.record_energy(status)
+        try:
+            await switches[0].commands.poll(read, self.device_io_timeout, op="energy")
+        except Exception as error:
+            poller_log.warning('unable to read emeter of switch %i "%s": %s', switches[0].index, switches[0].name, str(error) or 'timeout')
+
+    def poll_switch(self, switch, timeout):
+        # refresh_switch() via the device's command queue, sharing any poll already queued
+        return switch.commands.poll(lambda: self.refresh_switch(switch), timeout)
+
+    async def write_switch(self, switch, state):
+        # apply_write() via the device's command queue, ahead of any queued poll.  Returns on the relay's
+        # acknowledgement; a poll poll_interval_after_write later verifies the state in the background.
+        await switch.commands.write(switch.id, lambda: self.apply_write(switch, state), self.device_io_timeout)
+        asyncio.ensure_future(self.verify_write(switch))
+
+    async def verify_write(self, switch):
+        await asyncio.sleep(self.poll_interval_after_write)
+        if switch.unverified_state is None:
+            return      # already checked since the write
+        try:
+            await self.poll_switch(switch, self.state_check_timeout)
+        except Exception as error:
+            poller_log.warning('unable to verify write to switch %i "%s": %s', switch.index, switch.name, str(error) or 'timeout')
+
+    async def check_switch(self, switch_idx, switch, semaphore):
+        async with semaphore:
             try:
-                await switch.check()
-                print('  switch %i state: %s' % (switch_idx, switch.state_str))
-            except Exception as error:
-                print("An exception occurred:", error) # An exception occurred: division by zero
-                print('error checking status of switch %i' % switch_idx)
-        self.state_check_loop_busy = False
+                await self.poll_switch(switch, self.state_check_timeout)
+                poller_log.log(TRACE, 'switch %i state: %s  (%.0f ms)', switch_idx, switch.state_str, 1000*switch.last_check_rtt)
+                for sibling in switch.siblings:
+                    sibling.consecutive_failures = 0
+                outlets_due = [sibling for sibling in switch.siblings 
+                    if sibling.outlet_number is not None and sibling.energy is not None and sibling.present and self.energy_due(sibling)]
+                if outlets_due:
+                    asyncio.ensure_future(self.sample_outlet_energy(outlets_due))
+                return True
+            except asyncio.TimeoutError:
+                error = 'timeout'
+                poller_log.warning('error checking status of switch %i: no reply within %.1f s', switch_idx, self.state_check_timeout)
+            except Exception as ex:
+                error = str(ex)
+                poller_log.warning('error checking status of switch %i: %s', switch_idx, error)
+            for sibling in switch.siblings:
+                sibling.last_check_error = error
+                sibling.consecutive_failures += 1
+            self.request_rediscovery()
+            return False
+
+    async def check_switches(self, switches=None):
+        # Poll the given switches (default: all present switches) at once, capped at state_check_concurrency
+        # in flight, so a sweep costs about as long as the slowest device rather than the sum of all of them.
+        # Each physical device is polled once however many of its outlets are listed.  Returns {switch: success}
+        # for the switches that were present when the sweep started; discovery may change that meanwhile.
+        self.state_check_loop_busy = True
+        t0 = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.state_check_concurrency)
+        if switches is None:
+            switches = self.switches
+        polled = [switch for switch in switches if switch.present]
+        devices = {}
+        for switch in polled:
+            devices.setdefault(switch.device_id, switch)
+        try:
+            device_results = await asyncio.gather(*[
+                self.check_switch(switch.index, switch, semaphore) for switch in devices.values()
+            ])
+        finally:
+            self.last_sweep_duration = time.perf_counter() - t0
+            self.state_check_loop_busy = False
+            sweep_duration.observe(self.last_sweep_duration)
+        rtts = [(switch.last_check_rtt, switch.index) for switch, ok in zip(devices.values(), device_results) if ok]
+        if rtts:
+            slowest_rtt, slowest_idx = max(rtts)
+            poller_log.debug('polled %i devices (%i switches) in %.0f ms, %i failed, slowest switch %i (%.0f ms)', 
+                len(devices), len(polled), 1000*self.last_sweep_duration, device_results.count(False), slowest_idx, 1000*slowest_rtt)
+        ok_by_device = dict(zip(devices, device_results))
+        return {switch: ok_by_device[switch.device_id] for switch in polled}
     
     
+    def schedule_poll(self, switch, due):
+        # Device loop only.  Pushes a new heap entry; any earlier entry for the switch becomes stale.
+        switch.next_poll = due
+        heapq.heappush(self.poll_heap, (due, next(self.poll_sequence), switch))
+        if self.poll_wakeup is not None:
+            self.poll_wakeup.set()
+
+    def poll_all_now(self, group):
+        # Device loop only.  Make every switch of the group due immediately, e.g. when a client connects.
+        now = time.monotonic()
+        for switch in self.switches:
+            if switch.group is group:
+                self.schedule_poll(switch, now)
+
+    def polled(self, switch):
+        # Switches are polled while discovered and a client is connected to their Alpaca device, or anyone
+        # waits on /events, whose state change events only polling produces
+        return switch.present and switch.group is not None and (switch.group.connected or self.alpaca.event_connections > 0)
+
+    def poll_interval(self, switch, ok, now):
+        if not ok:
+            # unreachable: back off exponentially
+            return min(self.state_check_loop_period * 2**switch.consecutive_failures, self.poll_backoff_max)
+        if switch.last_interest is not None and now - switch.last_interest < self.poll_interest_window:
+            return self.state_check_loop_period
+        return self.poll_interval_idle
+
+    def note_interest(self, switch, write=False):
+        # Called from HTTP handler threads on every client read or write of a switch.  Pulls the
+        # switch's next poll forward if the active (or post-write) interval would be sooner.
+        now = time.monotonic()
+        switch.last_interest = now
+        due = now + (self.poll_interval_after_write if write else self.state_check_loop_period)
+        if switch.next_poll is None or due < switch.next_poll:
+            self.io.loop.call_soon_threadsafe(self.schedule_poll, switch, due)
+
     async def state_check_loop(self):
+        # Per-switch poll scheduler.  Each switch has its own due time in self.poll_heap; due switches
+        # are polled together and rescheduled by poll_interval().  Polling of a group's switches pauses
+        # while no Alpaca client is connected to it and no /events subscriber is waiting (reads then fall
+        # back to read_state's stale handling).
+        self.poll_wakeup = asyncio.Event()
         while True:
-            if not self.discovery_loop_busy:
-                if not self.state_check_loop_busy:
-                    print('State check loop updating switch states')
-                    self.state_check_loop_busy = True
-                    await self.check_switches()
-                    self.state_check_loop_busy = False
-                else:
-                    print('!!!!!! state check busy, skipping')
-            time.sleep(self.state_check_loop_period)
+            now = time.monotonic()
+            for switch in self.switches:
+                if switch.next_poll is None and self.polled(switch):
+                    self.schedule_poll(switch, now)
+            self.poll_wakeup.clear()
+            
+            wait_time = self.state_check_loop_period
+            if not self.alpaca.event_connections and not any(group.connected for group in self.groups):
+                sweep_skipped.inc(reason="disconnected")
+            elif self.discovery_loop_busy:
+                sweep_skipped.inc(reason="discovery")
+            else:
+                due_switches = []
+                while self.poll_heap and self.poll_heap[0][0] <= now:
+                    (due, _, switch) = heapq.heappop(self.poll_heap)
+                    if due != switch.next_poll:
+                        continue
+                    if not self.polled(switch):
+                        switch.next_poll = None
+                        continue
+                    due_switches.append(switch)
+                # a strip's outlets are refreshed together, so reschedule them together
+                for switch in list(due_switches):
+                    due_switches.extend(sibling for sibling in switch.siblings if self.polled(sibling) and sibling not in due_switches)
+                if due_switches:
+                    results = await self.check_switches(due_switches)
+                    now = time.monotonic()
+                    for switch in due_switches:
+                        if switch in results and self.polled(switch):
+                            self.schedule_poll(switch, now + self.poll_interval(switch, results[switch], now))
+                        else:
+                            # not polled this sweep, or no longer pollable: the loop adds it back when it is
+                            switch.next_poll = None
+                    continue
+                if self.poll_heap:
+                    wait_time = self.poll_heap[0][0] - now
+            try:
+                await asyncio.wait_for(self.poll_wakeup.wait(), wait_time)
+            except asyncio.TimeoutError:
+                pass
     
     
-    async def start_state_check_loop(self):
-        self.state_check_loop_thread = threading.Thread(target=asyncio.run, args=(self.state_check_loop(),))    
-        self.state_check_loop_thread.start()
+    def start_state_check_loop(self):
+        self.state_check_loop_task = self.io.submit(self.state_check_loop())
         self.state_check_loop_started = True
     
     
     async def discovery_loop(self):
+        # Rediscover every discovery_interval.  The interval doubles after each discovery that
+        # finds no changes, up to discovery_loop_period_max, and drops back to discovery_loop_period
+        # when the inventory changes or a state poll fails (see request_rediscovery).
+        self.rediscover_event = asyncio.Event()
         while True:
-            if not self.discovery_loop_busy:
-                #print('####### discovery loop discovering #######')
-                await self.discover()
+            wait_time = self.last_discovery_time + self.discovery_interval - time.monotonic()
+            if wait_time > 0:
+                try:
+                    await asyncio.wait_for(self.rediscover_event.wait(), wait_time)
+                except asyncio.TimeoutError:
+                    pass
+                self.rediscover_event.clear()
+                continue
+            if self.discovery_loop_busy:
+                discovery_log.debug('discovery busy, skipping')
+                discovery_skipped.inc()
+                await asyncio.sleep(self.discovery_loop_period)
+                continue
+            try:
+                num_changes = await self.discover()
+            except Exception as error:
+                discovery_log.warning('discovery failed: %s', error)
+                num_changes = 1
+            if num_changes:
+                self.discovery_interval = self.discovery_loop_period
             else:
-                print('!!!!!! discovery busy, skipping')
-            time.sleep(self.discovery_loop_period)
+                self.discovery_interval = min(2*self.discovery_interval, self.discovery_loop_period_max)
+            discovery_log.debug('next discovery in %i s', self.discovery_interval)
             
         
-    async def start_discovery_loop(self):
-        self.discovery_loop_thread = threading.Thread(target=asyncio.run, args=(self.discovery_loop(),))    
-        self.discovery_loop_thread.start()
+    def start_discovery_loop(self):
+        self.discovery_loop_task = self.io.submit(self.discovery_loop())
         self.discovery_loop_started = True
 
 
+    def get_group(self, transaction):
+        # The Alpaca device addressed; Alpaca has already checked the device number is configured
+        return self.groups[transaction.args["device_number"]]
+
+    def get_snapshot(self, transaction):
+        # The inventory snapshot this request is answered from: the current one, taken on first use, so
+        # that the ETag of a response names the version its switch was looked up in
+        if transaction.snapshot is None:
+            transaction.snapshot = self.inventory
+        return transaction.snapshot
+
+    def get_channels(self, transaction):
+        # The addressed Alpaca device's switches by switch number, as of the request's inventory snapshot
+        return self.get_snapshot(transaction).devices[transaction.args["device_number"]]
+
     def getConnected(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=self.alpaca.connected)
+        return self.alpaca.nominal_response(transaction, value=self.get_group(transaction).connected)
 
     def getDescription(self, transaction):
-        return self.alpaca.nominal_response(transaction, value="Kasa smart plug daemon")
+        return self.alpaca.cached_response(transaction, ("description",), "Kasa smart plug daemon")
         
     def getDriverInfo(self, transaction):
-        return self.alpaca.nominal_response(transaction, value="Kasa smart plug daemon")
+        return self.alpaca.cached_response(transaction, ("driverinfo",), "Kasa smart plug daemon")
         
     def getDriverVersion(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=self.version)
+        return self.alpaca.cached_response(transaction, ("driverversion",), self.version)
         
     def getInterfaceVersion(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=self.alpaca.api.version)
+        return self.alpaca.cached_response(transaction, ("interfaceversion",), self.alpaca.api.version)
 
     def getName(self, transaction):
-        return self.alpaca.nominal_response(transaction, value="Kasa smart plug daemon")
+        group = self.get_group(transaction)
+        return self.alpaca.cached_response(transaction, ("name", group.number), group.name)
         
     def getSupportedActions(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=[])
+        return self.alpaca.cached_response(transaction, ("supportedactions",), lambda: list(self.supported_actions.keys()))
 
     def getMaxSwitch(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=self.num_switches)
+        # keyed by inventory version too: a response computed from an older snapshot is never served for a newer one
+        inventory = self.get_snapshot(transaction)
+        device_number = transaction.args["device_number"]
+        return self.alpaca.cached_response(transaction, ("maxswitch", device_number, inventory.version), len(inventory.devices[device_number]),
+            version=(inventory.version,))
     
+    def get_switch(self, transaction):
+        # Look up the switch (KasaSwitch or PowerChannel) addressed by the (already int-typed) "id" argument,
+        # within the addressed Alpaca device.  Returns (switch, error_response).
+        channels = self.get_channels(transaction)
+        switch_num = transaction.args["id"]
+        if 0 <= switch_num < len(channels):
+            return (channels[switch_num], None)
+        return (None, self.alpaca.error_response(transaction,
+            self.alpaca.api.error_codes['INVALID_VALUE'], 
+            'invalid switch id: %i' % switch_num
+        ))
+
     def getCanWrite(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=True)
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        return self.alpaca.cached_response(transaction, ("canwrite", switch.can_write), switch.can_write,
+            version=(self.get_snapshot(transaction).version,))
 
     def getSwitch(self, transaction):
-        try:
-            switch_num = int(transaction.params["id"])
-        except:
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        if not switch.can_write:
+            return self.read_power(transaction, switch, lambda transaction, watts: self.alpaca.nominal_response(transaction, value=watts > 0))
+        return self.read_state(transaction, switch, self.switch_state_response)
+
+    def switch_state_response(self, transaction, reading):
+        # only two possible payloads, so cache by value
+        state = reading[0]
+        return self.alpaca.cached_response(transaction, ("getswitch", state), state, version=self.state_version(transaction, reading))
+            
+    def getSwitchDescription(self, transaction):
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        return self.alpaca.cached_response(transaction, ("getswitchdescription", switch.index), switch.description,
+            version=(self.get_snapshot(transaction).version,))        
+
+    def getSwitchName(self, transaction):
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        # keyed by the name itself, so a rename can't leave the old name cached
+        name = switch.name
+        return self.alpaca.cached_response(transaction, ("getswitchname", switch.index, name), name,
+            version=(self.get_snapshot(transaction).version,))
+
+    def getSwitchValue(self, transaction):
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        if not switch.can_write:
+            return self.read_power(transaction, switch, lambda transaction, watts: self.alpaca.nominal_response(transaction, value=round(watts, 3)))
+        return self.read_state(transaction, switch, self.switch_value_response)
+
+    def switch_value_response(self, transaction, reading):
+        value = 1 if reading[0] else 0
+        return self.alpaca.cached_response(transaction, ("getswitchvalue", value), value, version=self.state_version(transaction, reading))
+
+    def state_version(self, transaction, reading):
+        # ETag version of a state read: the inventory snapshot the switch was looked up in, and its state version
+        return (self.get_snapshot(transaction).version, reading[2])
+
+    def read_state(self, transaction, switch, respond):
+        # Answer respond(transaction, reading) from the state snapshot kept by the background poller.
+        # Only if the snapshot is older than state_max_age does the read either poll the device or fail,
+        # per stale_read_policy.  Polling returns a coroutine, which Alpaca runs on the device loop.
+        if not switch.present:
+            snapshot_reads.inc(result="absent")
             return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
+                self.alpaca.api.error_codes['UNSPECIFIED_ERROR'],
+                'switch "%s" is not currently discovered on the network' % switch.name
             )
-        try: 
-            switch = self.switches[switch_num]
-        except IndexError:
+        self.note_interest(switch)
+        reading = switch.reading
+        last_refresh = reading[1]
+        age = None if last_refresh is None else time.time() - last_refresh
+        if age is not None and age <= self.state_max_age:
+            snapshot_reads.inc(result="hit")
+            snapshot_age.observe(age)
+            return respond(transaction, reading)
+        snapshot_reads.inc(result="stale_" + self.stale_read_policy)
+        if self.stale_read_policy == "error":
             return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
+                self.alpaca.api.error_codes['UNSPECIFIED_ERROR'],
+                'switch state is stale (last refreshed %s)' % ('never' if age is None else '%.1f s ago' % age)
             )
-        switch.check()
-        return self.alpaca.nominal_response(transaction, value=switch.state)
-            
-    def getSwitchDescription(self, transaction):
-        # Get switch number from params, then get the specified switch
-        try:
-            switch_num = int(transaction.params["id"])
-        except:
+        return self.refresh_and_respond(transaction, switch, respond)
+
+    def read_power(self, transaction, channel, respond):
+        # Answer respond(transaction, watts) from the latest emeter sample, taken along with the state
+        # polls (see refresh_switch and sample_outlet_energy); a stale reading is an error, not a refresh.
+        switch = channel.switch
+        if not switch.present:
+            snapshot_reads.inc(result="absent")
             return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
+                self.alpaca.api.error_codes['UNSPECIFIED_ERROR'],
+                'switch "%s" is not currently discovered on the network' % switch.name
             )
-        #print('switch num %i' % switch_num)
-        try: 
-            switch = self.switches[switch_num]
-            #print(switch)
-        except IndexError:
+        self.note_interest(switch)
+        latest = switch.energy.latest()
+        if latest is None or time.time() - latest[0] > self.energy_max_age:
             return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
+                self.alpaca.api.error_codes['UNSPECIFIED_ERROR'],
+                'no power reading from switch %i in the last %i s' % (switch.number, self.energy_max_age)
             )
-        description = 'Kasa switch type ' + switch.type
-        return self.alpaca.nominal_response(transaction, value=description)        
+        return respond(transaction, latest[1])
 
-    def getSwitchName(self, transaction):
-        #print('getSwitchName')
-        #print(transaction.params)
+    async def refresh_and_respond(self, transaction, switch, respond):
         try:
-            switch_num = int(transaction.params["id"])
-        except:
+            await self.poll_switch(switch, self.state_check_timeout)
+        except Exception as error:
+            switch.last_check_error = str(error) or 'timeout'
             return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
+                self.alpaca.api.error_codes['UNSPECIFIED_ERROR'],
+                'unable to refresh switch state'
             )
-        #print('switch num %i' % switch_num)
-        try: 
-            switch = self.switches[switch_num]
-            #print(switch)
-        except IndexError:
+        return respond(transaction, switch.reading)
+            
+    def getMinSwitchValue(self, transaction):
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        return self.alpaca.cached_response(transaction, ("minswitchvalue", switch.min_value), switch.min_value,
+            version=(self.get_snapshot(transaction).version,))
+
+    def getMaxSwitchValue(self, transaction):
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        return self.alpaca.cached_response(transaction, ("maxswitchvalue", switch.max_value), switch.max_value,
+            version=(self.get_snapshot(transaction).version,))
+
+    def getSwitchStep(self, transaction):
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        return self.alpaca.cached_response(transaction, ("switchstep", switch.step), switch.step,
+            version=(self.get_snapshot(transaction).version,))
+        
+    def doAction(self, transaction):
+        requested_action = transaction.args["action"].lower()
+        for action_name, action in self.supported_actions.items():
+            if action_name.lower() == requested_action:
+                return action(transaction)
+        return self.alpaca.not_supported_response(transaction)
+
+    def actionGetSwitchStates(self, transaction):
+        # Whole switch table in one response, served from the state snapshot.
+        # Value is a JSON string: [{"Id", "Name", "Description", "CanWrite", "State", "Value", "Present", "LastRefresh", "LastError"}, ...]
+        # where a power switch's Value is watts and LastRefresh the time of that reading, and LastError is why the
+        # switch's latest poll failed, null once one succeeds.
+        table = []
+        for channel in self.get_channels(transaction):
+            switch = channel if channel.can_write else channel.switch
+            if channel.present:
+                self.note_interest(switch)
+            if channel.can_write:
+                (state, last_refresh, _) = channel.reading
+                value = None if state is None else (1 if state else 0)
+            else:
+                latest = channel.switch.energy.latest()
+                (value, last_refresh) = (None, None) if latest is None else (round(latest[1], 3), latest[0])
+            table.append({
+                "Id": channel.number,
+                "Name": channel.name,
+                "Description": channel.description(),
+                "CanWrite": channel.can_write,
+                "State": state if channel.can_write else (None if value is None else value > 0),
+                "Value": value,
+                "Present": channel.present,
+                "LastRefresh": last_refresh,
+                "LastError": switch.last_check_error,
+            })
+        return self.alpaca.nominal_response(transaction, value=json.dumps(table))
+
+    def actionSetSwitchStates(self, transaction):
+        # Apply many switch changes in one request, all sent to the devices concurrently.
+        # Parameters: JSON object {"<id>": state, ...} where state is true/false or 1/0.
+        # Value is a JSON string: [{"Id", "State", "Ok", "Error"}, ...]
+        try:
+            channels = self.get_channels(transaction)
+            requested = json.loads(transaction.args["parameters"])
+            changes = [(lookup_channel(channels, switch_num), parse_switch_state(state)) for switch_num, state in requested.items()]
+        except (ValueError, TypeError, AttributeError, IndexError):
             return self.alpaca.error_response(transaction,
                 self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
+                'expected parameters as JSON object {"<switch id>": <true/false/1/0>, ...} with valid switch ids'
             )
-        return self.alpaca.nominal_response(transaction, value=switch.name)
+        for switch, state in changes:
+            if not switch.can_write:
+                return self.read_only_response(transaction, switch)
+        for switch, state in changes:
+            self.note_interest(switch, write=True)
+        return self.apply_switch_states(transaction, changes)
 
-    def getSwitchValue(self, transaction):
+    async def apply_switch_states(self, transaction, changes):
+        async def apply(switch, state):
+            try:
+                await self.write_switch(switch, state)
+                return {"Id": switch.number, "State": switch.state, "Ok": switch.state == state, "Error": None}
+            except Exception as error:
+                return {"Id": switch.number, "State": switch.state, "Ok": False, "Error": str(error) or 'timeout'}
+        results = await asyncio.gather(*[apply(switch, state) for switch, state in changes])
+        return self.alpaca.nominal_response(transaction, value=json.dumps(results))
+
+    def actionGetPowerStats(self, transaction):
+        # Power and energy over a recent window for switches with an energy meter, from their emeter histories.
+        # Parameters (optional): JSON object {"Window": seconds (default 3600), "Ids": [switch or power switch ids]}
+        # Value is a JSON string: [{"Id", "PowerId", "Name", "Samples", "Start", "End", "MinWatts", "MeanWatts", "MaxWatts", "EnergyWh"}, ...]
         try:
-            switch_num = int(transaction.params["id"])
-        except:
+            requested = json.loads(transaction.args["parameters"] or "{}")
+            window = float(requested.get("Window", 3600))
+            channels = self.get_channels(transaction)
+            if "Ids" in requested:
+                switches = [lookup_channel(channels, switch_num) for switch_num in requested["Ids"]]
+                switches = [switch if switch.can_write else switch.switch for switch in switches]
+            else:
+                switches = [switch for switch in channels if switch.can_write and switch.energy is not None]
+        except (ValueError, TypeError, AttributeError, IndexError):
             return self.alpaca.error_response(transaction,
                 self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
+                'expected parameters as JSON object {"Window": <seconds>, "Ids": [<switch id>, ...]} with valid switch ids'
             )
-        try: 
-            switch = self.switches[switch_num]
-        except IndexError:
+        now = time.time()
+        results = []
+        for switch in switches:
+            if switch.energy is None:
+                return self.alpaca.error_response(transaction,
+                    self.alpaca.api.error_codes['INVALID_VALUE'], 
+                    'switch %i has no energy meter' % switch.number
+                )
+            stats = switch.energy.aggregate(window, now)
+            results.append(dict({
+                "Id": switch.number,
+                "PowerId": None if switch.power_channel is None else switch.power_channel.number,
+                "Name": switch.name,
+            }, **{key: round(value, 3) if key.endswith(("Watts", "Wh")) and value is not None else value for key, value in stats.items()}))
+        return self.alpaca.nominal_response(transaction, value=json.dumps(results))
+        
+    def actionGetSwitchHistory(self, transaction):
+        # State transitions and commands of switches over a time range, from their histories and, for
+        # anything older than those hold, the history file.
+        # Parameters (optional): JSON object {"Start": time (default an hour ago), "End": time (default now), "Ids": [switch ids]}
+        # with times as Unix time in seconds, and power switches standing for their switch.
+        # Value is a JSON string: [{"Id", "Name", "Events": [{"Time", "Event", "State"}, ...]}, ...]
+        # where Event is one of history.EVENTS.
+        try:
+            requested = json.loads(transaction.args["parameters"] or "{}")
+            end = float(requested.get("End", time.time()))
+            start = float(requested.get("Start", end - 3600))
+            if not (math.isfinite(start) and math.isfinite(end)):
+                raise ValueError('Start and End must be finite')
+            channels = self.get_channels(transaction)
+            if "Ids" in requested:
+                switches = [lookup_channel(channels, switch_num) for switch_num in requested["Ids"]]
+                switches = [switch if switch.can_write else switch.switch for switch in switches]
+            else:
+                switches = [switch for switch in channels if switch.can_write]
+        except (ValueError, TypeError, AttributeError, IndexError):
             return self.alpaca.error_response(transaction,
                 self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
+                'expected parameters as JSON object {"Start": <time>, "End": <time>, "Ids": [<switch id>, ...]} with valid switch ids'
             )
-        time.sleep(0.25)
-        switch.check()
-        print('Switch state: %s' % str(switch.state))
-        value = 1 if switch.state else 0
-        return self.alpaca.nominal_response(transaction, value=value)
-            
-    def getMinSwitchValue(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=0)
+        if self.history_path is not None:
+            older = [switch for switch in switches if switch.history.oldest() is None or start < switch.history.oldest()]
+            if older:
+                return self.switch_history_with_file(transaction, switches, older, start, end)
+        return self.switch_history_response(transaction, switches, start, end, {})
 
-    def getMaxSwitchValue(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=1)
+    async def switch_history_with_file(self, transaction, switches, older, start, end):
+        # The file is read in an executor thread: in asyncio server mode this runs on the device loop,
+        # which mustn't wait on the disk
+        history_file = HistoryFile(self.history_path)
+        from_file = await asyncio.get_running_loop().run_in_executor(None, 
+            lambda: {switch: history_file.between(switch.index, start, end) for switch in older})
+        return self.switch_history_response(transaction, switches, start, end, from_file)
 
-    def getSwitchStep(self, transaction):
-        return self.alpaca.nominal_response(transaction, value=1)
-        
-    def doAction(self, transaction):
-        return self.alpaca.not_supported_response(transaction)
+    def switch_history_response(self, transaction, switches, start, end, from_file):
+        # from_file: {switch: events read from the history file}, for switches whose memory history starts after start
+        results = []
+        for switch in switches:
+            oldest = switch.history.oldest()
+            # the file holds everything the memory history does, and more
+            events = from_file.get(switch, [])
+            if oldest is not None:
+                # events from the last history_spill_delay may not be in the file yet; take those from memory
+                events = [event for event in events if event[0] < oldest] + switch.history.between(start, end)
+            results.append({
+                "Id": switch.number,
+                "Name": switch.name,
+                "Events": [{"Time": round(t, 1), "Event": event, "State": state} for (t, event, state) in events],
+            })
+        return self.alpaca.nominal_response(transaction, value=json.dumps(results))
         
     def doCommandBlind(self, transaction):
         return self.alpaca.not_supported_response(transaction)
@@ -306,87 +1532,63 @@ class SwitchManager():
         return self.alpaca.not_supported_response(transaction)
 
     def setConnected(self, transaction):
-        self.alpaca.connected = transaction.params["connected"] in ("true", "True")
+        group = self.get_group(transaction)
+        group.connected = transaction.args["connected"]
         # don't send a response if client is disconnecting
-        if self.alpaca.connected:        
-            print('\n\n>>>>>>>>>>>>>>> CLIENT CONNECTED >>>>>>>>>>>>>>\n\n')
+        if group.connected:        
+            alpaca_log.info('>>>>>>>>>>>>>>> CLIENT CONNECTED (device %i) >>>>>>>>>>>>>>', group.number)
+            # polling was paused while disconnected; refresh everything now
+            self.io.loop.call_soon_threadsafe(self.poll_all_now, group)
         else:
-            print('\n\nXXXXXXXXXXXXXXX CLIENT DISCONNECTED XXXXXXXXXXXXXXXX\n\n')        
+            alpaca_log.info('XXXXXXXXXXXXXXX CLIENT DISCONNECTED (device %i) XXXXXXXXXXXXXXXX', group.number)
         return self.alpaca.nominal_response(transaction)
 
+    def read_only_response(self, transaction, switch):
+        return self.alpaca.error_response(transaction,
+            self.alpaca.api.error_codes['PROPERTY_OR_METHOD_NOT_IMPLEMENTED'], 
+            'switch %i is read-only' % switch.number
+        )
+
     def setSwitch(self, transaction):
-        try:
-            switch_num = int(transaction.params["id"])
-        except:
-            return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
-            )
-        try: 
-            switch = self.switches[switch_num]
-        except IndexError:
-            return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
-            )
-        try:
-            state = transaction.params["state"] in ("true", "True")
-        except:
-            return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'unable to parse commanded state'
-            )
-        try:
-            asyncio.run(switch.setState(state))
-        except:
-            return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['VALUE_NOT_SET'], 
-                'unable to set switch state'
-            )
-        return self.alpaca.nominal_response(transaction)
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        if not switch.can_write:
+            return self.read_only_response(transaction, switch)
+        state = transaction.args["state"]
+        self.note_interest(switch, write=True)
+        return self.write_state(transaction, switch, state)
 
             
     def setSwitchName(self, transaction):
         return self.alpaca.not_supported_response(transaction)
 
     def setSwitchValue(self, transaction):
-        try:
-            switch_num = int(transaction.params["id"])
-        except:
+        (switch, error) = self.get_switch(transaction)
+        if error is not None:
+            return error
+        if not switch.can_write:
+            return self.read_only_response(transaction, switch)
+        value = transaction.args["value"]
+        if not 0 <= value <= 1:
             return self.alpaca.error_response(transaction,
                 self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
-            )
-        try: 
-            switch = self.switches[switch_num]
-        except IndexError:
-            return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'invalid switch id: %i' % switch_num
-            )
-        try:
-            state = transaction.params["value"] == '1'
-        except:
-            return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['INVALID_VALUE'], 
-                'unable to parse commanded value'
+                'switch value %s out of range [0, 1]' % value
             )
+        state = value >= 0.5
+        self.note_interest(switch, write=True)
+        return self.write_state(transaction, switch, state)
+
+    async def write_state(self, transaction, switch, state):
+        # Device I/O part of setswitch/setswitchvalue; returned as a coroutine for Alpaca to run on the device loop.
+        # One round trip: answers once the relay acknowledges (see write_switch).
         try:
-            print('setting state: %s' % str(state))
-            asyncio.run(switch.setState(state))
-        except:
+            await self.write_switch(switch, state)
+        except Exception:
             return self.alpaca.error_response(transaction,
                 self.alpaca.api.error_codes['VALUE_NOT_SET'], 
                 'unable to set switch state'
             )
-        try:
-            print('checking switch state')
-            asyncio.run(switch.check())
-        except:
-            return self.alpaca.error_response(transaction,
-                self.alpaca.api.error_codes['VALUE_NOT_SET'], 
-                'unable to get switch state'
-            )
         return self.alpaca.nominal_response(transaction)    
 
 
@@ -396,8 +1598,7 @@ def delay_print(outstr, delay=0.01):
     time.sleep(delay)
 
 
-async def main():
-
+def print_banner():
     print("""
 
 
@@ -417,6 +1618,22 @@ async def main():
     print('\n\n')
     time.sleep(1)
 
+
+def print_started():
+    delay_print("\n\n\n >>>>>>>>>>>>  Kasa Alpaca server started  <<<<<<<<<<<<< \n")
+    time.sleep(1)
+    delay_print(      "         Clients may now discover and connect...         \n",0.02)
+    print('\n\n')
+    time.sleep(1)
+    delay_print('!!!  To stop the Kasa ASCOM-remote server, press ctrl-c or close this window.\n',0.02)
+    time.sleep(1)
+    delay_print('Status information that follows may be ignored unless troubleshooting.\n',0.02)
+    print('\n\n')
+    time.sleep(2)
+
+
+def main():
+
     # Parse command line arguments:
     parser = argparse.ArgumentParser(description="Run a simple HTTP server")
     parser.add_argument(
@@ -424,7 +1641,7 @@ async def main():
         "--address",
         type=str,
         default="0.0.0.0",
-        help="Specify the IP address on which the server listens",
+        help="Specify the IP address on which the server listens (:: for IPv4 and IPv6, also answering IPv6 Alpaca discovery)",
     )
     parser.add_argument(
         "-p",
@@ -433,37 +1650,242 @@ async def main():
         default=8000,
         help="Specify the port on which the server listens",
     )
+    parser.add_argument(
+        "--discovery-target",
+        type=str,
+        default=SwitchManager.discovery_target,
+        help="Address kasa discovery packets are sent to, e.g. a subnet broadcast address",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        action="append",
+        default=[],
+        help="Plug or strip address to probe directly on every discovery, in addition to broadcast; may be repeated",
+    )
+    parser.add_argument(
+        "--hosts-file",
+        type=str,
+        default=None,
+        help="File listing plug and strip addresses to probe directly, one per line (# starts a comment)",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default=None,
+        help='JSON file splitting the switches into Alpaca devices: [{"Name": ..., "Switches": [name/address/id patterns]}, ...]',
+    )
+    parser.add_argument(
+        "--no-broadcast",
+        action="store_true",
+        help="Don't broadcast for kasa devices; only probe the --host and --hosts-file addresses",
+    )
+    parser.add_argument(
+        "--server",
+        choices=("threaded", "asyncio"),
+        default="threaded",
+        help="HTTP front end: a thread per connection (threaded) or one event loop shared with device I/O (asyncio)",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=Alpaca.max_connections,
+        help="Maximum number of HTTP connections served at once; more wait in a queue",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=Alpaca.max_pending_connections,
+        help="Maximum number of HTTP connections waiting for a slot; beyond this, clients are answered 503",
+    )
+    parser.add_argument(
+        "--max-event-connections",
+        type=int,
+        default=Alpaca.max_event_connections,
+        help="Maximum number of /events long-polls and streams open at once, outside --max-connections; beyond this, clients are answered 503",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=Alpaca.idle_timeout,
+        help="Seconds a keep-alive HTTP connection may sit idle between requests",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=Alpaca.read_timeout,
+        help="Seconds a client may stall while sending a request",
+    )
+    parser.add_argument(
+        "--poll-concurrency",
+        type=int,
+        default=SwitchManager.state_check_concurrency,
+        help="Maximum number of switches polled simultaneously",
+    )
+    parser.add_argument(
+        "--poll-timeout",
+        type=float,
+        default=SwitchManager.state_check_timeout,
+        help="Seconds to wait for each switch to answer a state poll",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=SwitchManager.state_max_age,
+        help="Seconds a polled switch state may be served to clients before it is considered stale",
+    )
+    parser.add_argument(
+        "--stale-reads",
+        choices=("refresh", "error"),
+        default=SwitchManager.stale_read_policy,
+        help="On a stale read, poll the switch (refresh) or return an Alpaca error (error)",
+    )
+    parser.add_argument(
+        "--energy-interval",
+        type=float,
+        default=SwitchManager.energy_sample_interval,
+        help="Minimum seconds between energy meter samples of each switch",
+    )
+    parser.add_argument(
+        "--energy-history",
+        type=int,
+        default=SwitchManager.energy_history_size,
+        help="Energy meter samples kept per switch, for the GetPowerStats action",
+    )
+    parser.add_argument(
+        "--no-power-channels",
+        action="store_true",
+        help="Don't add a read-only power switch for each switch with an energy meter",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        default=os.path.join(os.path.expanduser("~"), ".kasa_alpaca_inventory.json"),
+        help="File the switch inventory is saved to and restored from at start-up; empty to disable",
+    )
+    parser.add_argument(
+        "--state-history",
+        type=int,
+        default=SwitchManager.state_history_size,
+        help="State transitions and commands kept in memory per switch, for the GetSwitchHistory action",
+    )
+    parser.add_argument(
+        "--history-file",
+        type=str,
+        default=None,
+        help="Also append every switch's state transitions and commands to this file, kept indefinitely",
+    )
+    parser.add_argument(
+        "--non-interactive",
+        action="store_true",
+        help="Skip the banner and start-up pauses, e.g. when run as a service (implied when output is not a terminal)",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Log per-request and per-poll detail (debug level)",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Log everything, including request parameters and response bodies",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Log warnings and errors only",
+    )
+    parser.add_argument(
+        "--log-file",
+        type=str,
+        default=None,
+        help="Also write the log to this file",
+    )
     args = parser.parse_args()
+    static_hosts = list(args.host)
+    if args.hosts_file is not None:
+        with open(args.hosts_file) as hosts_file:
+            static_hosts += [line.split('#', 1)[0].strip() for line in hosts_file if line.split('#', 1)[0].strip()]
+    if args.no_broadcast and not static_hosts:
+        parser.error('--no-broadcast needs --host or --hosts-file addresses to probe')
+    switch_groups = None
+    if args.devices is not None:
+        try:
+            with open(args.devices) as devices_file:
+                switch_groups = [SwitchGroup(number, device["Name"], device.get("Switches", ("*",)), device.get("UniqueID"))
+                    for number, device in enumerate(json.load(devices_file))]
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as error:
+            parser.error('unable to read --devices file %s: %s' % (args.devices, error))
+        if not switch_groups:
+            parser.error('--devices file %s lists no devices' % args.devices)
+    interactive = sys.stdout.isatty() and not args.non_interactive
+    if interactive:
+        print_banner()
+    
+    log_level = TRACE if args.trace else logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO
+    setup_logging(log_level, args.log_file)
     #print('Specified arguments:',args)
     #print('Kasa ASCOM-Remote server address: %s, port: %i' % (args.address, args.port))
     alpaca_device_control_port = args.port
     
+    # All kasa device I/O runs on this one event loop thread:
+    io_loop = DeviceIOLoop()
+    io_loop.start()
+    
     alpaca = Alpaca(
         device_type = "Switch", 
         server_address = args.address, 
-        control_port = args.port
+        control_port = args.port,
+        loop = io_loop.loop,
+        server_mode = args.server
     )
+    alpaca.max_connections = args.max_connections
+    alpaca.max_pending_connections = args.max_pending
+    alpaca.max_event_connections = args.max_event_connections
+    alpaca.idle_timeout = args.idle_timeout
+    alpaca.read_timeout = args.read_timeout
     
-    switch_manager = SwitchManager(alpaca)
-    await switch_manager.discover()
-    
-    alpaca.bindMethods(switch_manager.alpaca_methods)
-    alpaca.start()
-    delay_print("\n\n\n >>>>>>>>>>>>  Kasa Alpaca server started  <<<<<<<<<<<<< \n")
-    time.sleep(1)
-    delay_print(      "         Clients may now discover and connect...         \n",0.02)
-    print('\n\n')
-    time.sleep(1)
-    delay_print('!!!  To stop the Kasa ASCOM-remote server, press ctrl-c or close this window.\n',0.02)
-    time.sleep(1)
-    delay_print('Status information that follows may be ignored unless troubleshooting.\n',0.02)
-    print('\n\n')
-    time.sleep(2)
+    switch_manager = SwitchManager(alpaca, io_loop)
+    switch_manager.discovery_target = args.discovery_target
+    switch_manager.static_hosts = tuple(dict.fromkeys(static_hosts))
+    switch_manager.broadcast_discovery = not args.no_broadcast
+    switch_manager.state_check_concurrency = args.poll_concurrency
+    switch_manager.state_check_timeout = args.poll_timeout
+    switch_manager.state_max_age = args.max_age
+    switch_manager.stale_read_policy = args.stale_reads
+    switch_manager.energy_sample_interval = args.energy_interval
+    switch_manager.energy_history_size = args.energy_history
+    switch_manager.power_channels = not args.no_power_channels
+    switch_manager.inventory_path = args.inventory or None
+    switch_manager.state_history_size = args.state_history
+    switch_manager.history_path = args.history_file
+    if switch_groups is not None:
+        switch_manager.set_groups(switch_groups)
+    # Ctrl-C stops the servers, then the log writer, so the records queued up to then are written
+    try:
+        # With a saved inventory, serve it straight away and let the discovery loop reconcile it in the
+        # background; on a first run, there is nothing to serve until discovery finishes.
+        if not switch_manager.load_inventory():
+            io_loop.run(switch_manager.discover())
+        
+        alpaca.bindMethods(switch_manager.alpaca_methods)
+        alpaca.start()
+        alpaca_log.info('Starting switch state auto-rediscover and state check loops...')
+        switch_manager.start_discovery_loop()
+        switch_manager.start_state_check_loop()
+        if interactive:
+            print_started()
+        io_loop.wait()
+    except KeyboardInterrupt:
+        alpaca_log.info('Interrupted, shutting down')
+    finally:
+        alpaca.stop()
+        stop_logging()
 
-    print('Starting switch state auto-rediscover and state check loops...')
-    await switch_manager.start_discovery_loop()
-    await switch_manager.start_state_check_loop()
 
+if __name__ == "__main__":
+    main()
 
-asyncio.run(main())
 
@@ -0,0 +1,61 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Shared fixtures: a SwitchManager serving a small hand-built inventory, with
+no kasa devices or network I/O behind it (nothing is discovered or polled).
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from alpaca import Alpaca
+from energy import EnergyHistory
+from history import StateHistory
+from start_server import DeviceIOLoop, KasaSwitch, PowerChannel, SwitchManager
+
+
+@pytest.fixture(scope="session")
+def io_loop():
+    io_loop = DeviceIOLoop()
+    io_loop.start()
+    return io_loop
+
+
+@pytest.fixture
+def switch_manager(io_loop):
+    # Device 0: switches 0 and 1 are plugs, 2 a plug with an energy meter and 3 its read-only power switch
+    alpaca = Alpaca(device_type="Switch", server_address="127.0.0.1", control_port=0, discovery_port=0, loop=io_loop.loop)
+    switch_manager = SwitchManager(alpaca, io_loop)
+    for number in range(3):
+        switch = KasaSwitch(switch_address='127.0.0.%i' % (10 + number))
+        switch.name = 'plug %i' % number
+        switch.type = 'HS103'
+        switch.index = len(switch_manager.channels)
+        switch.history = StateHistory(16)
+        switch_manager.switches.append(switch)
+        switch_manager.channels.append(switch)
+        switch_manager.groups[0].add(switch)
+    switch.energy = EnergyHistory(16)
+    channel = PowerChannel(switch)
+    channel.index = len(switch_manager.channels)
+    switch_manager.channels.append(channel)
+    switch_manager.groups[0].add(channel)
+    switch_manager.publish_inventory()
+    yield switch_manager
+    alpaca.server.server.server_close()
+
+
+def action(switch_manager, name, parameters):
+    # Call a custom action as Alpaca would; returns what the bound method returned
+    transaction = Alpaca.Transaction(client_transaction_id=1, server_transaction_id=1, client_id=1, request_type="PUT",
+        request_path='/api/v1/switch/0/action', method="action", params={}, 
+        args={"device_type": "switch", "device_number": 0, "action": name, "parameters": json.dumps(parameters)})
+    return switch_manager.supported_actions[name](transaction)
+
+
+def error_number(response):
+    # ErrorNumber of a (status, content) response with a dict body
+    (status, content) = response
+    assert status == 200
+    return content["ErrorNumber"]
@@ -0,0 +1,136 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Argument validation of the custom Alpaca actions
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import inspect
+import json
+
+import pytest
+
+from conftest import action, error_number
+from history import HistoryFile, StateHistory
+from start_server import lookup_channel, parse_switch_state
+
+
+INVALID_VALUE = 0x401
+
+
+def test_lookup_channel():
+    channels = ["a", "b"]
+    assert lookup_channel(channels, 1) == "b"
+    assert lookup_channel(channels, "0") == "a"
+    for switch_num in (-1, "-1", 2, "2"):
+        with pytest.raises(IndexError):
+            lookup_channel(channels, switch_num)
+    for switch_num in (True, 1.0, "x", None):
+        with pytest.raises((ValueError, TypeError)):
+            lookup_channel(channels, switch_num)
+
+
+def test_parse_switch_state():
+    assert parse_switch_state(True) is True
+    assert parse_switch_state(0) is False
+    assert parse_switch_state(1) is True
+    for state in ("false", "true", 2, -1, 1.0, None, []):
+        with pytest.raises(ValueError):
+            parse_switch_state(state)
+
+
+def set_switch_changes(switch_manager, parameters):
+    # The (switch, state) changes SetSwitchStates would apply, without touching any device
+    coroutine = action(switch_manager, "SetSwitchStates", parameters)
+    assert inspect.iscoroutine(coroutine), coroutine
+    changes = inspect.getcoroutinelocals(coroutine)["changes"]
+    coroutine.close()
+    return [(switch.number, state) for switch, state in changes]
+
+
+def test_set_switch_states_valid(switch_manager):
+    assert set_switch_changes(switch_manager, {"0": True, "1": 0, "2": 1}) == [(0, True), (1, False), (2, True)]
+
+
+@pytest.mark.parametrize("parameters", [
+    {"-1": True},           # would be the last switch with Python indexing
+    {"-4": True},
+    {"4": True},
+    {"x": True},
+    {"0": "false"},         # a string, not a state; bool("false") is True
+    {"0": "true"},
+    {"0": 2},
+    {"0": None},
+    [0, True],
+])
+def test_set_switch_states_invalid(switch_manager, parameters):
+    assert error_number(action(switch_manager, "SetSwitchStates", parameters)) == INVALID_VALUE
+
+
+def test_set_switch_states_read_only(switch_manager):
+    assert error_number(action(switch_manager, "SetSwitchStates", {"3": True})) != 0
+
+
+def test_get_power_stats(switch_manager):
+    (status, content) = action(switch_manager, "GetPowerStats", {"Ids": [2, 3]})
+    assert content["ErrorNumber"] == 0
+    assert '"Id": 2' in content["Value"] and '"PowerId": 3' in content["Value"]
+
+
+@pytest.mark.parametrize("parameters", [
+    {"Ids": [-1]},          # would be the power switch of switch 2 with Python indexing
+    {"Ids": [4]},
+    {"Ids": [0]},           # no energy meter
+    {"Ids": ["x"]},
+    {"Ids": 2},
+    {"Window": "long"},
+])
+def test_get_power_stats_invalid(switch_manager, parameters):
+    assert error_number(action(switch_manager, "GetPowerStats", parameters)) == INVALID_VALUE
+
+
+def history_events(response, switch_id):
+    (status, content) = response
+    assert content["ErrorNumber"] == 0
+    return [(event["Time"], event["Event"], event["State"]) for row in json.loads(content["Value"]) if row["Id"] == switch_id 
+        for event in row["Events"]]
+
+
+def test_get_switch_history_memory(switch_manager):
+    switch = switch_manager.inventory.devices[0][0]
+    switch.history.append(1718000000.0, "write", True)
+    switch.history.append(1718000010.0, "poll", False)
+    response = action(switch_manager, "GetSwitchHistory", {"Start": 1718000005, "End": 1718000020, "Ids": [0]})
+    assert history_events(response, 0) == [(1718000010.0, "poll", False)]
+
+
+def test_get_switch_history_file(switch_manager, io_loop, tmp_path):
+    # events older than the memory history come from the file, read off the device loop
+    switch = switch_manager.inventory.devices[0][1]
+    switch_manager.history_path = str(tmp_path / 'history.bin')
+    old = [switch.history.append(1718000000.0 + t, "poll", t % 2 == 0) for t in range(3)]
+    HistoryFile(switch_manager.history_path).append([(switch.index, ticks, code) for (ticks, code) in old])
+    switch.history = StateHistory(16)
+    switch.history.append(1718000100.0, "write", True)
+    coroutine = action(switch_manager, "GetSwitchHistory", {"Start": 1718000000, "End": 1718000200, "Ids": [1]})
+    assert inspect.iscoroutine(coroutine)
+    assert history_events(io_loop.run(coroutine, 5), 1) == [
+        (1718000000.0, "poll", True), (1718000001.0, "poll", False), (1718000002.0, "poll", True), (1718000100.0, "write", True)]
+
+
+@pytest.mark.parametrize("parameters", [
+    {"Ids": [-1]},
+    {"Ids": [4]},
+    {"Ids": [True]},
+    {"Start": "yesterday"},
+    {"Ids": None},
+    {"End": float("inf")},
+    {"Start": float("-inf")},
+    {"Start": float("nan")},
+])
+def test_get_switch_history_invalid(switch_manager, parameters):
+    switch_manager.switches[0].history.append(1718000000.0, "poll", True)
+    assert error_number(action(switch_manager, "GetSwitchHistory", parameters)) == INVALID_VALUE
+
+
+def test_get_switch_states_last_error(switch_manager):
+    switch_manager.switches[2].last_check_error = 'timeout'
+    (status, content) = action(switch_manager, "GetSwitchStates", {})
+    table = json.loads(content["Value"])
+    assert [row["LastError"] for row in table] == [None, None, 'timeout', 'timeout']
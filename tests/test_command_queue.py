@@ -0,0 +1,136 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+CommandQueue: write coalescing, writes before reads, shared polls and
+per-command timeouts, with coroutines standing in for device I/O.
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import asyncio
+
+import pytest
+
+from start_server import CommandQueue
+
+
+def recorder(log, name, result=None, error=None, delay=0):
+    # A command that logs its name when it runs, then returns result or raises error
+    async def run():
+        log.append(name)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return name if result is None else result
+    return run
+
+
+async def block(queue, log):
+    # Occupy the worker with a command that runs until release is set, so later commands queue up
+    release = asyncio.Event()
+    async def run():
+        log.append("blocker")
+        await release.wait()
+    task = asyncio.ensure_future(queue.poll(run, 5, op="blocker"))
+    while queue.running is None:
+        await asyncio.sleep(0)
+    return (task, release)
+
+
+def test_last_writer_wins(io_loop):
+    async def scenario():
+        (queue, log) = (CommandQueue(), [])
+        (blocker, release) = await block(queue, log)
+        writes = [asyncio.ensure_future(queue.write("switch", recorder(log, name), 5)) for name in ("on", "off", "on again")]
+        await asyncio.sleep(0)
+        release.set()
+        return (await asyncio.gather(*writes), log)
+    (results, log) = io_loop.run(scenario(), 5)
+    assert log == ["blocker", "on again"]
+    assert results == ["on again"] * 3
+
+
+def test_coalesced_writers_share_the_failure(io_loop):
+    async def scenario():
+        (queue, log) = (CommandQueue(), [])
+        (blocker, release) = await block(queue, log)
+        writes = [asyncio.ensure_future(queue.write("switch", recorder(log, "on"), 5)),
+            asyncio.ensure_future(queue.write("switch", recorder(log, "off", error=OSError("no reply")), 5))]
+        await asyncio.sleep(0)
+        release.set()
+        return (await asyncio.gather(*writes, return_exceptions=True), log)
+    (results, log) = io_loop.run(scenario(), 5)
+    assert log == ["blocker", "off"]
+    assert [str(result) for result in results] == ["no reply", "no reply"]
+
+
+def test_writes_to_other_keys_are_not_coalesced(io_loop):
+    async def scenario():
+        (queue, log) = (CommandQueue(), [])
+        (blocker, release) = await block(queue, log)
+        writes = [asyncio.ensure_future(queue.write(key, recorder(log, key), 5)) for key in ("outlet 1", "outlet 2")]
+        await asyncio.sleep(0)
+        release.set()
+        return (await asyncio.gather(*writes), log)
+    (results, log) = io_loop.run(scenario(), 5)
+    assert log == ["blocker", "outlet 1", "outlet 2"]
+    assert results == ["outlet 1", "outlet 2"]
+
+
+def test_queued_write_runs_before_queued_poll(io_loop):
+    async def scenario():
+        (queue, log) = (CommandQueue(), [])
+        (blocker, release) = await block(queue, log)
+        poll = asyncio.ensure_future(queue.poll(recorder(log, "poll"), 5))
+        await asyncio.sleep(0)
+        write = asyncio.ensure_future(queue.write("switch", recorder(log, "write"), 5))
+        await asyncio.sleep(0)
+        assert queue.depth() == 3
+        release.set()
+        await asyncio.gather(poll, write)
+        return (log, queue.depth())
+    (log, depth) = io_loop.run(scenario(), 5)
+    assert log == ["blocker", "write", "poll"]
+    assert depth == 0
+
+
+def test_concurrent_polls_share_one_run(io_loop):
+    async def scenario():
+        (queue, log) = (CommandQueue(), [])
+        results = await asyncio.gather(*[queue.poll(recorder(log, "poll", result=object()), 5) for _ in range(3)])
+        return (results, log)
+    (results, log) = io_loop.run(scenario(), 5)
+    assert log == ["poll"]
+    assert results[0] is results[1] is results[2]
+
+
+def test_polls_of_other_ops_run_separately(io_loop):
+    async def scenario():
+        (queue, log) = (CommandQueue(), [])
+        await asyncio.gather(queue.poll(recorder(log, "poll"), 5), queue.poll(recorder(log, "energy"), 5, op="energy"))
+        return log
+    assert io_loop.run(scenario(), 5) == ["poll", "energy"]
+
+
+def test_timeout_fails_only_the_running_command(io_loop):
+    async def scenario():
+        (queue, log) = (CommandQueue(), [])
+        slow = asyncio.ensure_future(queue.poll(recorder(log, "slow", delay=1), 0.05))
+        while queue.running is None:
+            await asyncio.sleep(0)
+        # queued behind the slow poll for longer than its own timeout: time queued doesn't count
+        write = asyncio.ensure_future(queue.write("switch", recorder(log, "write"), 0.02))
+        with pytest.raises(asyncio.TimeoutError):
+            await slow
+        return (await write, log)
+    (result, log) = io_loop.run(scenario(), 5)
+    assert result == "write"
+    assert log == ["slow", "write"]
+
+
+def test_caller_giving_up_does_not_cancel_shared_poll(io_loop):
+    async def scenario():
+        (queue, log) = (CommandQueue(), [])
+        run = recorder(log, "poll", delay=0.05)
+        impatient = asyncio.ensure_future(queue.poll(run, 5))
+        patient = asyncio.ensure_future(queue.poll(run, 5))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        return (await patient, log)
+    (result, log) = io_loop.run(scenario(), 5)
+    assert result == "poll" and log == ["poll"]
@@ -0,0 +1,92 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Connection limits of both HTTP server modes: event-feed requests wait
+outside max_connections, under their own max_event_connections limit.
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import asyncio
+import http.client
+import json
+import socket
+import time
+
+import pytest
+
+from alpaca import Alpaca
+
+
+@pytest.fixture(params=["threaded", "asyncio"])
+def server(request, io_loop):
+    # An Alpaca server on a free port allowing one connection and one event-feed request at a time
+    alpaca = Alpaca(device_type="Switch", server_address="127.0.0.1", control_port=0, discovery_port=0,
+        loop=io_loop.loop, server_mode=request.param)
+    alpaca.max_connections = 1
+    alpaca.max_event_connections = 1
+    alpaca.server.start()
+    if request.param == "threaded":
+        port = alpaca.server.server.server_address[1]
+    else:
+        port = alpaca.server.server.sockets[0].getsockname()[1]
+    yield (alpaca, port)
+    if request.param == "threaded":
+        alpaca.server.server.shutdown()
+        alpaca.server.server.server_close()
+    else:
+        alpaca.server.server.close()
+        io_loop.run(alpaca.server.server.wait_closed(), 5)
+
+
+def get(port, path, timeout=2):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    connection.request("GET", path)
+    return connection
+
+
+def test_event_feed_leaves_connection_slot_free(server):
+    (alpaca, port) = server
+    poll = get(port, '/events?timeout=3', timeout=5)
+    other = get(port, '/api/v1/switch/0/connected?ClientTransactionID=1', timeout=1).getresponse()
+    assert other.status != 503
+    response = poll.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read())["Events"] == []
+
+
+def test_event_feed_limit(server):
+    (alpaca, port) = server
+    poll = get(port, '/events?timeout=1', timeout=5)
+    rejected = get(port, '/events?timeout=1', timeout=5).getresponse()
+    assert rejected.status == 503
+    assert alpaca.limit_counters["event_connections_rejected"] == 1
+    assert poll.getresponse().status == 200
+
+
+def test_read_timeout_is_a_deadline(server):
+    # A client sending its headers a line at a time, each well within read_timeout, is still cut off
+    (alpaca, port) = server
+    alpaca.read_timeout = 0.5
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(b'GET /management/apiversions HTTP/1.1\r\n')
+        t0 = time.monotonic()
+        with pytest.raises(OSError):
+            for n in range(20):
+                time.sleep(0.2)
+                sock.sendall(b'X-Drip-%i: 1\r\n' % n)
+                sock.settimeout(0.01)
+                try:
+                    if sock.recv(1024) == b'':
+                        raise ConnectionResetError('closed')
+                except socket.timeout:
+                    pass
+                sock.settimeout(5)
+        assert time.monotonic() - t0 < 2
+    assert alpaca.limit_counters["read_timeouts"] == 1
+
+
+def test_expect_100_continue(server):
+    (alpaca, port) = server
+    body = b'Connected=true&ClientTransactionID=1'
+    with socket.create_connection(('127.0.0.1', port), timeout=2) as sock:
+        sock.sendall(b'PUT /api/v1/switch/0/connected HTTP/1.1\r\nHost: test\r\nExpect: 100-continue\r\n'
+            b'Content-Type: application/x-www-form-urlencoded\r\nContent-Length: %i\r\n\r\n' % len(body))
+        assert sock.recv(1024).startswith(b'HTTP/1.1 100 Continue\r\n\r\n')
+        sock.sendall(body)
+        assert sock.recv(1024).startswith(b'HTTP/1.1 ')
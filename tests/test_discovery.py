@@ -0,0 +1,47 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Rediscovery of power strips: a strip already in the inventory is not
+updated again to list its outlets.
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+from start_server import KasaSwitch
+
+
+class FakeStrip():
+    # Just enough of a kasa strip for expand_strips: outlets appear on the first update()
+    def __init__(self, host, device_id, outlets=0):
+        self.host = host
+        self.device_id = device_id
+        self.alias = 'strip %s' % device_id
+        self.sys_info = {"children": [{"id": str(n)} for n in range(3)]}
+        self.children = ['outlet %i' % n for n in range(outlets)]
+        self.updates = 0
+
+    async def update(self, update_children=True):
+        self.updates += 1
+        self.children = ['outlet %i' % n for n in range(3)]
+
+
+def add_strip(switch_manager, device):
+    switch = KasaSwitch(switch_address=device.host)
+    switch.device = device
+    switch.device_id = device.device_id
+    switch_manager.switches_by_device_id[device.device_id] = switch
+
+
+def test_known_strip_reused(switch_manager, io_loop):
+    known = FakeStrip('127.0.0.20', 'A', outlets=3)
+    add_strip(switch_manager, known)
+    rediscovered = FakeStrip('127.0.0.20', 'A')
+    new = FakeStrip('127.0.0.21', 'B')
+    found = io_loop.run(switch_manager.expand_strips({'127.0.0.20': rediscovered, '127.0.0.21': new}), 5)
+    assert found == {'127.0.0.20': known, '127.0.0.21': new}
+    assert (known.updates, rediscovered.updates, new.updates) == (0, 0, 1)
+
+
+def test_moved_or_unlisted_strip_updated(switch_manager, io_loop):
+    add_strip(switch_manager, FakeStrip('127.0.0.20', 'A', outlets=3))
+    add_strip(switch_manager, FakeStrip('127.0.0.22', 'C'))     # restored from the inventory, never polled
+    moved = FakeStrip('127.0.0.23', 'A')
+    restored = FakeStrip('127.0.0.22', 'C')
+    found = io_loop.run(switch_manager.expand_strips({'127.0.0.23': moved, '127.0.0.22': restored}), 5)
+    assert found == {'127.0.0.23': moved, '127.0.0.22': restored}
+    assert (moved.updates, restored.updates) == (1, 1)
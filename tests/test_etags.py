@@ -0,0 +1,63 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Conditional GETs: ETags follow the inventory version and each switch's
+state version, not the response content.
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+from alpaca import Alpaca
+
+
+def get(switch_manager, method, if_none_match=None, **args):
+    # Call a bound GET method as Alpaca would; returns (status, TaggedResponse)
+    transaction = Alpaca.Transaction(client_transaction_id=1, server_transaction_id=1, client_id=1, request_type="GET",
+        request_path='/api/v1/switch/0/%s' % method.lower(), method=method.lower(), params={},
+        args=dict({"device_type": "switch", "device_number": 0}, **args), if_none_match=if_none_match)
+    return getattr(switch_manager, method)(transaction)
+
+
+def test_state_etag_follows_state_changes(switch_manager):
+    switch = switch_manager.switches[0]
+    switch.record_state(True)
+    (status, response) = get(switch_manager, "getSwitch", id=0)
+    assert status == 200 and response.etag.startswith('W/"')
+    etag = response.etag
+    assert get(switch_manager, "getSwitch", etag, id=0)[0] == 304
+    assert get(switch_manager, "getSwitchValue", etag, id=0)[0] == 304
+
+    switch.record_state(True)       # refreshed, unchanged
+    assert get(switch_manager, "getSwitch", etag, id=0)[0] == 304
+
+    switch.record_state(False)
+    (status, response) = get(switch_manager, "getSwitch", etag, id=0)
+    assert status == 200 and response.etag != etag
+    switch.record_state(True)       # back to the first state, but a newer version
+    (status, response) = get(switch_manager, "getSwitch", etag, id=0)
+    assert status == 200 and response.etag != etag
+
+
+def test_stale_state_is_not_answered_304(switch_manager):
+    switch = switch_manager.switches[0]
+    switch.record_state(True)
+    etag = get(switch_manager, "getSwitch", id=0)[1].etag
+    switch.reading = (True, 0, switch.reading[2])
+    switch_manager.stale_read_policy = "error"
+    (status, response) = get(switch_manager, "getSwitch", etag, id=0)
+    assert status == 200 and response["ErrorNumber"] != 0
+
+
+def test_inventory_etag_follows_inventory_version(switch_manager):
+    (status, response) = get(switch_manager, "getSwitchName", id=1)
+    etag = response.etag
+    assert get(switch_manager, "getSwitchName", etag, id=1)[0] == 304
+    assert get(switch_manager, "getMaxSwitch", etag)[0] == 304
+
+    switch_manager.publish_inventory()
+    (status, response) = get(switch_manager, "getSwitchName", etag, id=1)
+    assert status == 200 and response.etag != etag
+
+
+def test_etags_differ_between_servers(switch_manager):
+    other = Alpaca(device_type="Switch", server_address="127.0.0.1", control_port=0, discovery_port=0,
+        loop=switch_manager.alpaca.loop)
+    try:
+        assert other.etag_prefix != switch_manager.alpaca.etag_prefix
+    finally:
+        other.server.server.server_close()
@@ -0,0 +1,29 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Change notification cursors (/events?since=N, Last-Event-ID).
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import pytest
+
+from alpaca import Alpaca
+
+
+@pytest.fixture
+def alpaca():
+    alpaca = Alpaca(device_type="Switch", server_address="127.0.0.1", control_port=0, discovery_port=0)
+    for n in range(3):
+        alpaca.publish_event({"Type": "test", "N": n})
+    yield alpaca
+    alpaca.server.server.server_close()
+
+
+def test_cursor_from_this_run(alpaca):
+    assert alpaca.parse_events_request('/events?since=1&timeout=5') == (False, 1, 5)
+    assert alpaca.parse_events_request('/events/stream', '2') == (True, 2, 30)
+    assert alpaca.parse_events_request('/events')[1] == 3
+
+
+def test_cursor_from_before_a_restart_resends_retained_events(alpaca):
+    (stream, since, timeout) = alpaca.parse_events_request('/events?since=50')
+    assert since == 0
+    (version, events) = alpaca.events.wait(since, 0)
+    assert version == 3 and [event["N"] for event in events] == [0, 1, 2]
+    assert alpaca.parse_events_request('/events/stream', '50')[1] == 0
@@ -0,0 +1,71 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+StateHistory ring buffer and HistoryFile records
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import pytest
+
+from history import EVENTS, STATES, HistoryFile, StateHistory, decode, encode, from_ticks, to_ticks
+
+
+T0 = 1718000000.0
+
+
+def test_encode_decode():
+    for event in EVENTS:
+        for state in STATES:
+            assert decode(encode(event, state)) == (event, state)
+            assert 0 <= encode(event, state) < 256
+
+
+def test_ticks():
+    assert from_ticks(to_ticks(T0 + 12.3)) == pytest.approx(T0 + 12.3)
+    assert to_ticks(0) == 0
+
+
+def test_state_history_wraps():
+    history = StateHistory(4)
+    assert history.oldest() is None
+    assert history.between(0, T0 * 2) == []
+    for t in range(6):
+        history.append(T0 + t, "poll", t % 2 == 1)
+    assert history.oldest() == T0 + 2
+    assert history.between(0, T0 * 2) == [(T0 + t, "poll", t % 2 == 1) for t in range(2, 6)]
+    assert history.between(T0 + 3, T0 + 4) == [(T0 + 3, "poll", True), (T0 + 4, "poll", False)]
+    assert history.between(T0 + 10, T0 + 20) == []
+
+
+def test_history_file_round_trip(tmp_path):
+    history_file = HistoryFile(str(tmp_path / 'history.bin'))
+    assert history_file.between(0, 0, T0 * 2) == []
+    records = []
+    for t in range(100):
+        (index, event, state) = (t % 3, EVENTS[t % len(EVENTS)], STATES[t % len(STATES)])
+        records.append((index, to_ticks(T0 + t), encode(event, state)))
+    history_file.append(records[:50])
+    history_file.append(records[50:])
+    assert (tmp_path / 'history.bin').stat().st_size == 100 * HistoryFile.record.size == 700
+    assert history_file.between(1, 0, T0 * 2) == [
+        (T0 + t, EVENTS[t % len(EVENTS)], STATES[t % len(STATES)]) for t in range(100) if t % 3 == 1]
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    (T0 + 10, T0 + 20, list(range(10, 21))),      # inclusive at both ends
+    (T0 + 10.05, T0 + 19.95, list(range(10, 20))),  # bounds compare at the 0.1 s resolution times are stored with
+    (T0 + 10.15, T0 + 19.95, list(range(11, 20))),
+    (0, T0, [0]),
+    (T0 + 99, T0 + 500, [99]),
+    (T0 + 100, T0 + 500, []),
+    (T0 - 100, T0 - 1, []),
+])
+def test_history_file_bisect(tmp_path, start, end, expected):
+    history_file = HistoryFile(str(tmp_path / 'history.bin'))
+    history_file.append([(0, to_ticks(T0 + t), encode("poll", True)) for t in range(100)])
+    assert [t - T0 for (t, event, state) in history_file.between(0, start, end)] == pytest.approx(expected)
+
+
+def test_history_file_ignores_partial_record(tmp_path):
+    path = tmp_path / 'history.bin'
+    history_file = HistoryFile(str(path))
+    history_file.append([(0, to_ticks(T0 + t), encode("write", False)) for t in range(3)])
+    with open(path, 'ab') as partial:
+        partial.write(b'\x00\x00\x01')
+    assert len(history_file.between(0, 0, T0 * 2)) == 3
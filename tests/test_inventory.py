@@ -0,0 +1,122 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Saved inventory: save_inventory() -> load_inventory() round trip, and
+inventory files that must be ignored.
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import json
+
+import pytest
+
+from alpaca import Alpaca
+from start_server import PowerChannel, SwitchGroup, SwitchManager
+
+
+def record(index, switch_id, name, group, number, device_id=None, outlet=None, emeter=False, power_index=None, power_number=None,
+        state=None):
+    return {"index": index, "id": switch_id, "device_id": device_id or switch_id, "address": "127.0.0.%i" % (30 + index),
+        "name": name, "model": "HS300" if outlet else "HS110" if emeter else "HS103", "outlet": outlet, "emeter": emeter,
+        "power_index": power_index, "group": group, "number": number, "power_number": power_number, "present": True,
+        "state": state, "last_refresh": None if state is None else 1718000000.0}
+
+
+# Device 0: a plug, and a plug with an energy meter followed by its power switch; device 1: two outlets of
+# one strip; one more plug matches no device
+RECORDS = [
+    record(0, "P1", "plug a", 0, 0, state=True),
+    record(1, "M1", "plug meter", 0, 1, emeter=True, power_index=2, power_number=2, state=False),
+    record(3, "S1-00", "strip 1", 1, 0, device_id="S1", outlet=1),
+    record(4, "S1-01", "strip 2", 1, 1, device_id="S1", outlet=2, state=True),
+    record(5, "X1", "spare", None, None),
+]
+
+
+@pytest.fixture
+def make_manager(io_loop, tmp_path):
+    alpacas = []
+
+    def make_manager(records=None, groups=None, path='inventory.json'):
+        # A SwitchManager with the two test devices, reading inventory_path (written from records if given)
+        alpaca = Alpaca(device_type="Switch", server_address="127.0.0.1", control_port=0, discovery_port=0, loop=io_loop.loop)
+        alpacas.append(alpaca)
+        switch_manager = SwitchManager(alpaca, io_loop)
+        switch_manager.set_groups(groups or [SwitchGroup(0, "Pier 1", ("plug*",)), SwitchGroup(1, "Pier 2", ("strip*",))])
+        switch_manager.inventory_path = str(tmp_path / path)
+        if records is not None:
+            with open(switch_manager.inventory_path, 'w') as inventory_file:
+                json.dump({"switches": records}, inventory_file)
+        return switch_manager
+
+    yield make_manager
+    for alpaca in alpacas:
+        alpaca.server.server.server_close()
+
+
+def test_round_trip(make_manager):
+    first = make_manager(RECORDS)
+    assert first.load_inventory() == 5
+    first.inventory_path = first.inventory_path.replace('inventory.json', 'saved.json')
+    first.save_inventory()
+
+    restored = make_manager(path='saved.json')
+    assert restored.load_inventory() == 5
+    with open(first.inventory_path) as saved:
+        assert sorted(json.load(saved)["switches"], key=lambda saved: saved["index"]) == RECORDS
+
+    inventory = restored.inventory
+    assert [channel.name for channel in inventory.channels] == ["plug a", "plug meter", "plug meter power", "strip 1", "strip 2", "spare"]
+    assert [[channel.name for channel in channels] for channels in inventory.devices] == [
+        ["plug a", "plug meter", "plug meter power"], ["strip 1", "strip 2"]]
+    (plug, meter, power, outlet_1, outlet_2, spare) = inventory.channels
+    assert isinstance(power, PowerChannel) and power.switch is meter and meter.power_channel is power
+    assert meter.energy is not None and plug.energy is None
+    assert (plug.state, meter.state, outlet_1.state, outlet_2.state) == (True, False, None, True)
+    # the strip's outlets share its device object, siblings and command queue
+    assert outlet_1.device is outlet_2.device
+    assert outlet_1.siblings is outlet_2.siblings and set(outlet_1.siblings) == {outlet_1, outlet_2}
+    assert outlet_1.commands is outlet_2.commands
+    assert (outlet_1.outlet_number, outlet_2.outlet_number) == (1, 2)
+    assert spare.group is None and spare.index == 5
+    assert restored.switches_by_id["S1-01"] is outlet_2 and restored.switches_by_device_id["S1"] is outlet_1
+
+
+def legacy(records):
+    # As saved before Alpaca devices existed
+    return [{name: value for name, value in saved.items() if name not in ("group", "number", "power_number")} for saved in records]
+
+
+def test_legacy_inventory_without_groups(make_manager):
+    switch_manager = make_manager(legacy(RECORDS[:2]), groups=[SwitchGroup(0, "Kasa Switch Hub")])
+    assert switch_manager.load_inventory() == 2
+    assert [channel.number for channel in switch_manager.inventory.devices[0]] == [0, 1, 2]
+
+
+def changed(position, **fields):
+    # RECORDS with these fields of RECORDS[position] replaced
+    return [dict(saved, **fields) if n == position else saved for n, saved in enumerate(RECORDS)]
+
+
+@pytest.mark.parametrize("records", [
+    changed(4, index=6),                        # switch numbers (indices) not contiguous
+    changed(1, power_index=None),               # likewise: index 2 is missing
+    changed(2, group=0, number=3),              # switch now matched by another device
+    changed(4, name="plug spare"),              # switch now matched by a device it wasn't in
+    changed(3, number=2),                       # device numbering not contiguous
+    changed(1, power_number=3),                 # likewise, for a power switch
+    legacy(RECORDS),                            # saved before devices existed: all in device 0, but not the strips now
+    changed(0, index="zero"),                   # malformed
+    [{"id": "P1"}],                             # incomplete
+])
+def test_invalid_inventory_ignored(make_manager, records):
+    switch_manager = make_manager(records)
+    assert switch_manager.load_inventory() == 0
+    assert switch_manager.inventory.channels == () and switch_manager.switches == []
+
+
+def test_missing_or_unreadable_inventory_ignored(make_manager, tmp_path):
+    switch_manager = make_manager()
+    assert switch_manager.load_inventory() == 0
+    with open(switch_manager.inventory_path, 'w') as inventory_file:
+        inventory_file.write('{"switches": [')
+    assert switch_manager.load_inventory() == 0
+    with open(switch_manager.inventory_path, 'w') as inventory_file:
+        json.dump({"version": "1"}, inventory_file)
+    assert switch_manager.load_inventory() == 0
@@ -0,0 +1,64 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Poll scheduling: results stay with their switches, and a switch whose
+presence changes during a sweep is polled again once it is back.
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+import asyncio
+
+
+def fake_checks(switch_manager, during_sweep=None):
+    # Replace the device polls: switch 2 fails, the others succeed; during_sweep() runs in the first poll
+    polls = []
+
+    async def check_switch(switch_idx, switch, semaphore):
+        if during_sweep is not None and not polls:
+            during_sweep()
+        polls.append(switch)
+        switch.last_check_rtt = 0.001
+        await asyncio.sleep(0)
+        return switch.index != 2
+
+    switch_manager.check_switch = check_switch
+    return polls
+
+
+def run_state_check_loop(switch_manager, io_loop, seconds):
+    async def run():
+        try:
+            await asyncio.wait_for(switch_manager.state_check_loop(), seconds)
+        except asyncio.TimeoutError:
+            pass
+    io_loop.run(run(), seconds + 5)
+
+
+def test_check_switches_results_by_switch(switch_manager, io_loop):
+    (first, second, third) = switch_manager.switches
+    fake_checks(switch_manager, lambda: setattr(first, "present", False))
+    results = io_loop.run(switch_manager.check_switches([first, second, third]), 5)
+    assert results == {first: True, second: True, third: False}
+
+
+def test_switch_lost_during_sweep_is_polled_again(switch_manager, io_loop):
+    (first, second, third) = switch_manager.switches
+    switch_manager.groups[0].connected = True
+    switch_manager.state_check_loop_period = 0.05
+    fake_checks(switch_manager, lambda: setattr(first, "present", False))
+    run_state_check_loop(switch_manager, io_loop, 0.2)
+    assert first.next_poll is None
+    assert second.next_poll is not None and third.next_poll is not None
+    assert third.next_poll < second.next_poll     # the failed switch is retried, not given the idle interval
+
+    first.present = True
+    polls = fake_checks(switch_manager)
+    run_state_check_loop(switch_manager, io_loop, 0.2)
+    assert first in polls
+
+
+def test_event_subscribers_keep_switches_polled(switch_manager, io_loop):
+    switch = switch_manager.switches[0]
+    assert not switch_manager.polled(switch)
+    switch_manager.alpaca.event_connections = 1
+    assert switch_manager.polled(switch)
+    polls = fake_checks(switch_manager)
+    switch_manager.state_check_loop_period = 0.05
+    run_state_check_loop(switch_manager, io_loop, 0.2)
+    assert switch in polls